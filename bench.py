@@ -0,0 +1,270 @@
+"""
+Benchmarks for uninstall.py against fake_adb.py; no phone needed.
+
+A fake adb server runs in a subprocess with the requested package count,
+per-command latency and failure rate. The code under test reaches it either
+through a stand-in adb executable (the default, one process per command like
+the real tool) or through the native in-process client.
+
+    python bench.py                              # 100, 1000 and 10000 packages
+    python bench.py --sizes 500 --latency 0.005 --failure-rate 0.02
+    python bench.py --save-baseline              # store results in bench_baseline.json
+    python bench.py --compare                    # show changes against the baseline
+
+Results are printed and written to bench_output.txt.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fake_adb
+import uninstall as app
+
+BASELINE_FILE = "bench_baseline.json"
+OUTPUT_FILE = "bench_output.txt"
+REGRESSION_THRESHOLD = 0.25
+FILTER_QUERIES = ["c", "co", "com", "com.", "com.g", "com.go", "android", "*qti*", "re:^com\\.(miui|oneplus)",
+                  "sam -google", "/facebook|codeaurora/", ""]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(packages, latency, failure_rate):
+    """Starts fake_adb.py in its own process so it does not share our GIL or heap."""
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, fake_adb.__file__, "server", "--port", str(port), "--packages", str(packages),
+         "--latency", str(latency), "--failure-rate", str(failure_rate)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("fake adb server did not start")
+
+
+def measure(func, repeat):
+    """Returns (best wall seconds, peak traced KiB, ops) for func() -> ops."""
+    best, ops = None, 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        ops = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    # Peak memory comes from a separate run: tracemalloc slows the code it traces.
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak / 1024, ops
+
+
+def scenarios(session, args):
+    """Yields (name, func, repeat); each func returns the number of operations it did."""
+    names = []
+    built = {}
+
+    def fetch_worker():
+        return len(app.get_installed_packages_worker(True, session=session))
+
+    def fetch_inventory():
+        session.model = app.PackageModel()
+        session.package_filter = None
+        app.fetch_session_packages(session)
+        names[:] = session.model.all_names()
+        return len(names)
+
+    def filter_build():
+        built["engine"] = app.PackageFilter(names)
+        return len(names)
+
+    def filter_query():
+        # Typing sequence against an already built index, as the filter box does.
+        engine = built["engine"]
+        for query in FILTER_QUERIES:
+            engine.query(query)
+        return len(FILTER_QUERIES)
+
+    def listbox_rows():
+        # update_package_listbox without the widget: query, then order by source position.
+        engine = built["engine"]
+        position = {pkg: i for i, pkg in enumerate(names)}
+        for query in FILTER_QUERIES:
+            app.filter_rows(names, engine, query, position)
+        return len(FILTER_QUERIES)
+
+    def toggle_diff():
+        model = session.model
+        for name in names[::3]:
+            model.mark_uninstalled(name)
+        missing = model.missing_names()
+        for name in names[::3]:
+            model.mark_installed(name)
+        return len(missing)
+
+    def batch_round_trip():
+        targets = names[:args.batch_limit]
+        app.uninstall_packages(targets, batch=True, session=session)
+        app.install_existing_packages(targets, batch=True, session=session)
+        return 2 * len(targets)
+
+    def single_round_trip():
+        targets = names[:args.single_limit]
+        app.uninstall_packages(targets, batch=False, session=session)
+        app.install_existing_packages(targets, batch=False, session=session)
+        return 2 * len(targets)
+
+    yield "fetch_worker", fetch_worker, args.repeat
+    yield "fetch_inventory", fetch_inventory, args.repeat
+    yield "filter_build", filter_build, args.repeat
+    yield "filter_query", filter_query, args.repeat
+    yield "listbox_rows", listbox_rows, args.repeat
+    render = render_scenario(session, names)
+    if render:
+        yield "render_tk", render, args.repeat
+    yield "toggle_diff", toggle_diff, args.repeat
+    yield "batch_round_trip", batch_round_trip, 1
+    if args.single_limit:
+        yield "single_round_trip", single_round_trip, 1
+
+
+_tk_root = None
+
+def render_scenario(session, names):
+    """VirtualPackageList fill + redraw, or None when no display is available."""
+    global _tk_root
+    try:
+        app.import_tk()
+        if _tk_root is None:
+            _tk_root = app.tk.Tk()
+            _tk_root.withdraw()
+    except Exception:
+        return None
+
+    def render_tk():
+        frame = app.tk.Frame(_tk_root, width=600, height=700)
+        frame.pack()
+        view = app.VirtualPackageList(frame, model=session.model)
+        view.pack()
+        view.set_rows(names)
+        for pkg in names[::max(1, len(names) // 20)]:
+            view.scroll_to(pkg)
+            view.redraw()
+        _tk_root.update_idletasks()
+        frame.destroy()
+        return len(names)
+    return render_tk
+
+
+def run(args):
+    work = tempfile.mkdtemp(prefix="adb_bench_")
+    app.application_path = work
+    app.device_folder = work
+    app.logger = app.Logger()
+    results = {}
+    try:
+        for size in args.sizes:
+            proc, port = start_server(size, args.latency, args.failure_rate)
+            try:
+                if args.transport == "native":
+                    app.adb_executable = "adb"
+                    app.enable_native_adb(port)
+                else:
+                    app.native_adb = None
+                    app.adb_executable = fake_adb.write_launcher(os.path.join(work, "bin"), port)
+                app.latency = app.LatencyTracker()
+                app.metrics = app.CommandMetrics()
+                session = app.DeviceSession("FAKE0000", f"Bench{size}")
+                app.device_sessions = {session.serial: session}
+                for name, func, repeat in scenarios(session, args):
+                    wall, peak_kb, ops = measure(func, repeat)
+                    key = f"{size}/{name}"
+                    results[key] = {"wall_s": round(wall, 5), "peak_kb": round(peak_kb, 1),
+                                    "ops": ops, "ops_per_s": round(ops / wall, 1) if wall else None}
+                    print(f"{key:<28} {wall * 1000:>10.1f} ms {peak_kb:>10.0f} KiB {results[key]['ops_per_s'] or 0:>12.0f} ops/s",
+                          flush=True)
+            finally:
+                if app.native_adb:
+                    app.native_adb.close()
+                    app.native_adb = None
+                proc.kill()
+                proc.wait()
+    finally:
+        app.logger.close()
+    return results
+
+
+def compare(results, baseline):
+    lines = []
+    for key, now in results.items():
+        then = baseline.get(key)
+        if not then or not then.get("wall_s"):
+            lines.append(f"{key:<28} (no baseline)")
+            continue
+        change = now["wall_s"] / then["wall_s"] - 1
+        flag = "  REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        lines.append(f"{key:<28} {then['wall_s'] * 1000:>10.1f} -> {now['wall_s'] * 1000:>10.1f} ms ({change:+.0%}){flag}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ADB Manager code paths against a fake adb.")
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[100, 1000, 10000],
+                        help="Comma separated package counts (default 100,1000,10000).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every fake shell command.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of pm operations that fail.")
+    parser.add_argument("--transport", choices=("exec", "native"), default="exec",
+                        help="exec spawns a fake adb process per command; native uses the in-process client.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per local scenario; the best is kept.")
+    parser.add_argument("--batch-limit", type=int, default=1000, help="Packages per batched uninstall/install round trip.")
+    parser.add_argument("--single-limit", type=int, default=50, help="Packages for the one-process-per-package path (0 skips it).")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Write results to {BASELINE_FILE}.")
+    parser.add_argument("--compare", action="store_true", help=f"Compare results with {BASELINE_FILE}.")
+    args = parser.parse_args(argv)
+
+    meta = {"python": platform.python_version(), "platform": platform.platform(), "transport": args.transport,
+            "latency": args.latency, "failure_rate": args.failure_rate}
+    results = run(args)
+    report = [json.dumps(meta)] + [f"{key} {json.dumps(value)}" for key, value in results.items()]
+
+    if args.compare:
+        try:
+            with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"No usable baseline: {e}")
+        else:
+            diff = compare(results, baseline.get("results", {}))
+            print("\n".join(["", "Against baseline:"] + diff))
+            report += ["", "Against baseline:"] + diff
+            if any(line.endswith("REGRESSION") for line in diff):
+                with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+                    f.write("\n".join(report) + "\n")
+                return 1
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"Baseline saved to {BASELINE_FILE}.")
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        f.write("\n".join(report) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
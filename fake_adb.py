@@ -0,0 +1,572 @@
+"""
+Fake ADB server for exercising uninstall.py without a phone.
+
+FakeAdbServer speaks enough of the adb host protocol (host:version,
+host:devices[-l], host:track-devices, host:features, transports and
+shell:/shell,v2:) for AdbClient to run against it. Each attached FakeDevice
+emulates the handful of shell commands the manager sends.
+
+The "client" mode is a stand-in adb executable: like the real binary it
+forwards its argv to the server on ANDROID_ADB_SERVER_PORT, so code that
+spawns adb processes can be pointed at a fake server via write_launcher().
+
+    python fake_adb.py server --port 5037 --packages 300 --devices 2
+    python fake_adb.py client -s FAKE0000 shell pm list packages
+"""
+import argparse
+import hashlib
+import os
+import random
+import shlex
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+VENDORS = ["com.android", "com.google.android", "com.samsung.android", "com.qualcomm.qti",
+           "com.facebook", "com.miui", "com.oneplus", "org.codeaurora", "com.sec.android"]
+FEATURES = "shell_v2,cmd,stat_v2,ls_v2,fixed_push_mkdir,apex,abb,abb_exec"
+
+
+def apk_content(path):
+    """The bytes of a fake APK: the same path gives the same file on every device."""
+    return path.encode("utf-8") * (2000 + len(path) * 50)
+
+
+def make_packages(count, seed=0):
+    """Returns `count` unique, deterministic package names."""
+    rng = random.Random(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = f"{rng.choice(VENDORS)}.{''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 12)))}"
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+class FakeDevice:
+    def __init__(self, serial, model="Fake_Phone", packages=None, latency=0.0, failure_rate=0.0, seed=0, stalls=None):
+        self.serial = serial
+        self.model = model
+        self.state = "device"
+        self.packages = list(packages if packages is not None else make_packages(300, seed))
+        self.installed = set(self.packages)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.props = {
+            "ro.product.model": model,
+            "ro.build.fingerprint": f"fake/{model}/{model}:14/UP1A/1:user/release-keys",
+        }
+        self.disabled = set(self.packages[::25])
+        self.stalls = dict(stalls or {}) # {package: seconds} the next pm command on it hangs, once.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _is_system(package):
+        return not package.startswith("com.facebook")
+
+    def _apk_path(self, package):
+        leaf = package.rsplit(".", 1)[-1]
+        return f"/system/app/{leaf}/{leaf}.apk" if self._is_system(package) else f"/data/app/{package}-1/base.apk"
+
+    def _apk_files(self, package):
+        base = self._apk_path(package)
+        if self._is_system(package):
+            return [base]
+        return [base, base.replace("base.apk", "split_config.arm64_v8a.apk")]
+
+    def execute(self, command):
+        """
+        Runs a shell command line; returns (exit_code, stdout, stderr).
+        Understands "a; b", "a || b", "a | wc -l", "a | grep [-m N] text"
+        and "2>/dev/null", which covers every compound command the manager sends.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        code, out, err = 0, "", ""
+        for statement in command.split(";"):
+            code, o, e = 1, "", ""
+            for alternative in statement.split("||"):
+                code, o, e = self._pipeline(alternative.replace("2>/dev/null", ""))
+                if code == 0:
+                    break
+            out, err = out + o, err + e
+        return code, out, err
+
+    def _pipeline(self, command):
+        stages = command.split("|")
+        code, out, err = self._simple(stages[0])
+        for stage in stages[1:]:
+            args = stage.split()
+            if args == ["wc", "-l"]:
+                out = f"{len(out.splitlines())}\n"
+            elif args[:1] == ["grep"] and len(args) >= 2:
+                limit = int(args[1][2:] or args[2]) if args[1].startswith("-m") else None
+                text = args[-1]
+                lines = [line for line in out.splitlines(True) if text in line][:limit]
+                code, out = (0 if lines else 1), "".join(lines)
+            else:
+                return 127, "", f"/system/bin/sh: {stage.strip()}: not supported by fake\n"
+        return code, out, err
+
+    def _simple(self, command):
+        try:
+            argv = shlex.split(command)
+        except ValueError as e:
+            return 2, "", f"sh: {e}\n"
+        if not argv:
+            return 0, "", ""
+
+        if argv[0] == "echo":
+            return 0, " ".join(argv[1:]) + "\n", ""
+        if argv[0] == "getprop":
+            if len(argv) == 1:
+                return 0, "".join(f"[{k}]: [{v}]\n" for k, v in self.props.items()), ""
+            return 0, self.props.get(argv[1], "") + "\n", ""
+        if argv[:2] == ["dumpsys", "package"] and len(argv) == 3:
+            package = argv[2]
+            if package not in self.packages:
+                return 0, f"Unable to find package: {package}\n", ""
+            build = sum(map(ord, package)) % 90 + 10
+            return 0, (f"Packages:\n  Package [{package}] (1a2b3c):\n    codePath={self._apk_path(package).rsplit('/', 1)[0]}\n"
+                       f"    versionCode={build}0 minSdk=29 targetSdk=34\n    versionName=1.{build}.0\n"), ""
+        if argv[:2] == ["du", "-sk"] and len(argv) == 3:
+            return 0, f"{sum(map(ord, argv[2])) * 37 % 90000 + 100}\t{argv[2]}\n", ""
+        if argv[0] == "sha256sum":
+            return 0, "".join(f"{hashlib.sha256(apk_content(path)).hexdigest()}  {path}\n" for path in argv[1:]), ""
+        if argv[0] == "stat":
+            return 1, "", f"stat: '{argv[-1]}': Permission denied\n"
+        if argv[0] == "pm" or argv[:2] == ["cmd", "package"]:
+            return self._pm(argv[1:] if argv[0] == "pm" else argv[2:])
+        return 127, "", f"/system/bin/sh: {argv[0]}: inaccessible or not found\n"
+
+    def _pm(self, args):
+        if not args:
+            return 1, "", "Error: no command\n"
+        if args[:2] == ["list", "packages"]:
+            flags = set(args[2:])
+            with self.lock:
+                names = [p for p in self.packages if p in self.installed or flags & {"-a", "-u"}]
+            if "-s" in flags:
+                names = [p for p in names if self._is_system(p)]
+            if "-d" in flags:
+                names = [p for p in names if p in self.disabled]
+            lines = []
+            for uid, p in enumerate(names, 10000):
+                entry = f"package:{self._apk_path(p)}={p}" if "-f" in flags else f"package:{p}"
+                if "-i" in flags:
+                    entry += "  installer=" + ("null" if self._is_system(p) else "com.android.vending")
+                if "-U" in flags:
+                    entry += f" uid:{uid}"
+                lines.append(entry + "\n")
+            return 0, "".join(lines), ""
+
+        package = args[-1]
+        if args[0] == "path":
+            if package not in self.packages:
+                return 1, "", ""
+            return 0, "".join(f"package:{path}\n" for path in self._apk_files(package)), ""
+        with self.lock:
+            stall = self.stalls.pop(package, 0)
+        if stall:
+            time.sleep(stall)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            return 1, "Failure [DELETE_FAILED_INTERNAL_ERROR]\n", ""
+        with self.lock:
+            if args[0] == "uninstall":
+                if package not in self.installed:
+                    return 1, "Failure [not installed for 0]\n", ""
+                self.installed.discard(package)
+                return 0, "Success\n", ""
+            if args[0] == "install-existing":
+                if package not in self.packages:
+                    return 1, "", f"android.content.pm.PackageManager$NameNotFoundException: Package {package} doesn't exist\n"
+                self.installed.add(package)
+                return 0, f"Package {package} installed for user: 0\n", ""
+        return 1, "", f"Unknown command: {args[0]}\n"
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def _recv_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_request(self):
+        header = self._recv_exact(4)
+        if header is None:
+            return None
+        return self._recv_exact(int(header, 16)).decode("utf-8")
+
+    def _okay(self, payload=None):
+        data = b"OKAY"
+        if payload is not None:
+            data += self._block(payload)
+        self.request.sendall(data)
+
+    def _fail(self, message):
+        self.request.sendall(b"FAIL" + self._block(message))
+
+    @staticmethod
+    def _block(text):
+        data = text.encode("utf-8")
+        return b"%04x" % len(data) + data
+
+    def handle(self):
+        server = self.server.owner
+        transport = None
+        while True:
+            request = self._read_request()
+            if request is None:
+                return
+            if request == "host:version":
+                return self._okay("0029")
+            if request in ("host:devices", "host:devices-l"):
+                return self._okay(server.listing(long=request.endswith("-l")))
+            if request == "host:track-devices":
+                return self._track(server)
+            if request == "host:features" or (request.startswith("host-serial:") and request.endswith(":features")):
+                return self._okay(FEATURES if server.shell_v2 else "cmd")
+            if request.startswith("host:transport"):
+                transport, error = server.pick(request)
+                if error:
+                    return self._fail(error)
+                self._okay()
+                continue
+            if request.startswith("shell"):
+                if transport is None:
+                    return self._fail("no transport selected")
+                try:
+                    return self._shell(transport, request)
+                except OSError:
+                    return # The client hung up (killed command or unplugged device).
+            return self._fail(f"unknown host service '{request}'")
+
+    def _track(self, server):
+        self._okay()
+        generation = -1
+        while not server.stopping:
+            with server.changed:
+                if generation == server.generation:
+                    server.changed.wait(0.5)
+                if generation == server.generation:
+                    continue
+                generation = server.generation
+                listing = server.listing()
+            try:
+                self.request.sendall(self._block(listing))
+            except OSError:
+                return
+
+    def _send_output(self, v2, out, err, code=None):
+        if not v2:
+            if out or err:
+                self.request.sendall((out + err).encode("utf-8"))
+            return
+        packets = b""
+        if out:
+            packets += struct.pack("<BI", 1, len(out.encode("utf-8"))) + out.encode("utf-8")
+        if err:
+            packets += struct.pack("<BI", 2, len(err.encode("utf-8"))) + err.encode("utf-8")
+        if code is not None:
+            packets += struct.pack("<BI", 3, 1) + bytes([code & 0xFF])
+        if packets:
+            self.request.sendall(packets)
+
+    def _stdin_lines(self, v2):
+        """Yields script lines written to an interactive shell until stdin closes."""
+        buffer = b""
+        while True:
+            if v2:
+                header = self._recv_exact(5)
+                if header is None:
+                    break
+                packet_id, length = struct.unpack("<BI", header)
+                payload = self._recv_exact(length) if length else b""
+                if packet_id == 3 or payload is None:
+                    break
+                buffer += payload
+            else:
+                chunk = self.request.recv(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                yield line.decode("utf-8")
+        if buffer:
+            yield buffer.decode("utf-8")
+
+    def _shell(self, device, request):
+        service, _, command = request.partition(":")
+        v2 = service.startswith("shell,v2")
+        self._okay()
+        if command:
+            code, out, err = device.execute(command)
+            self._send_output(v2, out, err, code)
+            return
+
+        # Interactive shell: run stdin line by line, streaming each result.
+        # Like adbd, a client that hangs up (EOF after stdin was closed, v2
+        # only) ends the shell before its next command.
+        lines = self._stdin_lines(v2)
+        hung_up = threading.Event()
+        if v2:
+            script = list(lines)
+            lines = iter(script)
+            def watch():
+                try:
+                    while self.request.recv(65536):
+                        pass
+                except OSError:
+                    pass
+                hung_up.set()
+            threading.Thread(target=watch, daemon=True).start()
+        code = 0
+        for line in lines:
+            if line.strip() == "exit" or hung_up.is_set():
+                break
+            merge = "2>&1" in line
+            code, out, err = device.execute(line.replace("2>&1", "").replace("$?", str(code)))
+            self._send_output(v2, out + err if merge else out, "" if merge else err)
+        self._send_output(v2, "", "", code)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeAdbServer:
+    def __init__(self, devices=None, port=0, shell_v2=True):
+        self.devices = {d.serial: d for d in (devices or [])}
+        self.shell_v2 = shell_v2
+        self.changed = threading.Condition()
+        self.generation = 0
+        self.stopping = False
+        self.server = _TCPServer(("127.0.0.1", port), _Handler)
+        self.server.owner = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _bump(self):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def attach(self, device):
+        self.devices[device.serial] = device
+        self._bump()
+
+    def detach(self, serial):
+        self.devices.pop(serial, None)
+        self._bump()
+
+    def set_state(self, serial, state):
+        self.devices[serial].state = state
+        self._bump()
+
+    def listing(self, long=False):
+        lines = []
+        for d in self.devices.values():
+            if long and d.state == "device":
+                lines.append(f"{d.serial}       {d.state} product:{d.model} model:{d.model} device:{d.model} transport_id:1")
+            else:
+                lines.append(f"{d.serial}\t{d.state}")
+        return "".join(line + "\n" for line in lines)
+
+    def pick(self, request):
+        if request == "host:transport-any":
+            ready = [d for d in self.devices.values() if d.state == "device"]
+            if not ready:
+                return None, "no devices/emulators found"
+            if len(ready) > 1:
+                return None, "more than one device/emulator"
+            return ready[0], None
+        serial = request[len("host:transport:"):]
+        device = self.devices.get(serial)
+        if device is None:
+            return None, f"device '{serial}' not found"
+        if device.state != "device":
+            return None, f"device {device.state}"
+        return device, None
+
+
+def _request(sock, service):
+    data = service.encode("utf-8")
+    sock.sendall(b"%04x" % len(data) + data)
+    status = _recv_exact(sock, 4)
+    if status != b"OKAY":
+        length = _recv_exact(sock, 4)
+        message = _recv_exact(sock, int(length, 16)).decode("utf-8", "replace") if length else ""
+        raise RuntimeError(message or "protocol fault")
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def run_client(argv, port=None):
+    """
+    Minimal adb command line: --version, devices [-l], track-devices,
+    start-server, kill-server, [-s serial] shell [command], pull (writes
+    apk_content of the remote path) and install[-multiple] (checks the
+    files exist). A shell without a command forwards stdin. Returns the
+    process exit code.
+    """
+    port = port or int(os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+    args = list(argv)
+    serial = None
+    if args[:1] == ["-s"] and len(args) > 1:
+        serial, args = args[1], args[2:]
+    if not args:
+        sys.stderr.write("adb: no command\n")
+        return 1
+    if args[0] in ("start-server", "kill-server"):
+        return 0
+
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+    except OSError as e:
+        sys.stderr.write(f"adb: cannot connect to daemon at tcp:{port}: {e}\n")
+        return 1
+    with sock:
+        try:
+            if args[0] == "--version" or args[0] == "version":
+                _request(sock, "host:version")
+                length = _recv_exact(sock, 4)
+                version = int(_recv_exact(sock, int(length, 16)), 16)
+                sys.stdout.write(f"Android Debug Bridge version 1.0.{version}\nVersion fake\n")
+                return 0
+            if args[0] == "devices":
+                _request(sock, "host:devices-l" if "-l" in args[1:] else "host:devices")
+                length = _recv_exact(sock, 4)
+                sys.stdout.write("List of devices attached\n" + _recv_exact(sock, int(length, 16)).decode("utf-8") + "\n")
+                return 0
+            if args[0] == "track-devices":
+                # Like adb, passes the length-prefixed listings through until the server goes away.
+                _request(sock, "host:track-devices")
+                while True:
+                    data = sock.recv(4096)
+                    if not data:
+                        return 1
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.buffer.flush()
+            if args[0] not in ("shell", "pull", "install", "install-multiple"):
+                sys.stderr.write(f"adb: unknown command {args[0]}\n")
+                return 1
+            _request(sock, f"host:transport:{serial}" if serial else "host:transport-any")
+            if args[0] == "pull":
+                with open(args[2], "wb") as f:
+                    f.write(apk_content(args[1]))
+                sys.stdout.write(f"{args[1]}: 1 file pulled.\n")
+                return 0
+            if args[0] != "shell":
+                files = [arg for arg in args[1:] if arg.endswith(".apk")]
+                if not files or not all(os.path.exists(path) for path in files):
+                    sys.stderr.write("adb: failed to stat apk\n")
+                    return 1
+                sys.stdout.write("Success\n")
+                return 0
+            command = " ".join(args[1:])
+            _request(sock, f"shell,v2,raw:{command}")
+        except RuntimeError as e:
+            sys.stderr.write(f"adb: error: {e}\n")
+            return 1
+
+        if not command:
+            script = sys.stdin.buffer.read()
+            sock.sendall(struct.pack("<BI", 0, len(script)) + script + struct.pack("<BI", 3, 0))
+        code = 0
+        while True:
+            header = _recv_exact(sock, 5)
+            if header is None:
+                break
+            packet_id, length = struct.unpack("<BI", header)
+            payload = _recv_exact(sock, length) if length else b""
+            if packet_id == 1:
+                sys.stdout.buffer.write(payload)
+                sys.stdout.buffer.flush()
+            elif packet_id == 2:
+                sys.stderr.buffer.write(payload)
+            elif packet_id == 3:
+                code = payload[0] if payload else 0
+                break
+        return code
+
+
+def write_launcher(directory, port, python=None):
+    """Writes an executable 'adb' that runs client mode against port; returns its path."""
+    python = python or sys.executable
+    script = os.path.abspath(__file__)
+    os.makedirs(directory, exist_ok=True)
+    if os.name == "nt":
+        path = os.path.join(directory, "adb.cmd")
+        with open(path, "w") as f:
+            f.write(f'@set ANDROID_ADB_SERVER_PORT={port}\r\n@"{python}" "{script}" client %*\r\n')
+    else:
+        path = os.path.join(directory, "adb")
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nANDROID_ADB_SERVER_PORT={port} exec "{python}" "{script}" client "$@"\n')
+        os.chmod(path, 0o755)
+    return path
+
+
+def main():
+    if sys.argv[1:2] == ["client"]:
+        sys.exit(run_client(sys.argv[2:]))
+    parser = argparse.ArgumentParser(description="Fake adb server / client for hardware-free runs.")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    sub.add_parser("client", help="Act as the adb executable: fake_adb.py client [-s SERIAL] shell ...")
+    srv = sub.add_parser("server", help="Serve the adb host protocol on a local port.")
+    srv.add_argument("--port", type=int, default=5037)
+    srv.add_argument("--packages", type=int, default=300)
+    srv.add_argument("--devices", type=int, default=1)
+    srv.add_argument("--latency", type=float, default=0.0, help="Seconds added to every shell command.")
+    srv.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    devices = [FakeDevice(f"FAKE{i:04d}", packages=make_packages(args.packages), latency=args.latency,
+                          failure_rate=args.failure_rate, seed=i) for i in range(args.devices)]
+    server = FakeAdbServer(devices, port=args.port).start()
+    print(f"Fake adb server on 127.0.0.1:{server.port} with {len(devices)} device(s). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
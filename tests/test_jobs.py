@@ -0,0 +1,61 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_adb
+import uninstall
+
+
+class JobRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.packages = fake_adb.make_packages(6)
+        # The fourth package's first uninstall hangs past the per-package timeout.
+        self.device = fake_adb.FakeDevice("FAKE0", packages=self.packages, stalls={self.packages[3]: 3})
+        self.server = fake_adb.FakeAdbServer([self.device]).start()
+        self.root = tempfile.mkdtemp()
+        self.saved = (uninstall.adb_executable, uninstall.application_path, uninstall.logger,
+                      uninstall.BATCH_PACKAGE_TIMEOUT, uninstall.JOB_RETRY_DELAYS)
+        uninstall.adb_executable = fake_adb.write_launcher(self.root, self.server.port)
+        uninstall.application_path = self.root
+        uninstall.logger = uninstall.Logger(stream=open(os.devnull, "w"))
+        uninstall.BATCH_PACKAGE_TIMEOUT = 1
+        uninstall.JOB_RETRY_DELAYS = (0,)
+        self.session = uninstall.DeviceSession("FAKE0", "Fake_Phone")
+        self.session.folder = os.path.join(self.root, "FAKE0")
+        uninstall.device_sessions["FAKE0"] = self.session
+
+    def tearDown(self):
+        uninstall.device_sessions.pop("FAKE0", None)
+        uninstall.logger.stream.close()
+        (uninstall.adb_executable, uninstall.application_path, uninstall.logger,
+         uninstall.BATCH_PACKAGE_TIMEOUT, uninstall.JOB_RETRY_DELAYS) = self.saved
+        self.server.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_retry_keeps_first_attempt_in_task_log(self):
+        job = uninstall.Job(self.session, "uninstall", self.packages, batch=False)
+        job.run()
+
+        self.assertEqual(job.state, "Done")
+        self.assertEqual(job.attempt, 1)
+        self.assertTrue(all(r["success"] for r in job.results.values()))
+        with open(os.path.join(self.session.folder, "uninstall_log.txt")) as f:
+            log = f.read()
+        for package in self.packages:
+            self.assertIn(f"SUCCESS: {package}\n", log)
+        self.assertIn("Retry 1:", log)
+
+    def test_retried_job_is_one_journal_run(self):
+        job = uninstall.Job(self.session, "uninstall", self.packages, batch=False)
+        job.run()
+
+        runs = {entry["run"] for entry in uninstall.OperationJournal(self.session).entries()}
+        self.assertEqual(runs, {job.journal.id})
+
+
+if __name__ == "__main__":
+    unittest.main()
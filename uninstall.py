@@ -1,16 +1,27 @@
 import subprocess
 import os
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from tkinter import ttk
 from datetime import datetime
-from tkinter import scrolledtext
 import threading
 import sys
 import shutil
 import re
 import concurrent.futures
 import time
+import queue
+import fnmatch
+import collections
+import socket
+import struct
+import json
+import sqlite3
+import hashlib
+import zlib
+import array
+import itertools
+import heapq
+import shlex
+import traceback
+from contextlib import closing
 
 # --- FIX: Prevent "No Console" Crashes ---
 class NullWriter:
@@ -22,12 +33,26 @@ if sys.stderr is None: sys.stderr = NullWriter()
 
 CREATE_NO_WINDOW = 0x08000000 if sys.platform == 'win32' else 0
 
+# --- LAZY TKINTER ---
+# tkinter is only imported by create_gui(), so the headless CLI starts
+# without loading Tk at all.
+tk = ttk = filedialog = messagebox = scrolledtext = None
+
+def import_tk():
+    global tk, ttk, filedialog, messagebox, scrolledtext
+    import tkinter
+    from tkinter import ttk as _ttk, filedialog as _filedialog, messagebox as _messagebox, scrolledtext as _scrolledtext
+    tk, ttk, filedialog, messagebox = tkinter, _ttk, _filedialog, _messagebox
+    scrolledtext = _scrolledtext
+
+def show_error(title, message):
+    """Pops an error dialog when the GUI is running; the CLI only logs."""
+    if messagebox:
+        messagebox.showerror(title, message)
+
 # Global variables
 is_diff_view_active = False
 diff_list = []
-existing_packages = [] 
-all_packages_cache = [] 
-installed_packages_cache = [] 
 
 # --- PATH FIX: Determine correct base path for logs ---
 # If frozen (exe), use the folder of the exe. If script, use __file__.
@@ -41,17 +66,288 @@ current_device_name = "Unknown_Device"
 # Logs will now be created next to the .exe instead of inside the temporary temp folder
 device_folder = os.path.join(application_path, "Unknown_Device") 
 adb_executable = None 
+native_adb = None
+
+# --- ADAPTIVE TIMEOUTS ---
+# Device commands keep a short latency history per (serial, command kind).
+# Once enough samples exist the timeout follows the observed p95 instead of
+# the fixed value given at the call site, which stays the upper bound for
+# unknown devices. Consecutive timeouts mark a device as suspect; a failed
+# 'echo' health probe then lets batches stop instead of waiting out every
+# remaining package.
+LATENCY_HISTORY = 64
+LATENCY_MIN_SAMPLES = 5
+LATENCY_PERCENTILE = 0.95
+LATENCY_MARGIN = 3.0
+ADAPTIVE_MIN_TIMEOUT = 3.0
+HUNG_AFTER_TIMEOUTS = 2
+HEALTH_PROBE_TIMEOUT = 3
+DEVICE_HUNG_DETAIL = "Device not responding; batch stopped"
+DEVICE_GONE_DETAIL = "Device disconnected; batch stopped"
+JOB_CANCELLED_DETAIL = "Cancelled"
+
+class LatencyTracker:
+    def __init__(self):
+        self.samples = {}
+        self.timeouts = {}
+        self.lock = threading.Lock()
+
+    def record(self, serial, kind, seconds):
+        with self.lock:
+            self.samples.setdefault((serial, kind), collections.deque(maxlen=LATENCY_HISTORY)).append(seconds)
+            self.timeouts[serial] = 0
+
+    def record_timeout(self, serial, kind, seconds):
+        # The timeout itself counts as a sample, so a slow device widens its
+        # own window instead of timing out again at the same limit.
+        with self.lock:
+            self.samples.setdefault((serial, kind), collections.deque(maxlen=LATENCY_HISTORY)).append(seconds)
+            self.timeouts[serial] = self.timeouts.get(serial, 0) + 1
+
+    def percentile(self, serial, kind, fraction=LATENCY_PERCENTILE):
+        with self.lock:
+            history = sorted(self.samples.get((serial, kind), ()))
+        if len(history) < LATENCY_MIN_SAMPLES:
+            return None
+        return history[min(len(history) - 1, int(fraction * len(history)))]
+
+    def timeout_for(self, serial, kind, default):
+        """Adaptive timeout: p95 * margin, within [ADAPTIVE_MIN_TIMEOUT, 2 * default]."""
+        p = self.percentile(serial, kind)
+        if p is None:
+            return default
+        return round(min(max(p * LATENCY_MARGIN + 1, ADAPTIVE_MIN_TIMEOUT), default * 2), 2)
+
+    def is_suspect(self, serial):
+        with self.lock:
+            return self.timeouts.get(serial, 0) >= HUNG_AFTER_TIMEOUTS
+
+    def forget(self, serial):
+        with self.lock:
+            self.timeouts.pop(serial, None)
+            for key in [key for key in self.samples if key[0] == serial]:
+                del self.samples[key]
+
+latency = LatencyTracker()
+
+def command_key(cmd, kind=None):
+    """
+    Returns (serial, kind) for an adb argv. kind is None, whatever was
+    passed, for everything but 'shell': host-side commands ('devices',
+    '--version') and transfers ('pull', 'install-multiple'), whose time
+    follows the APK size, are never adapted.
+    """
+    args = list(cmd[1:])
+    serial = None
+    if args[:1] == ["-s"] and len(args) > 1:
+        serial, args = args[1], args[2:]
+    if not args or args[0] != "shell":
+        return serial, None
+    if kind is None:
+        words = " ".join(args[1:]).split()
+        kind = " ".join(words[:2]) if words[:1] in (["pm"], ["cmd"]) else " ".join(words[:1]) or "shell"
+    return serial, kind
+
+def device_responds(serial):
+    """Health probe: True when 'adb shell echo' comes back within a few seconds."""
+    try:
+        code, out, err = _run_process(adb_command(serial, "shell", "echo", "asm_ok"), HEALTH_PROBE_TIMEOUT)
+    except Exception:
+        return False
+    return code == 0 and "asm_ok" in out
+
+# --- COMMAND METRICS ---
+# Counters and latency histograms per (serial, subcommand): how many runs,
+# time to spawn the adb process, execution time, exit codes and timeouts.
+# They feed the ADB Stats panel and are exported to each device folder as
+# adb_metrics.json and adb_metrics.prom (Prometheus text format).
+METRICS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_JSON_FILE = "adb_metrics.json"
+METRICS_PROM_FILE = "adb_metrics.prom"
+
+class CommandStats:
+    __slots__ = ("count", "timeouts", "spawn_sum", "exec_sum", "buckets", "exit_codes")
+
+    def __init__(self):
+        self.count = 0
+        self.timeouts = 0
+        self.spawn_sum = 0.0
+        self.exec_sum = 0.0
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1) # Last slot is +Inf.
+        self.exit_codes = collections.Counter()
+
+    def observe(self, spawn, seconds, code):
+        self.count += 1
+        self.spawn_sum += spawn
+        self.exec_sum += seconds
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        self.exit_codes["timeout" if code is None else str(code)] += 1
+
+    def quantile(self, fraction):
+        """Histogram estimate, interpolated inside the bucket like Prometheus does."""
+        if not self.count:
+            return None
+        rank, seen, lower = fraction * self.count, 0, 0.0
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seen + self.buckets[i] >= rank:
+                return lower + (bound - lower) * (rank - seen) / max(1, self.buckets[i])
+            seen += self.buckets[i]
+            lower = bound
+        return METRICS_BUCKETS[-1]
+
+    def errors(self):
+        return sum(n for code, n in self.exit_codes.items() if code not in ("0", "timeout"))
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "timeouts": self.timeouts,
+            "spawn_seconds_sum": round(self.spawn_sum, 4),
+            "exec_seconds_sum": round(self.exec_sum, 4),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": dict(zip([str(b) for b in METRICS_BUCKETS] + ["+Inf"], self.buckets)),
+            "exit_codes": dict(self.exit_codes),
+        }
+
+class CommandMetrics:
+    def __init__(self):
+        self.stats = {}
+        self.meta = {}
+        self.version = 0 # Bumped on every change so the panel can skip idle redraws.
+        self.lock = threading.Lock()
+
+    def _get(self, serial, kind):
+        key = (serial or "", kind)
+        if key not in self.stats:
+            self.stats[key] = CommandStats()
+        return self.stats[key]
+
+    def observe(self, serial, kind, seconds, code, spawn=0.0):
+        with self.lock:
+            self._get(serial, kind).observe(spawn, seconds, code)
+            self.version += 1
+
+    def observe_timeout(self, serial, kind, seconds, spawn=0.0):
+        with self.lock:
+            stats = self._get(serial, kind)
+            stats.observe(spawn, seconds, None)
+            stats.timeouts += 1
+            self.version += 1
+
+    def rows(self, serial=None):
+        """[(serial, kind, CommandStats)] sorted by total execution time, busiest first."""
+        with self.lock:
+            items = [(s, k, v) for (s, k), v in self.stats.items() if serial is None or s == serial]
+        return sorted(items, key=lambda item: item[2].exec_sum, reverse=True)
+
+    def to_json(self, serial=None):
+        devices = {}
+        for s, kind, stats in self.rows(serial):
+            devices.setdefault(s or "host", {})[kind] = stats.to_dict()
+        return {"generated_at": datetime.now().isoformat(timespec="seconds"), **self.meta, "devices": devices}
+
+    def to_prometheus(self, serial=None):
+        lines = [
+            "# HELP adb_command_seconds Execution time of adb commands.",
+            "# TYPE adb_command_seconds histogram",
+        ]
+        rows = self.rows(serial)
+        extra = "".join(f',{k}="{v}"' for k, v in sorted(self.meta.items()))
+        for s, kind, stats in rows:
+            labels = f'serial="{s}",command="{kind}"{extra}'
+            cumulative = 0
+            for bound, n in zip([str(b) for b in METRICS_BUCKETS] + ["+Inf"], stats.buckets):
+                cumulative += n
+                lines.append(f'adb_command_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"adb_command_seconds_sum{{{labels}}} {stats.exec_sum:.6f}")
+            lines.append(f"adb_command_seconds_count{{{labels}}} {stats.count}")
+        for name, kind_help, value_of in (
+            ("adb_command_spawn_seconds_sum", "Time spent starting adb processes.", lambda st: f"{st.spawn_sum:.6f}"),
+            ("adb_command_timeouts_total", "Commands killed by their timeout.", lambda st: st.timeouts),
+        ):
+            lines += [f"# HELP {name} {kind_help}", f"# TYPE {name} counter"]
+            for s, kind, stats in rows:
+                lines.append(f'{name}{{serial="{s}",command="{kind}"{extra}}} {value_of(stats)}')
+        lines += ["# HELP adb_command_exit_total Commands by exit code.", "# TYPE adb_command_exit_total counter"]
+        for s, kind, stats in rows:
+            for code, n in sorted(stats.exit_codes.items()):
+                lines.append(f'adb_command_exit_total{{serial="{s}",command="{kind}",code="{code}"{extra}}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, folder, serial=None):
+        """Writes the JSON and Prometheus reports for one device (or all) into folder."""
+        try:
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, METRICS_JSON_FILE), "w", encoding="utf-8") as f:
+                json.dump(self.to_json(serial), f, indent=2)
+            with open(os.path.join(folder, METRICS_PROM_FILE), "w", encoding="utf-8") as f:
+                f.write(self.to_prometheus(serial))
+        except Exception: pass
+
+metrics = CommandMetrics()
+
+def export_session_metrics(session):
+    if session:
+        metrics.export(session.folder, session.serial)
+
+def subcommand_of(cmd):
+    """The adb subcommand of an argv ('devices', 'shell', ...), ignoring '-s serial'."""
+    args = list(cmd[1:])
+    if args[:1] == ["-s"]:
+        args = args[2:]
+    return args[0] if args else "adb"
 
 # --- ROBUST PROCESS RUNNER ---
-def run_with_timeout(cmd, timeout_sec):
+def run_with_timeout(cmd, timeout_sec, kind=None):
     """
     Runs a command with a GUARANTEED timeout kill switch.
+    Device shell commands use the adaptive timeout for their kind (see
+    LatencyTracker); timeout_sec is the default until history exists.
+    """
+    serial, kind = command_key(cmd, kind)
+    if kind:
+        timeout_sec = latency.timeout_for(serial, kind, timeout_sec)
+    label = kind or subcommand_of(cmd)
+    timing = {"spawn": 0.0}
+    started = time.perf_counter()
+    try:
+        result = _run_process(cmd, timeout_sec, timing)
+    except subprocess.TimeoutExpired:
+        if kind:
+            latency.record_timeout(serial, kind, timeout_sec)
+        metrics.observe_timeout(serial, label, timeout_sec, timing["spawn"])
+        raise
+    elapsed = time.perf_counter() - started
+    if kind:
+        latency.record(serial, kind, elapsed)
+    metrics.observe(serial, label, elapsed - timing["spawn"], result[0], timing["spawn"])
+    return result
+
+def _run_process(cmd, timeout_sec, timing=None):
+    """
+    adb commands are served in-process by native_adb when it is enabled.
+    timing["spawn"] receives the seconds spent starting the process.
     """
+    if native_adb is not None:
+        try:
+            result = native_adb.run(cmd, timeout_sec)
+            if result is not None:
+                return result
+        except ConnectionRefusedError:
+            pass # No server yet; the adb binary below will start one.
+
     try:
         # If we are forced to use the system "adb" command (not a path), 
         # we generally need shell=True on Windows to resolve it correctly.
         use_shell = (cmd[0] == "adb")
         
+        spawn_started = time.perf_counter()
         proc = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
@@ -61,6 +357,8 @@ def run_with_timeout(cmd, timeout_sec):
             creationflags=CREATE_NO_WINDOW,
             shell=use_shell
         )
+        if timing is not None:
+            timing["spawn"] = time.perf_counter() - spawn_started
         try:
             stdout, stderr = proc.communicate(timeout=timeout_sec)
             return proc.returncode, stdout, stderr
@@ -71,6 +369,539 @@ def run_with_timeout(cmd, timeout_sec):
     except Exception as e:
         raise e
 
+# --- STREAMING RUNNER ---
+# CommandStream hands out output lines while the command is still running,
+# so large outputs (inventory, dumpsys, logcat) never sit in memory whole.
+# The reader thread passes whatever one read returned, split into lines,
+# through a bounded queue that pushes back on the pipe; over-long lines are
+# split, and the same hard timeout and kill as run_with_timeout apply.
+STREAM_READ_SIZE = 64 * 1024
+STREAM_QUEUE_CHUNKS = 64 # At most ~4 MB buffered between reader and consumer.
+STREAM_MAX_LINE = 64 * 1024
+STREAM_STDERR_LINES = 50
+STREAM_CONNECT_TIMEOUT = 15
+
+live_streams = {} # serial -> set of running CommandStreams, so a detached device's commands can be killed.
+live_streams_lock = threading.Lock()
+
+def close_streams(serial):
+    """Kills every running command addressed to serial; returns how many."""
+    with live_streams_lock:
+        streams = list(live_streams.get(serial, ()))
+    for stream in streams:
+        stream.close()
+    return len(streams)
+
+class CommandStream:
+    """
+    for line in CommandStream(cmd, timeout_sec): ...
+
+    timeout_sec bounds the whole command and idle_timeout (which may be
+    changed while iterating) the silence between lines; either one kills the
+    command and raises subprocess.TimeoutExpired. exit_code and stderr_tail
+    are set once the output is exhausted. Leaving the loop early, or close(),
+    kills the command. With native_adb, shell output arrives merged.
+    raw=True yields decoded output as read, without splitting into lines.
+    """
+    def __init__(self, cmd, timeout_sec=None, idle_timeout=None, stdin_data=None,
+                 merge_stderr=False, kind=None, track_latency=True, raw=False):
+        self.cmd = cmd
+        self.raw = raw
+        self.serial, self.kind = command_key(cmd, kind)
+        self.label = self.kind or subcommand_of(cmd)
+        self.track_latency = track_latency and self.kind is not None
+        if self.track_latency and timeout_sec:
+            timeout_sec = latency.timeout_for(self.serial, self.kind, timeout_sec)
+        self.timeout_sec = timeout_sec
+        self.idle_timeout = idle_timeout
+        self.exit_code = None
+        self.stderr_tail = collections.deque(maxlen=STREAM_STDERR_LINES)
+        self.chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.proc = None
+        self.stream = None
+        self.threads = []
+        self.started = time.perf_counter()
+        self.spawn = 0.0
+        with live_streams_lock:
+            live_streams.setdefault(self.serial, set()).add(self)
+        self._start(stdin_data, merge_stderr)
+
+    def _unregister(self):
+        with live_streams_lock:
+            streams = live_streams.get(self.serial)
+            if streams:
+                streams.discard(self)
+                if not streams:
+                    del live_streams[self.serial]
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _start(self, stdin_data, merge_stderr):
+        args = list(self.cmd[1:])
+        if args[:1] == ["-s"]:
+            args = args[2:]
+        if native_adb is not None and args[:1] == ["shell"]:
+            try:
+                self.stream = native_adb.open_shell(self.serial, " ".join(args[1:]), stdin_data,
+                                                    timeout=self.timeout_sec or self.idle_timeout or STREAM_CONNECT_TIMEOUT)
+            except AdbProtocolError as e:
+                self.stderr_tail.append(f"error: {e}")
+                self.exit_code = 1
+                self._put(None)
+                return
+            except ConnectionRefusedError:
+                pass # No server yet; the adb binary below will start one.
+            else:
+                self.spawn = time.perf_counter() - self.started
+                self._thread(self._pump, self.stream.chunks())
+                return
+
+        self.proc = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+            stdin=subprocess.PIPE if stdin_data else subprocess.DEVNULL,
+            creationflags=CREATE_NO_WINDOW,
+            shell=(self.cmd[0] == "adb")
+        )
+        self.spawn = time.perf_counter() - self.started
+        if stdin_data:
+            # Fed from its own thread: a large script must not block on a full stdout pipe.
+            self._thread(self._feed, stdin_data)
+        if not merge_stderr:
+            self._thread(self._drain_stderr)
+        self._thread(self._pump, iter(lambda: self.proc.stdout.read1(STREAM_READ_SIZE), b""))
+
+    @staticmethod
+    def _pipe_lines(pipe):
+        while True:
+            raw = pipe.readline(STREAM_MAX_LINE)
+            if not raw:
+                return
+            yield raw.decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def _feed(self, data):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+    def _drain_stderr(self):
+        for line in self._pipe_lines(self.proc.stderr):
+            self.stderr_tail.append(line)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _pump(self, source):
+        """Splits raw reads into lines and queues them one read at a time."""
+        buffer = b""
+        try:
+            for data in source:
+                if self.raw:
+                    if not self._put([data.decode("utf-8", errors="replace")]):
+                        return
+                    continue
+                buffer += data
+                *complete, buffer = buffer.split(b"\n")
+                while len(buffer) > STREAM_MAX_LINE: # No newline in sight; hand it out in pieces.
+                    complete.append(buffer[:STREAM_MAX_LINE])
+                    buffer = buffer[STREAM_MAX_LINE:]
+                if complete and not self._put([raw.decode("utf-8", errors="replace").rstrip("\r") for raw in complete]):
+                    return
+            if buffer:
+                self._put([buffer.decode("utf-8", errors="replace").rstrip("\r")])
+        except (OSError, ValueError):
+            pass # Pipe or socket closed underneath us by close().
+        finally:
+            self._put(None)
+
+    def _wait(self):
+        waits = []
+        if self.idle_timeout is not None:
+            waits.append(self.idle_timeout)
+        if self.timeout_sec:
+            waits.append(self.started + self.timeout_sec - time.perf_counter())
+        return max(0, min(waits)) if waits else None
+
+    def _expire(self, waited):
+        self.close()
+        metrics.observe_timeout(self.serial, self.label, time.perf_counter() - self.started - self.spawn, self.spawn)
+        if self.track_latency:
+            latency.record_timeout(self.serial, self.kind, self.timeout_sec or waited)
+        raise subprocess.TimeoutExpired(self.cmd, waited)
+
+    def _complete(self):
+        if self.proc is not None:
+            try:
+                self.exit_code = self.proc.wait(timeout=max(1, self._wait() or 0))
+            except subprocess.TimeoutExpired:
+                self._expire(self.timeout_sec) # Output closed but the process hangs on.
+            for thread in self.threads:
+                thread.join(1)
+        elif self.stream is not None:
+            code = self.stream.exit_code
+            self.exit_code = code if code is not None else (1 if self.stream.v2 else 0)
+        self.finished = True
+        self._unregister()
+        elapsed = time.perf_counter() - self.started
+        metrics.observe(self.serial, self.label, elapsed - self.spawn, self.exit_code, self.spawn)
+        if self.track_latency:
+            latency.record(self.serial, self.kind, elapsed)
+
+    def __iter__(self):
+        completed = False
+        try:
+            while True:
+                wait = self._wait()
+                try:
+                    batch = self.chunks.get(timeout=wait)
+                except queue.Empty:
+                    self._expire(wait)
+                if batch is None:
+                    completed = not self.stopped.is_set() # Otherwise close() came from another thread.
+                    break
+                yield from batch
+        finally:
+            if not completed:
+                self.close()
+        if completed:
+            self._complete()
+
+    def close(self):
+        """Stops the command; safe to call from any thread and more than once."""
+        self.stopped.set()
+        self.finished = True
+        self._unregister()
+        try: # Wake a reader blocked on the queue; whatever is still in it is discarded.
+            while True:
+                self.chunks.get_nowait()
+        except queue.Empty:
+            pass
+        try: self.chunks.put_nowait(None)
+        except queue.Full: pass
+        if self.stream is not None:
+            self.stream.close()
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                self.proc.kill()
+                self.proc.wait()
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- NATIVE ADB CLIENT ---
+# Speaks the adb host protocol to the adb server on localhost:5037 directly,
+# so routine commands skip spawning an adb client process. Every socket
+# serves exactly one service, so the pool keeps a few pre-connected spares
+# ready instead of reusing sockets.
+ADB_SERVER_PORT = 5037
+ADB_POOL_SPARES = 2
+SHELL_V2_STDIN, SHELL_V2_STDOUT, SHELL_V2_STDERR, SHELL_V2_EXIT = 0, 1, 2, 3
+SHELL_V2_CLOSE_STDIN = 3
+
+class AdbProtocolError(Exception):
+    pass
+
+class AdbClient:
+    def __init__(self, host="127.0.0.1", port=ADB_SERVER_PORT, spares=ADB_POOL_SPARES):
+        self.host = host
+        self.port = port
+        self.spares = spares
+        self._idle = []
+        self._lock = threading.Lock()
+        self._features = {}
+
+    # Connection pool
+    def _connect(self, timeout, fresh=False):
+        sock = None
+        if not fresh:
+            with self._lock:
+                if self._idle:
+                    sock = self._idle.pop()
+        if sock is None:
+            sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        sock.settimeout(timeout)
+        return sock
+
+    def _release(self, sock):
+        try: sock.close()
+        except OSError: pass
+        with self._lock:
+            if len(self._idle) >= self.spares:
+                return
+        try:
+            spare = socket.create_connection((self.host, self.port), timeout=1)
+        except OSError:
+            return
+        with self._lock:
+            self._idle.append(spare)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            try: sock.close()
+            except OSError: pass
+
+    # Wire format
+    @staticmethod
+    def _send(sock, request):
+        data = request.encode("utf-8")
+        sock.sendall(b"%04x" % len(data) + data)
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        chunks = []
+        while size:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise ConnectionError("adb server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _recv_block(self, sock):
+        length = int(self._recv_exact(sock, 4), 16)
+        return self._recv_exact(sock, length).decode("utf-8", errors="replace")
+
+    def _check_status(self, sock):
+        status = self._recv_exact(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise AdbProtocolError(self._recv_block(sock))
+        raise AdbProtocolError(f"Unexpected adb status {status!r}")
+
+    def _open(self, service, timeout, serial=None, transport=False):
+        """Returns a socket on which `service` was accepted."""
+        for attempt in (0, 1):
+            sock = self._connect(timeout, fresh=attempt > 0)
+            try:
+                if transport:
+                    self._send(sock, f"host:transport:{serial}" if serial else "host:transport-any")
+                    self._check_status(sock)
+                self._send(sock, service)
+                self._check_status(sock)
+                return sock
+            except AdbProtocolError:
+                sock.close()
+                raise
+            except (ConnectionError, socket.timeout):
+                # A pooled spare may predate an adb server restart; retry once fresh.
+                sock.close()
+                if attempt:
+                    raise
+
+    def _query(self, service, timeout):
+        sock = self._open(service, timeout)
+        try:
+            return self._recv_block(sock)
+        finally:
+            self._release(sock)
+
+    # Host services
+    def version(self, timeout=5):
+        return int(self._query("host:version", timeout), 16)
+
+    def devices(self, long=False, timeout=15):
+        return self._query("host:devices-l" if long else "host:devices", timeout)
+
+    def track_devices(self, timeout=None):
+        """
+        Yields the full device list text every time it changes, and None
+        whenever timeout passes without a change (so callers can check in).
+        """
+        sock = self._open("host:track-devices", 5)
+        sock.settimeout(timeout)
+        try:
+            while True:
+                try:
+                    header = sock.recv(4, socket.MSG_PEEK)
+                except socket.timeout:
+                    yield None
+                    continue
+                if not header:
+                    return
+                yield self._recv_block(sock)
+        finally:
+            sock.close()
+
+    # Device services
+    def features(self, serial, timeout=5):
+        features = self._features.get(serial)
+        if features is None:
+            service = f"host-serial:{serial}:features" if serial else "host:features"
+            features = self._features[serial] = set(self._query(service, timeout).split(","))
+        return features
+
+    def shell(self, serial, command, timeout):
+        deadline = time.monotonic() + timeout
+        def remaining():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise subprocess.TimeoutExpired(command, timeout)
+            return left
+
+        use_v2 = "shell_v2" in self.features(serial, timeout)
+        sock = self._open(f"shell,v2,raw:{command}" if use_v2 else f"shell:{command}", remaining(), serial, transport=True)
+
+        try:
+            if use_v2:
+                out, err, code = bytearray(), bytearray(), None
+                while code is None:
+                    sock.settimeout(remaining())
+                    packet_id, length = struct.unpack("<BI", self._recv_exact(sock, 5))
+                    payload = self._recv_exact(sock, length)
+                    if packet_id == SHELL_V2_STDOUT:
+                        out += payload
+                    elif packet_id == SHELL_V2_STDERR:
+                        err += payload
+                    elif packet_id == SHELL_V2_EXIT:
+                        code = payload[0] if payload else 0
+            else:
+                # shell v1 has no exit status; report 0 like the adb client does.
+                out, err, code = bytearray(), b"", 0
+                while True:
+                    sock.settimeout(remaining())
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    out += chunk
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(command, timeout)
+        finally:
+            sock.close()
+
+        decode = lambda data: bytes(data).decode("utf-8", errors="replace").replace("\r\n", "\n")
+        return code, decode(out), decode(err)
+
+    def open_shell(self, serial, command="", stdin_data=None, timeout=15):
+        """Starts a shell, optionally feeding it stdin; returns an AdbShellStream."""
+        use_v2 = "shell_v2" in self.features(serial, timeout)
+        sock = self._open(f"shell,v2,raw:{command}" if use_v2 else f"shell:{command}", timeout, serial, transport=True)
+        if stdin_data:
+            if use_v2:
+                sock.sendall(struct.pack("<BI", SHELL_V2_STDIN, len(stdin_data)) + stdin_data
+                             + struct.pack("<BI", SHELL_V2_CLOSE_STDIN, 0))
+            else:
+                sock.sendall(stdin_data)
+        return AdbShellStream(self, sock, use_v2)
+
+    def run(self, cmd, timeout_sec):
+        """
+        Serves an adb argv (as passed to run_with_timeout) in-process.
+        Returns (returncode, stdout, stderr), or None if it needs the real binary.
+        """
+        args = list(cmd[1:])
+        serial = None
+        if len(args) >= 2 and args[0] == "-s":
+            serial, args = args[1], args[2:]
+        if args == ["--version"]:
+            return 0, f"Android Debug Bridge version 1.0.{self.version(timeout_sec)}\n", ""
+        if args in (["devices"], ["devices", "-l"]):
+            listing = self.devices(long=len(args) == 2, timeout=timeout_sec)
+            return 0, "List of devices attached\n" + listing + "\n", ""
+        if len(args) >= 2 and args[0] == "shell":
+            try:
+                return self.shell(serial, " ".join(args[1:]), timeout_sec)
+            except AdbProtocolError as e:
+                return 1, "", f"error: {e}\n"
+        return None
+
+class AdbShellStream:
+    """
+    Iterates the merged stdout/stderr lines of an open shell socket.
+    close() may be called from another thread to abort a blocked read.
+    """
+    def __init__(self, client, sock, v2):
+        self.client = client
+        self.sock = sock
+        self.v2 = v2
+        self.exit_code = None
+
+    def _chunks(self):
+        while True:
+            if not self.v2:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    return
+                yield chunk
+                continue
+            packet_id, length = struct.unpack("<BI", self.client._recv_exact(self.sock, 5))
+            payload = self.client._recv_exact(self.sock, length)
+            if packet_id in (SHELL_V2_STDOUT, SHELL_V2_STDERR):
+                yield payload
+            elif packet_id == SHELL_V2_EXIT:
+                self.exit_code = payload[0] if payload else 0
+                return
+
+    def chunks(self):
+        """Raw output as it arrives; ends quietly when the socket is closed."""
+        self.sock.settimeout(None)
+        try:
+            yield from self._chunks()
+        except OSError:
+            return
+        finally:
+            self.close()
+
+    def __iter__(self):
+        self.sock.settimeout(None)
+        buffer = b""
+        try:
+            for chunk in self._chunks():
+                buffer += chunk
+                *complete, buffer = buffer.split(b"\n")
+                for raw in complete:
+                    yield raw.decode("utf-8", errors="replace").rstrip("\r")
+                while len(buffer) > STREAM_MAX_LINE: # No newline in sight; hand it out in pieces.
+                    yield buffer[:STREAM_MAX_LINE].decode("utf-8", errors="replace")
+                    buffer = buffer[STREAM_MAX_LINE:]
+        except OSError:
+            return
+        finally:
+            self.close()
+        if buffer:
+            yield buffer.decode("utf-8", errors="replace").rstrip("\r")
+
+    def close(self):
+        # shutdown() wakes a recv() blocked in another thread and sends FIN,
+        # so the server ends the device shell; close() alone does neither.
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        try: self.sock.close()
+        except OSError: pass
+
+def enable_native_adb(port=ADB_SERVER_PORT):
+    global native_adb
+    native_adb = AdbClient(port=port)
+    return native_adb
+
+def enable_native_adb_from_env():
+    """Turns the native client on when ADB_MANAGER_NATIVE=1; returns True if enabled."""
+    if os.environ.get("ADB_MANAGER_NATIVE") != "1":
+        return False
+    enable_native_adb(int(os.environ.get("ANDROID_ADB_SERVER_PORT", ADB_SERVER_PORT)))
+    return True
+
 # --- TOOL RESOLUTION LOGIC ---
 def get_bundled_path(filename):
     # This logic remains the same because we WANT internal resources 
@@ -81,15 +912,15 @@ def get_bundled_path(filename):
         base_path = os.path.dirname(os.path.abspath(__file__))
     return os.path.join(base_path, "bin", filename)
 
-def resolve_initial_adb():
+def adb_candidates():
     """
-    Finds ADB using the user's strict fallback order:
+    Lists usable ADB binaries in the user's strict fallback order:
     1. System Path (REAL binaries only, ignores Shim).
     2. Chocolatey Lib paths (The real binaries hidden in lib).
     3. Local Bin subfolder.
-    4. Return None (triggers User Prompt).
     """
-    
+    candidates = []
+
     # --- 1. System Path (If it's REAL) ---
     system_adb = shutil.which("adb")
     if system_adb:
@@ -98,7 +929,7 @@ def resolve_initial_adb():
         if "chocolatey" in system_adb.lower() and "bin" in system_adb.lower():
             pass 
         else:
-            return system_adb # It's a real system ADB (e.g. C:\platform-tools\adb.exe), use it.
+            candidates.append(system_adb) # It's a real system ADB (e.g. C:\platform-tools\adb.exe), use it.
 
     # --- 2. Chocolatey "Real" Paths (Deep Search) ---
     # These bypass the shim by looking directly where the tools are installed.
@@ -112,230 +943,3397 @@ def resolve_initial_adb():
     
     for path in choco_paths:
         if os.path.exists(path):
-            return path
+            candidates.append(path)
+
+    # --- 3. Local Bin Subfolder ---
+    bundled = get_bundled_path("adb.exe")
+    if os.path.exists(bundled):
+        candidates.append(bundled)
+    
+    unique = []
+    for path in candidates:
+        if os.path.normcase(os.path.abspath(path)) not in [os.path.normcase(os.path.abspath(p)) for p in unique]:
+            unique.append(path)
+    return unique
+
+def resolve_initial_adb():
+    """
+    Finds ADB using the order of adb_candidates().
+    Returns None (triggers User Prompt) if nothing was found.
+    """
+    candidates = adb_candidates()
+    return candidates[0] if candidates else None
+
+# --- STARTUP PROBE ---
+# The last ADB binary that answered is remembered in adb_probe.json along
+# with its size/mtime, so later launches skip the '--version' round trip.
+# Without a valid record every candidate is started at once and the
+# highest-priority one that answers wins; the rest are killed.
+ADB_PROBE_FILE = os.path.join(application_path, "adb_probe.json")
+
+class PhaseTimer:
+    """Collects (phase, seconds) pairs so slow startup steps show up in the log."""
+    def __init__(self):
+        self.phases = []
+        self.started = time.perf_counter()
+
+    def start(self, name):
+        return (name, time.perf_counter())
+
+    def stop(self, mark):
+        name, started = mark
+        self.phases.append((name, time.perf_counter() - started))
+
+    def summary(self):
+        parts = [f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases]
+        parts.append(f"total {(time.perf_counter() - self.started) * 1000:.0f} ms")
+        return " | ".join(parts)
+
+    def as_dict(self):
+        return {name: round(seconds, 4) for name, seconds in self.phases}
+
+def _binary_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, int(st.st_mtime)]
+
+def load_adb_probe():
+    try:
+        with open(ADB_PROBE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_adb_probe(path, version, timer=None):
+    probe = load_adb_probe()
+    if path:
+        probe.update({"adb": path, "version": version, "stamp": _binary_stamp(path)})
+    else:
+        for key in ("adb", "version", "stamp"):
+            probe.pop(key, None)
+    if timer:
+        probe["last_startup"] = timer.as_dict()
+    try:
+        with open(ADB_PROBE_FILE, "w", encoding="utf-8") as f:
+            json.dump(probe, f, indent=2)
+    except Exception: pass
+
+def _version_of(proc, timeout_sec):
+    try:
+        out, _ = proc.communicate(timeout=timeout_sec)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        return None
+    if proc.returncode != 0 or not out.strip():
+        return None
+    return out.strip().splitlines()[0]
+
+def race_adb_candidates(candidates, timeout_sec=5):
+    """
+    Runs '--version' on all candidates concurrently. Returns (path, version)
+    of the highest-priority candidate that answered, or (None, None).
+    Lower-priority binaries are killed as soon as a winner is known.
+    """
+    procs = []
+    for path in candidates:
+        try:
+            procs.append(subprocess.Popen(
+                [path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                stdin=subprocess.DEVNULL, text=True, creationflags=CREATE_NO_WINDOW
+            ))
+        except OSError:
+            procs.append(None)
+
+    winner = None
+    exc = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(procs)))
+    futures = [exc.submit(_version_of, proc, timeout_sec) if proc else None for proc in procs]
+    pending = {f for f in futures if f}
+    while pending and winner is None:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for index, future in enumerate(futures):
+            if future is None or (future.done() and not future.result()):
+                continue # Failed; look at the next candidate.
+            if future.done():
+                winner = index
+            break # Either the winner, or a higher-priority candidate is still running.
+    for proc in procs:
+        if proc and proc.poll() is None:
+            proc.kill()
+    exc.shutdown(wait=False) # Losers' readers finish on their own once killed.
+
+    if winner is None:
+        return None, None
+    return candidates[winner], futures[winner].result()
+
+def resolve_adb_fast(timer=None):
+    """
+    Returns (adb_path, version, verified). verified means the binary is
+    known to answer, so probe_devices can skip its own '--version' check.
+    """
+    timer = timer or PhaseTimer()
+    mark = timer.start("resolve adb")
+    probe = load_adb_probe()
+    cached = probe.get("adb")
+    if cached and os.path.exists(cached) and probe.get("stamp") == _binary_stamp(cached):
+        timer.stop(mark)
+        return cached, probe.get("version"), True
+
+    candidates = adb_candidates()
+    timer.stop(mark)
+    if not candidates:
+        return None, None, False
+    mark = timer.start("race candidates")
+    path, version = race_adb_candidates(candidates)
+    timer.stop(mark)
+    if path:
+        save_adb_probe(path, version)
+        return path, version, True
+    return candidates[0], None, False
+
+def force_kill_all_adb():
+    """Nuclear option to clear all ADB processes."""
+    try:
+        subprocess.run(
+            ["taskkill", "/F", "/IM", "adb.exe"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            creationflags=CREATE_NO_WINDOW
+        )
+    except: pass
+
+# --- PACKAGE STATE MODEL ---
+class PackageModel:
+    """
+    Package state of one device. Names are interned to small integer ids;
+    installed/all/missing are hash sets of ids and the selection is a bitmap.
+    Uninstalls and reinstalls update the sets in place, so the diff
+    (all - installed) never has to be rebuilt.
+    """
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.installed = set()
+        self.all = set()
+        self.missing = set()
+        self.selection = bytearray()
+        self._lock = threading.RLock()
+
+    def intern(self, name):
+        pkg_id = self.ids.get(name)
+        if pkg_id is None:
+            with self._lock:
+                pkg_id = self.ids.get(name)
+                if pkg_id is None:
+                    pkg_id = len(self.names)
+                    self.names.append(sys.intern(name))
+                    self.ids[self.names[pkg_id]] = pkg_id
+                    if pkg_id >> 3 >= len(self.selection):
+                        self.selection.extend(bytes(len(self.selection) + 1))
+        return pkg_id
+
+    def load(self, installed, all_packages):
+        """
+        Applies a fresh listing as a delta against the current sets; ids and
+        selection survive. Returns (installed_changes, all_changes) counts.
+        """
+        with self._lock:
+            installed_ids = {self.intern(name) for name in installed}
+            all_ids = {self.intern(name) for name in all_packages} | installed_ids
+            gained, lost = installed_ids - self.installed, self.installed - installed_ids
+            added, removed = all_ids - self.all, self.all - all_ids
+
+            self.installed -= lost
+            self.installed |= gained
+            self.all -= removed
+            self.all |= added
+            self.missing -= gained | removed
+            self.missing |= (lost | added) - self.installed - removed
+            return len(gained) + len(lost), len(added) + len(removed)
+
+    def mark_uninstalled(self, name):
+        with self._lock:
+            pkg_id = self.intern(name)
+            self.installed.discard(pkg_id)
+            if pkg_id in self.all:
+                self.missing.add(pkg_id)
+
+    def mark_installed(self, name):
+        with self._lock:
+            pkg_id = self.intern(name)
+            self.installed.add(pkg_id)
+            self.all.add(pkg_id)
+            self.missing.discard(pkg_id)
+
+    def is_installed(self, name):
+        pkg_id = self.ids.get(name)
+        return pkg_id is not None and pkg_id in self.installed
+
+    def _names_of(self, ids):
+        with self._lock:
+            return [self.names[i] for i in sorted(ids)]
+
+    def installed_names(self):
+        return self._names_of(self.installed)
+
+    def all_names(self):
+        return self._names_of(self.all)
+
+    def missing_names(self):
+        with self._lock:
+            return sorted(self.names[i] for i in self.missing)
+
+    # Selection bitmap: one bit per interned id.
+    def is_selected(self, name):
+        pkg_id = self.ids.get(name)
+        return pkg_id is not None and bool(self.selection[pkg_id >> 3] & (1 << (pkg_id & 7)))
+
+    def set_selected(self, names, value=True):
+        with self._lock:
+            for name in names:
+                pkg_id = self.intern(name)
+                if value:
+                    self.selection[pkg_id >> 3] |= 1 << (pkg_id & 7)
+                else:
+                    self.selection[pkg_id >> 3] &= ~(1 << (pkg_id & 7)) & 0xFF
+
+    def clear_selection(self):
+        with self._lock:
+            self.selection[:] = bytes(len(self.selection))
+
+    def selected_ids(self):
+        ids = []
+        for byte_index, byte in enumerate(self.selection):
+            while byte:
+                low = byte & -byte
+                ids.append((byte_index << 3) | (low.bit_length() - 1))
+                byte ^= low
+        return ids
+
+    def selected_names(self):
+        return [self.names[i] for i in self.selected_ids()]
+
+    def selection_count(self):
+        return sum(bin(byte).count("1") for byte in self.selection)
+
+# --- DEVICE SESSIONS ---
+# One DeviceSession per attached serial. Every adb call made on behalf of a
+# session passes "-s <serial>", so several phones can be driven at once.
+MAX_DEVICE_WORKERS = 8
+
+def adb_command(serial, *args):
+    cmd = [adb_executable]
+    if serial:
+        cmd += ["-s", serial]
+    return cmd + list(args)
+
+def device_folder_for(name, serial):
+    safe_serial = re.sub(r'[^\w\-_]', '_', serial)
+    return os.path.join(application_path, f"{name}_{safe_serial}")
+
+class DeviceSession:
+    def __init__(self, serial, name="Unknown_Device"):
+        self.serial = serial
+        self.name = name
+        self.folder = device_folder_for(name, serial)
+        self.model = PackageModel()
+        self.inventory = {}
+        self.package_filter = None
+        self.fingerprint = None
+        self.change_token = None
+        self.status = "Idle"
+        self.metadata = None # MetadataService, created when the GUI first shows this device.
+        self.detached = threading.Event() # Set by the hot-plug watcher while the device is gone.
+
+    @property
+    def label(self):
+        return f"{self.name} ({self.serial})"
+
+    def adb(self, *args):
+        return adb_command(self.serial, *args)
+
+    def ensure_folder(self):
+        if not os.path.exists(self.folder):
+            try: os.makedirs(self.folder, exist_ok=True)
+            except: pass
+
+device_sessions = {}
+# Held by every writer of device_sessions (the fetch worker, the hot-plug
+# watcher's attach); writers never remove a key that stays, so readers need no lock.
+device_sessions_lock = threading.Lock()
+active_serial = None
+
+def get_active_session():
+    return device_sessions.get(active_serial)
+
+def device_detached(serial):
+    session = device_sessions.get(serial)
+    return session is not None and session.detached.is_set()
+
+def set_active_session(serial):
+    """Points the single-device globals at the chosen session."""
+    global active_serial, current_device_name, device_folder
+    session = device_sessions.get(serial)
+    if session is None:
+        return None
+    active_serial = serial
+    current_device_name = session.name
+    device_folder = session.folder
+    if logger:
+        logger.update_log_path(device_folder)
+    return session
+
+def run_on_devices(func, sessions, *args, **kwargs):
+    """
+    Runs func(*args, session=s, **kwargs) for every session on a bounded pool.
+    Returns {serial: result}; a device that raised maps to its exception.
+    """
+    results = {}
+    if not sessions:
+        return results
+    workers = min(MAX_DEVICE_WORKERS, len(sessions))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as exc:
+        futures = {exc.submit(func, *args, session=s, **kwargs): s for s in sessions}
+        for future in concurrent.futures.as_completed(futures):
+            session = futures[future]
+            try:
+                results[session.serial] = future.result()
+            except Exception as e:
+                logger.log(f"ERROR: {str(e)}", level="ERROR", device=session)
+                results[session.serial] = e
+    return results
+
+def parse_device_list(output):
+    """Parses 'adb devices [-l]' output into [(serial, state, {key: value})]."""
+    devices = []
+    for line in output.splitlines():
+        line = line.strip()
+        if not line or line.startswith("*") or line.startswith("List of devices"):
+            continue
+        parts = line.split()
+        if len(parts) >= 2:
+            props = dict(part.split(":", 1) for part in parts[2:] if ":" in part)
+            devices.append((parts[0], parts[1], props))
+    return devices
+
+def list_devices(adb_path):
+    """Returns [(serial, state, {key: value})] parsed from 'adb devices -l'."""
+    code, output, err = run_with_timeout([adb_path, "devices", "-l"], 15)
+    return parse_device_list(output)
+
+def read_device_model(adb_path, serial):
+    """Model name from getprop, made safe for folder names; None when unreadable."""
+    try:
+        code, name, err = run_with_timeout([adb_path, "-s", serial, "shell", "getprop", "ro.product.model"], 5)
+    except:
+        return None
+    if code != 0:
+        return None
+    name = re.sub(r'[^\w\-_]', '_', name.strip())
+    return name if name else "Unknown_Device"
+
+def probe_devices(adb_path, verified=False, timer=None):
+    """
+    Returns ([(serial, model_name)], error) for every authorized device.
+    The model comes straight from 'adb devices -l'; getprop is only used
+    for devices that do not report one.
+    """
+    timer = timer or PhaseTimer()
+    # 1. Sanity Check (skipped when the binary was just raced or is cached)
+    if not verified:
+        mark = timer.start("adb --version")
+        try:
+            run_with_timeout([adb_path, "--version"], 5)
+        except:
+            return [], "Binary Unresponsive"
+        finally:
+            timer.stop(mark)
+
+    # 2. Run 'devices -l'
+    mark = timer.start("adb devices -l")
+    try:
+        devices = [(serial, props) for serial, state, props in list_devices(adb_path) if state == "device"]
+    except subprocess.TimeoutExpired:
+        return [], "Daemon Start Timeout"
+    except Exception as e:
+        return [], str(e)
+    finally:
+        timer.stop(mark)
+
+    if not devices:
+        return [], "No device found"
+
+    # 3. Get Model Names (one getprop per device lacking a model, in parallel)
+    def read_model(serial):
+        return read_device_model(adb_path, serial)
+
+    names = {serial: re.sub(r'[^\w\-_]', '_', props["model"]) for serial, props in devices if props.get("model")}
+    unnamed = [serial for serial, _ in devices if serial not in names]
+    if unnamed:
+        mark = timer.start("getprop model")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_DEVICE_WORKERS, len(unnamed))) as exc:
+            names.update(zip(unnamed, exc.map(read_model, unnamed)))
+        timer.stop(mark)
+
+    found = [(serial, names[serial]) for serial, _ in devices if names.get(serial)]
+    if not found:
+        return [], "Read Error"
+    return found, None
+
+def connect_devices(verified=False, timer=None):
+    """Probes devices with adb_executable, falling back to the bundled binary."""
+    global adb_executable
+    # PHASE 1: Try System ADB (with safety net)
+    logger.log(f"Attempting connection with: {adb_executable}", level="INFO")
+    found, error_reason = probe_devices(adb_executable, verified, timer)
+    
+    # PHASE 2: Fallback to Bundled
+    if not found:
+        logger.log(f"Connection failed ({error_reason}).", level="WARNING")
+        if error_reason in ("Binary Unresponsive", "Daemon Start Timeout") or verified and error_reason != "No device found":
+            save_adb_probe(None, None) # Don't trust the remembered binary next launch.
+        
+        bundled_adb = get_bundled_path("adb.exe")
+        if adb_executable != bundled_adb and os.path.exists(bundled_adb):
+            logger.log("Switching to Bundled ADB...", level="WARNING")
+            
+            # We only force kill if the FIRST attempt failed, just in case the shim is truly broken.
+            force_kill_all_adb() 
+            adb_executable = bundled_adb
+            
+            found, error_reason = probe_devices(adb_executable, timer=timer)
+    return found, error_reason
+
+def build_sessions(found):
+    """
+    Rebuilds device_sessions from probe results, keeping sessions of devices
+    still attached; a kept session found again is no longer detached.
+    """
+    sessions = {}
+    with device_sessions_lock:
+        for serial, name in found:
+            session = device_sessions.get(serial)
+            if session is None or session.name != name:
+                session = DeviceSession(serial, name)
+            session.ensure_folder()
+            session.detached.clear()
+            sessions[serial] = session
+        device_sessions.update(sessions)
+        for serial in [serial for serial in device_sessions if serial not in sessions]:
+            del device_sessions[serial]
+    return sessions
+
+def get_device_name_with_tool(adb_path):
+    devices, error = probe_devices(adb_path)
+    if not devices:
+        return None, error
+    return devices[0][1], None
+
+# --- HOT-PLUG WATCHER ---
+# Follows 'adb track-devices' (host:track-devices with the native client): the
+# adb server pushes the whole device list, length-prefixed, every time a
+# device attaches, detaches or changes state (unauthorized, offline, device).
+# Consecutive lists are diffed and each change is handed to on_change.
+WATCH_RETRY_DELAYS = (1, 2, 5, 10)
+
+def parse_track_blocks(buffer):
+    """Splits track-devices output into listings; returns ([listing], unparsed rest)."""
+    listings = []
+    while len(buffer) >= 4:
+        try:
+            length = int(buffer[:4], 16)
+        except ValueError:
+            # Not a frame header (a stray server message); skip the line.
+            newline = buffer.find("\n")
+            if newline < 0:
+                break
+            buffer = buffer[newline + 1:]
+            continue
+        if len(buffer) < 4 + length:
+            break
+        listings.append(buffer[4:4 + length])
+        buffer = buffer[4 + length:]
+    return listings, buffer
+
+class DeviceWatcher:
+    """
+    Background thread calling on_change(serial, old_state, new_state) for each
+    device whose state changes; a state is None when the device is gone.
+    known seeds the states so devices already handled are not reported again.
+    When the adb server goes away the watcher reconnects with a backoff.
+    """
+    def __init__(self, on_change, known=None):
+        self.on_change = on_change
+        self.states = dict(known or {})
+        self.stopped = threading.Event()
+        self.stream = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=2):
+        self.stopped.set()
+        stream = self.stream
+        if stream is not None:
+            stream.close()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _listings(self):
+        if native_adb is not None:
+            # Heartbeats (None) every second let stop() take effect.
+            for listing in native_adb.track_devices(timeout=1):
+                if self.stopped.is_set():
+                    return
+                if listing is not None:
+                    yield listing
+            return
+        self.stream = CommandStream([adb_executable, "track-devices"], kind="track-devices",
+                                    track_latency=False, raw=True)
+        buffer = ""
+        try:
+            for data in self.stream:
+                buffer += data
+                listings, buffer = parse_track_blocks(buffer)
+                yield from listings
+        finally:
+            self.stream.close()
+            self.stream = None
+
+    def _apply(self, listing):
+        current = {serial: state for serial, state, _ in parse_device_list(listing)}
+        changes = [(serial, self.states.get(serial), current.get(serial))
+                   for serial in sorted(set(self.states) | set(current))
+                   if self.states.get(serial) != current.get(serial)]
+        self.states = current
+        for serial, old, new in changes:
+            try:
+                self.on_change(serial, old, new)
+            except Exception as e:
+                logger.log(f"Device watcher error ({serial}): {e}", level="ERROR")
+
+    def _run(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                for listing in self._listings():
+                    failures = 0
+                    self._apply(listing)
+            except ConnectionRefusedError:
+                # No adb server yet; the binary starts one.
+                try: run_with_timeout([adb_executable, "start-server"], 15)
+                except: pass
+            except Exception as e:
+                if not self.stopped.is_set():
+                    logger.log(f"Device watcher lost the adb server ({e}); reconnecting.", level="WARNING")
+            delay = WATCH_RETRY_DELAYS[min(failures, len(WATCH_RETRY_DELAYS) - 1)]
+            failures += 1
+            self.stopped.wait(delay)
+
+# --- LOGGING ---
+# Log lines are handed to a background writer thread that keeps each log file
+# open, writes whatever has queued up in one go and rotates by size. The GUI
+# side buffers lines and inserts them in bulk on a timer, keeping at most
+# LOG_MAX_LINES lines in the System Log.
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+LOG_FLUSH_MS = 100
+LOG_MAX_LINES = 2000
+
+LEVEL_KEYWORDS = [
+    ("ERROR", ["error", "failed", "failure", "exception", "no device", "timed out", "unresponsive", "switching"]),
+    ("SUCCESS", ["success", "installed successfully"]),
+    ("WARNING", ["warning", "no selection"]),
+    ("HEADER", ["starting", "launching", "fetching", "connecting", "attempting"]),
+]
+LEVEL_PATTERNS = [(level, re.compile("|".join(re.escape(k) for k in keywords))) for level, keywords in LEVEL_KEYWORDS]
+
+class LogWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.files = {}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, line):
+        self.queue.put((path, line))
+
+    def close(self, timeout=2):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _open(self, path):
+        handle = self.files.get(path)
+        if handle is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handle = self.files[path] = open(path, "a", encoding="utf-8")
+        return handle
+
+    def _rotate(self, path):
+        self.files.pop(path).close()
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        os.replace(path, f"{path}.1")
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try: batch.append(self.queue.get_nowait())
+                except queue.Empty: break
+
+            touched = set()
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                path, line = item
+                try:
+                    self._open(path).write(line)
+                    touched.add(path)
+                except Exception:
+                    pass
+
+            for path in touched:
+                try:
+                    handle = self.files[path]
+                    handle.flush()
+                    if handle.tell() > LOG_MAX_BYTES:
+                        self._rotate(path)
+                except Exception:
+                    pass
+
+        for handle in self.files.values():
+            try: handle.close()
+            except Exception: pass
+        self.files.clear()
+
+class Logger:
+    def __init__(self, textbox=None, stream=None):
+        self.textbox = textbox
+        self.stream = stream
+        self.log_file = os.path.join(device_folder, "operation_log.txt")
+        self.writer = LogWriter()
+        self.pending = collections.deque()
+        self.setup_tags()
+        if self.textbox:
+            self.textbox.after(LOG_FLUSH_MS, self._pump)
+
+    def setup_tags(self):
+        if self.textbox:
+            self.textbox.tag_config("INFO", foreground="#212121") 
+            self.textbox.tag_config("SUCCESS", foreground="#2e7d32", font=("Consolas", 13, "bold")) 
+            self.textbox.tag_config("ERROR", foreground="#c62828", font=("Consolas", 13, "bold")) 
+            self.textbox.tag_config("WARNING", foreground="#ef6c00", font=("Consolas", 12, "bold")) 
+            self.textbox.tag_config("HEADER", foreground="#1565c0", font=("Consolas", 10, "bold")) 
+
+    def update_log_path(self, new_folder):
+        self.log_file = os.path.join(new_folder, "operation_log.txt")
+
+    @staticmethod
+    def classify(message):
+        msg_lower = message.lower()
+        for level, pattern in LEVEL_PATTERNS:
+            if pattern.search(msg_lower):
+                return level
+        return "INFO"
+
+    def log(self, message, level=None, device=None):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        formatted_msg = f"[{timestamp}] [{device.name}] {message}" if device else f"[{timestamp}] {message}"
+        log_file = os.path.join(device.folder, "operation_log.txt") if device else self.log_file
+        
+        if level is None:
+            level = self.classify(message)
+
+        if self.textbox:
+            self.pending.append((formatted_msg + "\n", level))
+        if self.stream:
+            try: self.stream.write(f"{level:<7} {formatted_msg}\n")
+            except Exception: pass
+
+        self.writer.write(log_file, f"{datetime.now().strftime('%Y-%m-%d')} [{level}] {message}\n")
+
+    def _pump(self):
+        """Runs on the Tk thread: inserts everything queued since the last tick."""
+        if self.pending:
+            args = []
+            while self.pending:
+                try: args.extend(self.pending.popleft())
+                except IndexError: break
+            try:
+                self.textbox.insert(tk.END, *args)
+                lines = int(self.textbox.index("end-1c").split(".")[0])
+                if lines > LOG_MAX_LINES:
+                    self.textbox.delete("1.0", f"{lines - LOG_MAX_LINES + 1}.0")
+                self.textbox.see(tk.END)
+            except tk.TclError:
+                return
+        self.textbox.after(LOG_FLUSH_MS, self._pump)
+
+    def close(self):
+        self.writer.close()
+
+logger = None
+
+# --- BATCHED PM SESSION ---
+# Packages are pushed through one long-lived 'adb shell' per chunk instead of
+# spawning a new adb process per package. Each package is wrapped in marker
+# lines so results can still be reported one by one as they stream back.
+BATCH_CHUNK_SIZE = 50
+BATCH_PACKAGE_TIMEOUT = 15
+SAFE_PACKAGE_RE = re.compile(r'^[A-Za-z0-9_.]+$')
+
+def _batch_script(operations, token):
+    lines = []
+    for package_name, pm_args in operations:
+        lines.append(f"echo '{token} B {package_name}'")
+        lines.append(" ".join(["pm"] + pm_args + [package_name]) + " 2>&1")
+        lines.append(f"echo '{token} E {package_name}' $?")
+    lines.append("exit")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def run_marked_script(serial, items, kind, item_timeout):
+    """
+    Runs [(key, [shell lines])] through one shell, wrapping each item in
+    marker echoes. Returns {key: [output lines]} for every item whose end
+    marker arrived, also when the shell timed out later; keys must not
+    contain whitespace.
+    """
+    token = f"__ASM_{os.urandom(4).hex()}__"
+    script = []
+    for key, commands in items:
+        script.append(f"echo '{token} B {key}'")
+        script.extend(commands)
+        script.append(f"echo '{token} E {key}'")
+    script.append("exit")
+    stream = CommandStream(adb_command(serial, "shell"), timeout_sec=item_timeout * max(1, len(items)),
+                           stdin_data=("\n".join(script) + "\n").encode("utf-8"), merge_stderr=True, kind=kind)
+    results, current, output = {}, None, []
+    try:
+        for line in stream:
+            if line.startswith(token):
+                parts = line.split()
+                if len(parts) >= 3 and parts[1] == "B":
+                    current, output = parts[2], []
+                elif len(parts) >= 3 and parts[1] == "E" and current == parts[2]:
+                    results[current] = output
+                    current = None
+            elif current is not None:
+                output.append(line)
+    except subprocess.TimeoutExpired:
+        pass
+    finally:
+        stream.close()
+    return results
+
+def _run_pm_chunk(operations, timeout_sec, serial=None):
+    """
+    Runs one chunk of (package_name, pm_args) operations in a single shell.
+    Yields (package_name, exit_code, output) per package as markers arrive;
+    exit_code is None for the package that was running when the session
+    died or timed out. Returns the operations that never started.
+    The silence allowed per package adapts as the chunk's own timings arrive.
+    """
+    token = f"__ASM_{os.urandom(4).hex()}__"
+    script = _batch_script(operations, token)
+    # Per-package timings are recorded below; the stream only adds one
+    # "batch shell" sample (spawn cost vs. the whole chunk) to the metrics.
+    stream = CommandStream(adb_command(serial, "shell"), idle_timeout=timeout_sec, stdin_data=script,
+                           merge_stderr=True, kind="batch shell", track_latency=False)
+    lines = iter(stream)
+
+    kinds = {pkg: "pm " + pm_args[0] for pkg, pm_args in operations}
+    pending = [pkg for pkg, _ in operations]
+    current, output, stray = None, [], []
+    reason = "Shell session ended"
+    started = time.perf_counter()
+    try:
+        while pending:
+            kind = kinds[current or pending[0]]
+            stream.idle_timeout = wait = latency.timeout_for(serial, kind, timeout_sec)
+            try:
+                line = next(lines)
+            except subprocess.TimeoutExpired:
+                reason = f"Timed out after {wait}s"
+                latency.record_timeout(serial, kind, wait)
+                metrics.observe_timeout(serial, kind, wait)
+                break
+            except StopIteration:
+                break
+            if not line.startswith(token):
+                (output if current else stray).append(line)
+                continue
+            parts = line.split()
+            if len(parts) >= 3 and parts[1] == "B":
+                current, output, started = parts[2], [], time.perf_counter()
+            elif len(parts) >= 4 and parts[1] == "E" and parts[2] in pending:
+                pending.remove(parts[2])
+                elapsed = time.perf_counter() - started
+                latency.record(serial, kinds[parts[2]], elapsed)
+                try: code = int(parts[3])
+                except ValueError: code = 1
+                metrics.observe(serial, kinds[parts[2]], elapsed, code)
+                yield parts[2], code, "\n".join(output).strip()
+                current, output = None, []
+        if not pending:
+            for _ in lines: pass # Only 'exit' is left; let the session end on its own.
+    except subprocess.TimeoutExpired:
+        pass
+    finally:
+        stream.close()
+
+    detail = "\n".join(stray).strip() or reason
+    if current in pending:
+        pending.remove(current)
+        yield current, None, detail
+    return [op for op in operations if op[0] in pending]
+
+def run_pm_batch(operations, chunk_size=BATCH_CHUNK_SIZE, timeout_sec=BATCH_PACKAGE_TIMEOUT, serial=None, job=None):
+    """
+    Runs (package_name, pm_args) operations in chunked 'adb shell' sessions.
+    timeout_sec is the allowed silence per package, not per chunk; once the
+    device has history the adaptive timeout for the pm command is used.
+    When a chunk breaks off, packages that never started are retried once
+    if the device still answers a health probe; otherwise the batch stops.
+    A device the hot-plug watcher reports as gone stops it straight away.
+    With a job, pausing and cancelling take effect between chunks.
+    """
+    remaining = []
+    for package_name, pm_args in operations:
+        if SAFE_PACKAGE_RE.match(package_name):
+            remaining.append((package_name, pm_args))
+        else:
+            yield package_name, None, "Invalid package name"
+
+    retried = set()
+    while remaining:
+        if job is not None and not job.checkpoint():
+            for package_name, _ in remaining:
+                yield package_name, None, JOB_CANCELLED_DETAIL
+            return
+        if device_detached(serial):
+            logger.log(f"Device disconnected; skipping {len(remaining)} remaining packages.",
+                       level="ERROR", device=device_sessions.get(serial))
+            for package_name, _ in remaining:
+                yield package_name, None, DEVICE_GONE_DETAIL
+            return
+        chunk, remaining = remaining[:chunk_size], remaining[chunk_size:]
+        leftover = yield from _run_pm_chunk(chunk, timeout_sec, serial)
+        if not leftover:
+            continue
+        if device_detached(serial):
+            remaining = leftover + remaining
+            continue
+        if latency.is_suspect(serial) or not device_responds(serial):
+            logger.log(f"Device stopped responding; skipping {len(leftover) + len(remaining)} remaining packages.",
+                       level="ERROR", device=device_sessions.get(serial))
+            for package_name, _ in leftover + remaining:
+                yield package_name, None, DEVICE_HUNG_DETAIL
+            return
+        for op in leftover:
+            if op[0] in retried:
+                yield op[0], None, "Shell session ended twice; not retried"
+        leftover = [op for op in leftover if op[0] not in retried]
+        retried.update(op[0] for op in leftover)
+        remaining = leftover + remaining
+
+STOPPED_STATUSES = ("Not responding", "Disconnected")
+
+def mark_stopped_session(session, results):
+    """Keeps the reason a task stopped early on the session after the progress updates."""
+    if session is None:
+        return
+    if session.detached.is_set():
+        session.status = "Disconnected"
+    elif any(r["detail"] == DEVICE_HUNG_DETAIL for r in results.values()):
+        session.status = "Not responding"
+
+def _run_package_task(package_list, pm_args, task_name, verb, batch, session=None, progress=None, on_success=None, job=None):
+    folder = session.folder if session else device_folder
+    serial = session.serial if session else None
+    task_log_file = os.path.join(folder, task_name)
+    if session:
+        session.ensure_folder()
+    retry = job is not None and job.attempt > 0
+    try:
+        # A job's retries append, so the log keeps the earlier attempts' successes.
+        with open(task_log_file, "a" if retry else "w") as f:
+            f.write(f"Retry {job.attempt}: {datetime.now()}\n" if retry else f"Start: {datetime.now()}\n")
+    except: pass
+
+    total = len(package_list)
+    done = 0
+    results = {}
+    journal = journal_for(session, job) if session else None
+    action = JOURNAL_PM_ACTIONS[pm_args[0]]
+    def report(package_name, code, detail):
+        nonlocal done
+        done += 1
+        results[package_name] = {"success": code == 0, "exit_code": code, "detail": detail}
+        if journal:
+            journal.record(action, package_name, results[package_name])
+        if code == 0:
+            if on_success:
+                on_success(package_name)
+            logger.log(f"SUCCESS: {package_name}", level="SUCCESS", device=session)
+            try:
+                with open(task_log_file, "a") as f: f.write(f"SUCCESS: {package_name}\n")
+            except: pass
+        elif detail == JOB_CANCELLED_DETAIL:
+            pass # Logged once for the whole job.
+        elif code is None:
+            logger.log(f"ERROR: {package_name} ({detail})", level="ERROR", device=session)
+        else:
+            logger.log(f"FAILED: {package_name} (ADB Error: {detail})", level="ERROR", device=session)
+        if session:
+            session.status = f"{verb} {done}/{total}"
+        if progress:
+            progress(session, done, total)
+
+    if batch:
+        logger.log(f"Batch mode: {total} packages in chunks of {BATCH_CHUNK_SIZE}.", level="INFO", device=session)
+        try:
+            for package_name, code, detail in run_pm_batch([(p, pm_args) for p in package_list], serial=serial, job=job):
+                report(package_name, code, detail)
+        except Exception as e:
+            logger.log(f"ERROR: Batch session failed ({str(e)})", level="ERROR", device=session)
+            for package_name in package_list:
+                if package_name not in results:
+                    results[package_name] = {"success": False, "exit_code": None, "detail": str(e)}
+        finally:
+            if journal:
+                journal.close()
+        mark_stopped_session(session, results)
+        return results
+
+    for index, package_name in enumerate(package_list):
+        if job is not None and not job.checkpoint():
+            for skipped in package_list[index:]:
+                report(skipped, None, JOB_CANCELLED_DETAIL)
+            break
+        if device_detached(serial):
+            logger.log(f"Device disconnected; skipping {len(package_list) - index} remaining packages.",
+                       level="ERROR", device=session)
+            for skipped in package_list[index:]:
+                report(skipped, None, DEVICE_GONE_DETAIL)
+            break
+        logger.log(f"{verb}: {package_name}", level="INFO", device=session)
+        try:
+            code, out, err = run_with_timeout(
+                adb_command(serial, "shell", "pm", *pm_args, package_name),
+                BATCH_PACKAGE_TIMEOUT
+            )
+            report(package_name, code, err.strip() if code else "")
+        except Exception as e:
+            report(package_name, None, str(e))
+            if latency.is_suspect(serial) and not device_responds(serial):
+                logger.log(f"Device stopped responding; skipping {len(package_list) - index - 1} remaining packages.",
+                           level="ERROR", device=session)
+                for skipped in package_list[index + 1:]:
+                    report(skipped, None, DEVICE_HUNG_DETAIL)
+                break
+    if journal:
+        journal.close()
+    mark_stopped_session(session, results)
+    return results
+
+def uninstall_packages(package_list, batch=True, session=None, progress=None, job=None, backup=False):
+    """With backup, APKs go to the shared store first; a package whose backup failed is left installed."""
+    logger.log(f"Starting uninstall for {len(package_list)} packages...", level="HEADER", device=session)
+    skipped = {}
+    if backup and session:
+        failures = {pkg: error for pkg, error in backup_packages(session, package_list).items() if error}
+        for pkg, error in failures.items():
+            logger.log(f"SKIPPED: {pkg} ({BACKUP_FAILED_DETAIL}: {error})", level="ERROR", device=session)
+            skipped[pkg] = {"success": False, "exit_code": None, "detail": BACKUP_FAILED_DETAIL}
+        package_list = [pkg for pkg in package_list if pkg not in skipped]
+    results = _run_package_task(package_list, ["uninstall", "--user", "0"], "uninstall_log.txt", "Uninstalling", batch, session, progress,
+                                on_success=session.model.mark_uninstalled if session else None, job=job)
+    results.update(skipped)
+    if session and session.status not in STOPPED_STATUSES:
+        session.status = "Idle"
+    export_session_metrics(session)
+    logger.log("Uninstallation process finished.", level="HEADER", device=session)
+    return results
+
+def install_existing_packages(package_list, batch=True, session=None, progress=None, job=None):
+    logger.log(f"Starting install for {len(package_list)} packages...", level="HEADER", device=session)
+    results = _run_package_task(package_list, ["install-existing"], "install_existing_log.txt", "Installing", batch, session, progress,
+                                on_success=session.model.mark_installed if session else None, job=job)
+    if session and session.status not in STOPPED_STATUSES:
+        session.status = "Idle"
+    export_session_metrics(session)
+    logger.log("Installation process finished.", level="HEADER", device=session)
+    return results
+
+# --- APK BACKUP STORE ---
+# Before an uninstall, the package's APKs (base and splits, from 'pm path')
+# can be copied into apk_store/ next to the script. The store is content
+# addressed (objects/<sha256[:2]>/<sha256>.apk) and shared by every device
+# folder, so the same vendor APK on thirty identical phones is kept once.
+# The device hashes its files with sha256sum first; an APK whose hash is
+# already stored is not pulled again. Each device folder keeps
+# apk_backups.json mapping its packages to the hashes they need, which is
+# what restore_packages installs from.
+APK_STORE_DIR = "apk_store"
+APK_BACKUP_MANIFEST = "apk_backups.json"
+BACKUP_PULL_WORKERS = 4
+BACKUP_PULL_TIMEOUT = 300
+BACKUP_HASH_TIMEOUT = 30
+BACKUP_FAILED_DETAIL = "Backup failed; not uninstalled"
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class ApkStore:
+    def __init__(self, root=None):
+        self.root = root or os.path.join(application_path, APK_STORE_DIR)
+        self._inflight = {} # sha256 -> Event set once that object is stored (or given up on)
+        self._lock = threading.Lock()
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], sha256 + ".apk")
+
+    def has(self, sha256):
+        return os.path.exists(self.object_path(sha256))
+
+    @staticmethod
+    def hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def claim(self, sha256):
+        """True when the caller should fetch sha256; False when it is stored or another thread just stored it."""
+        while True:
+            if self.has(sha256):
+                return False
+            with self._lock:
+                event = self._inflight.get(sha256)
+                if event is None:
+                    self._inflight[sha256] = threading.Event()
+                    return True
+            event.wait()
+
+    def release(self, sha256):
+        with self._lock:
+            event = self._inflight.pop(sha256, None)
+        if event:
+            event.set()
+
+    def add_file(self, path, expected=None):
+        """Hashes a pulled file and moves it into the store; returns its sha256."""
+        sha256 = self.hash_file(path)
+        if expected and sha256 != expected:
+            os.remove(path)
+            raise ValueError(f"hash mismatch ({sha256[:12]} != {expected[:12]})")
+        target = self.object_path(sha256)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        return sha256
+
+    def temp_path(self):
+        folder = os.path.join(self.root, "tmp")
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, f"{os.getpid()}_{threading.get_ident()}_{os.urandom(4).hex()}.apk")
+
+apk_store = None
+
+def get_apk_store():
+    global apk_store
+    if apk_store is None:
+        apk_store = ApkStore()
+    return apk_store
+
+def load_backup_manifest(session):
+    try:
+        with open(os.path.join(session.folder, APK_BACKUP_MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_backup_manifest(session, manifest):
+    path = os.path.join(session.folder, APK_BACKUP_MANIFEST)
+    try:
+        session.ensure_folder()
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        logger.log(f"Could not save backup manifest: {e}", level="ERROR", device=session)
+
+def resolve_apk_files(session, packages):
+    """{package: [(remote path, device sha256 or None)]} via batched pm path, then sha256sum."""
+    serial = session.serial
+    listing = run_marked_script(serial, [(pkg, [f"pm path {pkg} 2>/dev/null"]) for pkg in packages],
+                                "pm path", BACKUP_HASH_TIMEOUT)
+    paths = {pkg: [line.strip()[len("package:"):] for line in lines if line.strip().startswith("package:")]
+             for pkg, lines in listing.items()}
+    hashing = [(pkg, ["sha256sum " + " ".join(shlex.quote(path) for path in files) + " 2>/dev/null"])
+               for pkg, files in paths.items() if files]
+    hashes = {}
+    if hashing:
+        for pkg, lines in run_marked_script(serial, hashing, "sha256sum", BACKUP_HASH_TIMEOUT).items():
+            for line in lines:
+                parts = line.split(None, 1)
+                if len(parts) == 2 and SHA256_RE.match(parts[0]):
+                    hashes[parts[1].strip()] = parts[0]
+    return {pkg: [(path, hashes.get(path)) for path in files] for pkg, files in paths.items()}
+
+def _pull_apk(session, store, remote, device_hash):
+    """Stores one APK; returns (sha256, size, pulled?)."""
+    if device_hash and not store.claim(device_hash):
+        return device_hash, os.path.getsize(store.object_path(device_hash)), False
+    local = None
+    try:
+        local = store.temp_path()
+        code, out, err = run_with_timeout(session.adb("pull", remote, local), BACKUP_PULL_TIMEOUT)
+        if code != 0 or not os.path.exists(local):
+            raise RuntimeError((err or out).strip() or f"adb pull exited with {code}")
+        size = os.path.getsize(local)
+        return store.add_file(local, device_hash), size, True
+    except Exception:
+        # A failed or cut-off pull can leave a partial file in the store's tmp folder.
+        if local and os.path.exists(local):
+            try: os.remove(local)
+            except: pass
+        raise
+    finally:
+        if device_hash:
+            store.release(device_hash)
+
+def backup_packages(session, packages, store=None):
+    """
+    Copies the APKs of packages into the shared store and records them in the
+    device's manifest. Returns {package: error or None}.
+    """
+    store = store or get_apk_store()
+    packages = [pkg for pkg in packages if SAFE_PACKAGE_RE.match(pkg)]
+    logger.log(f"Backing up APKs of {len(packages)} packages...", level="INFO", device=session)
+    try:
+        files = resolve_apk_files(session, packages)
+    except Exception as e:
+        return {pkg: f"pm path failed ({e})" for pkg in packages}
+    errors = {pkg: "No APK path (not installed?)" for pkg in packages if not files.get(pkg)}
+    tasks = [(pkg, remote, device_hash) for pkg in packages if files.get(pkg) for remote, device_hash in files[pkg]]
+    stored = {}
+    pulled = skipped = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BACKUP_PULL_WORKERS) as exc:
+        futures = {exc.submit(_pull_apk, session, store, remote, device_hash): (pkg, remote)
+                   for pkg, remote, device_hash in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            pkg, remote = futures[future]
+            try:
+                sha256, size, was_pulled = future.result()
+            except Exception as e:
+                errors[pkg] = f"{os.path.basename(remote)}: {e}"
+                continue
+            pulled, skipped = pulled + was_pulled, skipped + (not was_pulled)
+            stored.setdefault(pkg, []).append({"name": os.path.basename(remote), "path": remote, "sha256": sha256, "size": size})
+
+    manifest = load_backup_manifest(session)
+    saved_at = datetime.now().isoformat(timespec="seconds")
+    for pkg, entries in stored.items():
+        if pkg in errors:
+            continue # A package is only backed up when every split made it.
+        entries.sort(key=lambda e: (e["name"] != "base.apk", e["name"]))
+        manifest[pkg] = {"files": entries, "saved_at": saved_at, "fingerprint": session.fingerprint}
+    save_backup_manifest(session, manifest)
+    logger.log(f"Backup: {len(packages) - len(errors)} packages stored ({pulled} APKs pulled, {skipped} already in the store)"
+               + (f", {len(errors)} failed." if errors else "."), level="SUCCESS" if not errors else "WARNING", device=session)
+    return {pkg: errors.get(pkg) for pkg in packages}
+
+def restore_packages(package_list, batch=True, session=None, progress=None, job=None, store=None, journal=None):
+    """
+    Installs packages for user 0 from their backed-up APKs ('adb install-multiple').
+    Results are recorded in journal (a JournalRun) if given, else in the job's run or a new one.
+    """
+    store = store or get_apk_store()
+    manifest = load_backup_manifest(session)
+    logger.log(f"Restoring {len(package_list)} packages from backup...", level="HEADER", device=session)
+    results = {}
+    journal = journal or journal_for(session, job)
+    for index, package_name in enumerate(package_list):
+        if job is not None and not job.checkpoint():
+            for skipped in package_list[index:]:
+                results[skipped] = {"success": False, "exit_code": None, "detail": JOB_CANCELLED_DETAIL}
+            break
+        if device_detached(session.serial):
+            for skipped in package_list[index:]:
+                results[skipped] = {"success": False, "exit_code": None, "detail": DEVICE_GONE_DETAIL}
+            break
+        entry = manifest.get(package_name)
+        files = [store.object_path(f["sha256"]) for f in entry["files"]] if entry else []
+        if not files or not all(os.path.exists(path) for path in files):
+            code, detail = 1, "No complete backup"
+        else:
+            try:
+                code, out, err = run_with_timeout(session.adb("install-multiple", "-r", "--user", "0", *files),
+                                                  BACKUP_PULL_TIMEOUT)
+                detail = "" if code == 0 else (err or out).strip()
+            except Exception as e:
+                code, detail = None, str(e)
+        results[package_name] = {"success": code == 0, "exit_code": code, "detail": detail}
+        journal.record("restore", package_name, results[package_name])
+        if code == 0:
+            session.model.mark_installed(package_name)
+            logger.log(f"SUCCESS: {package_name} (restored)", level="SUCCESS", device=session)
+        else:
+            logger.log(f"FAILED: {package_name} ({detail})", level="ERROR", device=session)
+        session.status = f"Restoring {index + 1}/{len(package_list)}"
+        if progress:
+            progress(session, index + 1, len(package_list))
+    journal.close()
+    mark_stopped_session(session, results)
+    if session.status not in STOPPED_STATUSES:
+        session.status = "Idle"
+    export_session_metrics(session)
+    logger.log("Restore finished.", level="HEADER", device=session)
+    return results
+
+# --- OPERATION JOURNAL ---
+# Every package operation is appended to journal.jsonl in the device folder,
+# one JSON object per line: time, run id, action, package, result and the
+# build fingerprint. The file is never rewritten. Any run, or any time
+# range, can be replayed (brought back to the state it left) or reverted
+# (brought back to the state before it). The target states are compared with
+# one 'pm list packages', so packages already there are skipped and a second
+# run is a no-op; the rest go out as one mixed uninstall/install-existing
+# batch. An install-existing that fails falls back to the APK backup.
+JOURNAL_FILE = "journal.jsonl"
+JOURNAL_FLUSH_EVERY = BATCH_CHUNK_SIZE
+JOURNAL_PM_ACTIONS = {"uninstall": "uninstall", "install-existing": "install"}
+JOURNAL_STATES = {"uninstall": "uninstalled", "install": "installed", "restore": "installed"}
+JOURNAL_PM_ARGS = {"uninstalled": ["uninstall", "--user", "0"], "installed": ["install-existing"]}
+
+class JournalRun:
+    """
+    Entries of one run; written in blocks of JOURNAL_FLUSH_EVERY and on close().
+    close() only flushes, so a run shared by a job's attempts may be closed by each.
+    """
+    def __init__(self, journal, origin=None):
+        self.journal = journal
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(2).hex()}"
+        self.origin = origin
+        self.buffer = []
+
+    def record(self, action, package_name, result):
+        session = self.journal.session
+        entry = {"ts": datetime.now().isoformat(timespec="seconds"), "run": self.id, "action": action,
+                 "package": package_name, "success": result["success"], "exit_code": result["exit_code"],
+                 "detail": result["detail"], "serial": session.serial, "fingerprint": session.fingerprint}
+        if self.origin:
+            entry["origin"] = self.origin
+        self.buffer.append(entry)
+        if len(self.buffer) >= JOURNAL_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        entries, self.buffer = self.buffer, []
+        if entries:
+            self.journal.append(entries)
+
+    def close(self):
+        self.flush()
+
+class OperationJournal:
+    _lock = threading.Lock() # Runs on one device may overlap (a restore inside a revert).
+
+    def __init__(self, session):
+        self.session = session
+        self.path = os.path.join(session.folder, JOURNAL_FILE)
+
+    def begin(self, origin=None):
+        if not self.session.fingerprint and not self.session.detached.is_set():
+            self.session.fingerprint, self.session.change_token = read_device_identity(self.session)
+        return JournalRun(self, origin)
+
+    def append(self, entries):
+        try:
+            self.session.ensure_folder()
+            with OperationJournal._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.log(f"Could not write {JOURNAL_FILE}: {e}", level="ERROR", device=self.session)
+
+    def entries(self):
+        """All entries in write order; a torn last line (crash mid-write) is skipped."""
+        entries = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try: entries.append(json.loads(line))
+                    except ValueError: pass
+        except OSError:
+            pass
+        return entries
+
+    def runs(self, entries=None):
+        """[{"run", "started", "ended", "actions", "ok", "failed", "origin"}], oldest first."""
+        runs = collections.OrderedDict()
+        for entry in self.entries() if entries is None else entries:
+            run = runs.get(entry["run"])
+            if run is None:
+                run = runs[entry["run"]] = {"run": entry["run"], "started": entry["ts"], "actions": [], "ok": 0, "failed": 0,
+                                            "origin": entry.get("origin")}
+            run["ended"] = entry["ts"]
+            if entry["action"] not in run["actions"]:
+                run["actions"].append(entry["action"])
+            run["ok" if entry["success"] else "failed"] += 1
+        return list(runs.values())
+
+    def select(self, runs=None, since=None, until=None):
+        """Entries of the given run ids ("last" = newest run), within [since, until] (ISO timestamps)."""
+        entries = self.entries()
+        if runs:
+            runs = set(runs)
+            if "last" in runs and entries:
+                runs.add(entries[-1]["run"])
+            entries = [entry for entry in entries if entry["run"] in runs]
+        if since:
+            entries = [entry for entry in entries if entry["ts"] >= since]
+        if until:
+            entries = [entry for entry in entries if entry["ts"] <= until]
+        return entries
+
+def journal_for(session, job=None, origin=None):
+    """The job's run (one per job, across its retries), else a new run of its own."""
+    if job is not None and job.journal is not None:
+        return job.journal
+    return OperationJournal(session).begin(origin)
+
+def journal_targets(entries, mode):
+    """
+    {package: "installed" | "uninstalled"} from successful entries. replay:
+    the state the entries left each package in (last entry wins). revert:
+    the state before them (inverse of the first entry).
+    """
+    targets = {}
+    for entry in entries:
+        state = JOURNAL_STATES.get(entry.get("action"))
+        if not entry.get("success") or state is None:
+            continue
+        package_name = entry["package"]
+        if mode == "replay":
+            targets[package_name] = state
+        elif package_name not in targets:
+            targets[package_name] = "uninstalled" if state == "installed" else "installed"
+    return targets
+
+def apply_journal(package_list, batch=True, session=None, progress=None, job=None, targets=None, origin=None):
+    """
+    Brings package_list to targets[package] in one batched pass; packages already
+    in their target state are reported as successes without touching the device.
+    """
+    logger.log(f"Starting {origin or 'journal replay'} for {len(package_list)} packages...", level="HEADER", device=session)
+    results = {}
+    installed = set(get_installed_packages_worker(False, session))
+    if not installed:
+        logger.log("ERROR: Could not read installed packages; nothing changed.", level="ERROR", device=session)
+        return {pkg: {"success": False, "exit_code": None, "detail": "Could not read installed packages"} for pkg in package_list}
+    operations = []
+    for package_name in package_list:
+        state = targets[package_name]
+        if (package_name in installed) == (state == "installed"):
+            results[package_name] = {"success": True, "exit_code": 0, "detail": f"Already {state}"}
+        else:
+            operations.append((package_name, JOURNAL_PM_ARGS[state]))
+    logger.log(f"{len(results)} already in target state; {len(operations)} to change.", level="INFO", device=session)
+
+    total, done = len(package_list), len(results)
+    if progress:
+        progress(session, done, total)
+    journal = journal_for(session, job, origin)
+    fallback = []
+    try:
+        for package_name, code, detail in run_pm_batch(operations, chunk_size=BATCH_CHUNK_SIZE if batch else 1,
+                                                       serial=session.serial, job=job):
+            state = targets[package_name]
+            results[package_name] = {"success": code == 0, "exit_code": code, "detail": detail}
+            if code == 0:
+                journal.record("install" if state == "installed" else "uninstall", package_name, results[package_name])
+                (session.model.mark_installed if state == "installed" else session.model.mark_uninstalled)(package_name)
+                logger.log(f"SUCCESS: {package_name} ({state})", level="SUCCESS", device=session)
+            elif state == "installed" and code is not None:
+                fallback.append(package_name) # Recorded below, or by restore_packages if a backup exists.
+            else:
+                journal.record("install" if state == "installed" else "uninstall", package_name, results[package_name])
+                if detail != JOB_CANCELLED_DETAIL:
+                    logger.log(f"FAILED: {package_name} ({detail})", level="ERROR", device=session)
+            done += 1
+            session.status = f"Applying {done}/{total}"
+            if progress:
+                progress(session, done, total)
+
+        if fallback:
+            manifest = load_backup_manifest(session)
+            restorable = [pkg for pkg in fallback if pkg in manifest]
+            for package_name in fallback:
+                if package_name not in manifest:
+                    journal.record("install", package_name, results[package_name])
+                    logger.log(f"FAILED: {package_name} (ADB Error: {results[package_name]['detail']})", level="ERROR", device=session)
+            if restorable:
+                logger.log(f"install-existing failed for {len(restorable)} package(s); restoring them from backup.", level="WARNING", device=session)
+                results.update(restore_packages(restorable, session=session, job=job, journal=journal))
+    finally:
+        journal.close()
+    mark_stopped_session(session, results)
+    if session.status not in STOPPED_STATUSES:
+        session.status = "Idle"
+    export_session_metrics(session)
+    logger.log(f"{(origin or 'Journal replay').capitalize()} finished.", level="HEADER", device=session)
+    return results
+
+# --- JOB SCHEDULER ---
+# Uninstall/install runs are queued as jobs: one queue per device, ordered by
+# priority (lower first) and then submission, with at most JOB_DEVICE_SLOTS
+# jobs running per device and MAX_DEVICE_WORKERS overall. Pause and cancel
+# take effect at the next chunk (batch mode) or package. Packages that fail
+# for transient reasons (timeouts, a dropped shell) are retried with backoff.
+# On shutdown, work that did not finish is written to pending_jobs.json in
+# the device folder so it can be resumed on the next start.
+JOB_DEVICE_SLOTS = 1
+JOB_RETRIES = 2
+JOB_RETRY_DELAYS = (2, 5)
+JOB_PRIORITY_NORMAL = 10
+JOB_PRIORITY_HIGH = 0
+PENDING_JOBS_FILE = "pending_jobs.json"
+JOB_FINAL_DETAILS = (DEVICE_HUNG_DETAIL, DEVICE_GONE_DETAIL, JOB_CANCELLED_DETAIL, BACKUP_FAILED_DETAIL, "Invalid package name")
+JOB_ACTIONS = {"uninstall": uninstall_packages, "install": install_existing_packages, "restore": restore_packages,
+               "revert": apply_journal, "replay": apply_journal}
+
+def is_transient_failure(result):
+    """A package worth retrying: it never reported an exit code, for a reason other than a stop."""
+    return result["exit_code"] is None and result["detail"] not in JOB_FINAL_DETAILS
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, session, action, packages, batch=True, priority=JOB_PRIORITY_NORMAL, on_done=None, options=None):
+        self.id = next(Job._ids)
+        self.session = session
+        self.action = action
+        self.packages = list(dict.fromkeys(packages))
+        self.batch = batch
+        self.options = dict(options or {}) # Extra keyword arguments for the action, e.g. backup=True.
+        self.priority = priority
+        self.on_done = on_done
+        self.state = "Queued"
+        self.results = {}
+        self.done = 0
+        self.attempt = 0
+        self.cancelled = threading.Event()
+        self.running = threading.Event() # Cleared while paused.
+        self.running.set()
+        self.started = None
+        self.finished = None
+        self.paused_for = 0.0
+        self.base = 0 # Packages settled before the current attempt.
+        self.on_progress = None
+        self.stopped_for_shutdown = False # Cancelled by JobScheduler.stop(), so its rest is worth saving.
+        self.journal = None # JournalRun shared by every attempt, so a retried job is one run in History.
+
+    @property
+    def total(self):
+        return len(self.packages)
+
+    @property
+    def failed(self):
+        return sum(1 for r in self.results.values() if not r["success"] and r["detail"] != JOB_CANCELLED_DETAIL)
+
+    @property
+    def active(self):
+        return self.state in ("Queued", "Running", "Paused")
+
+    def checkpoint(self):
+        """Called between chunks/packages: blocks while paused; False once cancelled."""
+        if not self.running.is_set():
+            paused_at = time.monotonic()
+            while not self.running.wait(0.5):
+                if self.cancelled.is_set():
+                    break
+            self.paused_for += time.monotonic() - paused_at
+        return not self.cancelled.is_set()
+
+    def pause(self):
+        if self.state in ("Queued", "Running"):
+            self.running.clear()
+            self.state = "Paused"
+
+    def resume(self):
+        if self.state == "Paused":
+            self.running.set()
+            self.state = "Running" if self.started else "Queued"
+
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()
+        if self.state in ("Queued", "Paused") and not self.started:
+            self.state = "Cancelled"
+
+    def rate(self):
+        """Packages per second over the time spent running (pauses excluded)."""
+        if not self.started or not self.done:
+            return None
+        elapsed = (self.finished or time.monotonic()) - self.started - self.paused_for
+        return self.done / elapsed if elapsed > 0 else None
+
+    def eta(self):
+        rate = self.rate()
+        if rate is None or not self.active:
+            return None
+        return (self.total - self.done) / rate
+
+    def unfinished(self):
+        return [pkg for pkg in self.packages
+                if pkg not in self.results or self.results[pkg]["detail"] == JOB_CANCELLED_DETAIL]
+
+    def _progress(self, session, done, total):
+        self.done = self.base + done
+        if self.on_progress:
+            self.on_progress(session, done, total)
+
+    def run(self, on_progress=None):
+        func = JOB_ACTIONS[self.action]
+        self.on_progress = on_progress
+        self.started = time.monotonic()
+        self.state = "Running" if self.running.is_set() else "Paused"
+        pending = list(self.packages)
+        session = self.session
+        self.journal = OperationJournal(session).begin(self.options.get("origin"))
+        try:
+            while True:
+                self.base = self.total - len(pending)
+                results = func(pending, batch=self.batch, session=session, progress=self._progress, job=self, **self.options)
+                self.results.update(results)
+                retry = [pkg for pkg in pending if pkg in results and is_transient_failure(results[pkg])]
+                if not retry or self.attempt >= JOB_RETRIES or self.cancelled.is_set() or session.status in STOPPED_STATUSES:
+                    break
+                delay = JOB_RETRY_DELAYS[min(self.attempt, len(JOB_RETRY_DELAYS) - 1)]
+                self.attempt += 1
+                logger.log(f"Retrying {len(retry)} package(s) after transient failures (attempt {self.attempt + 1}) in {delay}s.",
+                           level="WARNING", device=session)
+                if self.cancelled.wait(delay):
+                    break
+                pending = retry
+        finally:
+            self.journal.close()
+        self.done = sum(1 for r in self.results.values() if r["detail"] != JOB_CANCELLED_DETAIL)
+        self.finished = time.monotonic()
+        if self.cancelled.is_set():
+            self.state = "Cancelled"
+            logger.log(f"Job {self.id} cancelled; {len(self.unfinished())} package(s) not run.", level="WARNING", device=session)
+        elif session.status in STOPPED_STATUSES:
+            self.state = "Stopped"
+        else:
+            self.state = "Done"
+        return self.results
+
+class JobScheduler:
+    def __init__(self, max_workers=MAX_DEVICE_WORKERS, per_device=JOB_DEVICE_SLOTS, on_progress=None):
+        self.max_workers = max_workers
+        self.per_device = per_device
+        self.on_progress = on_progress
+        self.jobs = []
+        self.queues = {} # serial -> heap of (priority, seq, job)
+        self.running = {} # serial -> set of running jobs
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.accepting = True
+
+    def submit(self, job):
+        with self.lock:
+            if not self.accepting:
+                return None
+            self.jobs.append(job)
+            heapq.heappush(self.queues.setdefault(job.session.serial, []), (job.priority, next(self.seq), job))
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        # Caller holds self.lock.
+        busy = sum(len(jobs) for jobs in self.running.values())
+        for serial, heap in self.queues.items():
+            running = self.running.setdefault(serial, set())
+            while heap and busy < self.max_workers and len(running) < self.per_device:
+                job = heap[0][2]
+                if job.state == "Cancelled":
+                    heapq.heappop(heap)
+                    continue
+                if job.state == "Paused" and not job.started:
+                    break # A paused head keeps the jobs behind it waiting, in order.
+                heapq.heappop(heap)
+                running.add(job)
+                busy += 1
+                thread = threading.Thread(target=self._run, args=(job,), daemon=True)
+                self.threads.add(thread)
+                thread.start()
+
+    def _run(self, job):
+        try:
+            job.run(self.on_progress)
+        except Exception as e:
+            job.state = "Failed"
+            job.finished = time.monotonic()
+            logger.log(f"ERROR: Job {job.id} failed ({str(e)})", level="ERROR", device=job.session)
+        finally:
+            with self.lock:
+                self.running[job.session.serial].discard(job)
+                self.threads.discard(threading.current_thread())
+                self._dispatch()
+        if job.on_done:
+            job.on_done(job)
+
+    def _requeue(self, job):
+        with self.lock:
+            heap = self.queues.get(job.session.serial, [])
+            for index, entry in enumerate(heap):
+                if entry[2] is job:
+                    heap[index] = (job.priority, entry[1], job)
+                    heapq.heapify(heap)
+                    break
+            self._dispatch()
+
+    def prioritize(self, job, priority=JOB_PRIORITY_HIGH):
+        job.priority = priority
+        self._requeue(job)
+
+    def pause(self, job):
+        job.pause()
+
+    def resume(self, job):
+        job.resume()
+        self._requeue(job)
+
+    def cancel(self, job):
+        job.cancel()
+        self._requeue(job)
+
+    def active_jobs(self):
+        return [job for job in self.jobs if job.active]
+
+    def busy(self):
+        with self.lock:
+            return any(self.running.values())
+
+    def progress(self):
+        """(done, total, packages per second, eta seconds) across jobs still queued or running."""
+        jobs = self.active_jobs()
+        done = sum(job.done for job in jobs)
+        total = sum(job.total for job in jobs)
+        rates = [job.rate() for job in jobs if job.state == "Running" and job.rate()]
+        rate = sum(rates) if rates else None
+        eta = (total - done) / rate if rate else None
+        return done, total, rate, eta
+
+    def stop(self):
+        """Stops accepting jobs and cancels every job; running ones stop at their next checkpoint."""
+        with self.lock:
+            self.accepting = False
+            jobs = list(self.jobs)
+        for job in jobs:
+            if job.active:
+                job.stopped_for_shutdown = True
+                job.cancel()
+
+    def drain(self):
+        """Stops accepting jobs; queued and running ones carry on, paused ones are resumed."""
+        with self.lock:
+            self.accepting = False
+            paused = [job for job in self.jobs if job.state == "Paused"]
+        for job in paused:
+            self.resume(job)
+
+    def save_pending(self):
+        """
+        Writes unfinished work to each device's pending_jobs.json; returns the package count.
+        Jobs the user cancelled are left out: only jobs stopped for shutdown or still active count.
+        """
+        pending = {}
+        for job in self.jobs:
+            packages = job.unfinished() if job.active or job.stopped_for_shutdown else []
+            if packages:
+                pending.setdefault(job.session, []).append({"action": job.action, "batch": job.batch, "options": job.options,
+                                                            "packages": packages})
+        count = 0
+        for session, entries in pending.items():
+            session.ensure_folder()
+            try:
+                with open(os.path.join(session.folder, PENDING_JOBS_FILE), "w", encoding="utf-8") as f:
+                    json.dump({"serial": session.serial, "saved_at": datetime.now().isoformat(timespec="seconds"),
+                               "jobs": entries}, f, indent=2)
+                count += sum(len(entry["packages"]) for entry in entries)
+            except OSError as e:
+                logger.log(f"Could not save pending jobs: {e}", level="ERROR", device=session)
+        return count
+
+def load_pending_jobs(session):
+    """Reads and removes a device's pending_jobs.json; returns [{"action", "batch", "packages"}]."""
+    path = os.path.join(session.folder, PENDING_JOBS_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        os.remove(path)
+    except (OSError, ValueError):
+        return []
+    if data.get("serial") != session.serial:
+        return []
+    return [entry for entry in data.get("jobs", []) if entry.get("action") in JOB_ACTIONS and entry.get("packages")]
+
+def read_package_list(file_path):
+    """Package names from a list file (one per line, '#' comments); raises OSError if unreadable."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+def load_package_list(file_path):
+    try:
+        package_list = read_package_list(file_path)
+    except Exception as e:
+        logger.log(f"Error reading file: {e}", level="ERROR")
+        show_error("Error", str(e))
+        return []
+    logger.log(f"Loaded {len(package_list)} packages from {os.path.basename(file_path)}.", level="HEADER")
+    return package_list
+
+def get_installed_packages_worker(all_packages, session=None):
+    cmd = adb_command(session.serial if session else None, "shell", "pm", "list", "packages")
+    if all_packages:
+        cmd.append("-a")
+    try:
+        stream = CommandStream(cmd, 10)
+        packages = [line.replace("package:", "").strip() for line in stream if line.strip()]
+        return packages if stream.exit_code == 0 else []
+    except Exception:
+        return []
+
+def save_packages_to_file(packages, filename, folder=None):
+    folder = folder or device_folder
+    full_path = os.path.join(folder, filename)
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with open(full_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(packages))
+    except Exception: pass
+
+# --- PACKAGE FILTER ENGINE ---
+# Built once per fetch. Names are lower-cased up front and indexed by
+# trigram, so a query only verifies the ids that share all of its trigrams.
+# Query syntax: space separated terms that must all match; "-term" excludes,
+# "re:expr" or "/expr/" is a regex, and a term with * ? or [ is a glob.
+# Plain and glob terms are lower-cased; a regex keeps its text as typed
+# (\D is not \d) and is matched case-insensitively.
+FILTER_DEBOUNCE_MS = 150
+GLOB_CHARS_RE = re.compile(r'\[[^\]]*\]|[*?]')
+
+class PackageFilter:
+    def __init__(self, packages):
+        self.names = list(dict.fromkeys(packages))
+        self.lowered = [name.lower() for name in self.names]
+        self.position = {name: i for i, name in enumerate(self.names)}
+        grams = {}
+        for i, name in enumerate(self.lowered):
+            for gram in {name[j:j + 3] for j in range(len(name) - 2)}:
+                grams.setdefault(gram, set()).add(i)
+        self.trigrams = {gram: frozenset(ids) for gram, ids in grams.items()}
+        self.error = None
+        self._last = None
+
+    @staticmethod
+    def parse(query):
+        terms = []
+        for raw in query.split():
+            negate = raw.startswith("-") and len(raw) > 1
+            text = raw[1:] if negate else raw
+            if text[:3].lower() == "re:":
+                kind, text = "regex", text[3:]
+            elif len(text) > 2 and text.startswith("/") and text.endswith("/"):
+                kind, text = "regex", text[1:-1]
+            elif GLOB_CHARS_RE.search(text):
+                kind, text = "glob", text.lower()
+            else:
+                kind, text = "plain", text.lower()
+            if text:
+                terms.append((negate, kind, text))
+        return terms
+
+    def _ngram_candidates(self, literals, candidates):
+        postings = []
+        for literal in literals:
+            for j in range(len(literal) - 2):
+                posting = self.trigrams.get(literal[j:j + 3])
+                if posting is None:
+                    return set()
+                postings.append(posting)
+        if not postings:
+            return set(range(len(self.names))) if candidates is None else set(candidates)
+        postings.sort(key=len)
+        result = set(postings[0]) if candidates is None else candidates & postings[0]
+        for posting in postings[1:]:
+            if not result:
+                break
+            result &= posting
+        return result
+
+    def _match(self, kind, text, candidates):
+        lowered = self.lowered
+        if kind == "plain":
+            ids = self._ngram_candidates([text], candidates)
+            return {i for i in ids if text in lowered[i]}
+        if kind == "glob":
+            literals = [part for part in GLOB_CHARS_RE.split(text) if len(part) >= 3]
+            matcher = re.compile(fnmatch.translate(text))
+            ids = self._ngram_candidates(literals, candidates)
+            return {i for i in ids if matcher.match(lowered[i])}
+        matcher = re.compile(text, re.IGNORECASE)
+        names = self.names
+        ids = range(len(names)) if candidates is None else candidates
+        return {i for i in ids if matcher.search(names[i])}
+
+    def _narrows(self, terms):
+        # A longer query may start from the previous result only when every
+        # earlier term is unchanged and the last one is a plain term that grew.
+        if self._last is None:
+            return False
+        last_terms = self._last[0]
+        if not last_terms or len(terms) < len(last_terms):
+            return False
+        if terms[:len(last_terms) - 1] != last_terms[:-1]:
+            return False
+        old, new = last_terms[-1], terms[len(last_terms) - 1]
+        if old == new:
+            return True
+        return old[:2] == new[:2] == (False, "plain") and old[2] in new[2]
+
+    def query(self, query):
+        """Returns matching names in original order, or None for an empty query."""
+        self.error = None
+        terms = self.parse(query)
+        if not terms:
+            self._last = None
+            return None
+
+        candidates = set(self._last[1]) if self._narrows(terms) else None
+        try:
+            for negate, kind, text in sorted(terms, key=lambda t: (t[0], t[1] == "regex")):
+                if negate:
+                    if candidates is None:
+                        candidates = set(range(len(self.names)))
+                    candidates -= self._match(kind, text, candidates)
+                else:
+                    candidates = self._match(kind, text, candidates)
+                if not candidates:
+                    break
+        except re.error as e:
+            self.error = str(e)
+            self._last = None
+            return []
+
+        ids = sorted(candidates)
+        self._last = (terms, ids)
+        return [self.names[i] for i in ids]
+
+def filter_rows(source, engine, query, position=None):
+    """
+    Rows of source matching query, kept in source order. engine must index
+    every name in source. position maps each package to its index in
+    source; pass it in to avoid rebuilding it.
+    """
+    matches = engine.query(query)
+    if matches is None:
+        return list(source)
+    if position is None:
+        position = {pkg: i for i, pkg in enumerate(source)}
+    return sorted((pkg for pkg in matches if pkg in position), key=position.__getitem__)
+
+# --- DEBLOAT PROFILES ---
+# A profile is a package list with rules. One rule per line:
+#   com.facebook.katana        exact name
+#   com.miui.*                 glob (* ? [...])
+#   re:^com\.(oem|vendor)\.   or /regex/   regex, searched anywhere in the name
+#   vendor:com.samsung         the name itself and everything below it
+#   -com.samsung.android.app   a leading "-" turns any rule into an exclude
+#   include base.txt           rules of another profile (relative to this file)
+# "#" starts a comment. A plain package list is a valid profile. Files are
+# read line by line and compiled once: exact names into a dict, vendor
+# prefixes (and "prefix.*" globs) into a trie over the dotted segments, and
+# the remaining globs and regexes into one combined regex that rejects most
+# names in a single search before the matching rule is looked up.
+PROFILE_INCLUDE_RE = re.compile(r'^(?:include|@include)\s+(.+)$')
+
+class ProfileRules:
+    """One compiled side of a profile (the includes or the excludes)."""
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.patterns = [] # (compiled, source, reason)
+        self.combined = None
+
+    def __len__(self):
+        return len(self.exact) + self._trie_size(self.trie) + len(self.patterns)
+
+    @classmethod
+    def _trie_size(cls, node):
+        return sum(1 if key in ("", "*") else cls._trie_size(child) for key, child in node.items())
+
+    def add_prefix(self, prefix, reason, below_only=False):
+        node = self.trie
+        for part in prefix.split("."):
+            node = node.setdefault(part, {})
+        node.setdefault("*" if below_only else "", reason)
+
+    def add_pattern(self, source, reason):
+        self.patterns.append((re.compile(source), source, reason))
+
+    def add(self, kind, text, reason):
+        if kind == "exact":
+            self.exact.setdefault(text, reason)
+        elif kind == "vendor":
+            self.add_prefix(text.rstrip("."), reason)
+        elif kind == "glob":
+            head = text[:-2]
+            if text.endswith(".*") and head and not GLOB_CHARS_RE.search(head):
+                self.add_prefix(head, reason, below_only=True)
+            else:
+                self.add_pattern("^" + fnmatch.translate(text), reason)
+        else:
+            self.add_pattern(text, reason)
+
+    def compile(self):
+        self.combined = None
+        if len(self.patterns) > 1:
+            try:
+                self.combined = re.compile("|".join(f"(?:{source})" for _, source, _ in self.patterns))
+            except re.error:
+                pass # e.g. numbered backreferences; fall back to one search per pattern.
+
+    def reason(self, name):
+        """The reason of the first rule matching name, or None."""
+        reason = self.exact.get(name)
+        if reason is not None:
+            return reason
+        node = self.trie
+        parts = name.split(".")
+        for depth, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if "" in node:
+                return node[""]
+            if "*" in node and depth + 1 < len(parts):
+                return node["*"]
+        if self.patterns and (self.combined is None or self.combined.search(name)):
+            for matcher, _, reason in self.patterns:
+                if matcher.search(name):
+                    return reason
+        return None
+
+class DebloatProfile:
+    def __init__(self):
+        self.rules = ProfileRules()
+        self.excludes = ProfileRules()
+        self.files = []
+        self.errors = []
+
+    @staticmethod
+    def parse_rule(text):
+        """Returns (exclude, kind, text) for one rule."""
+        exclude = text.startswith("-") and len(text) > 1
+        if exclude:
+            text = text[1:].strip()
+        if text.startswith("re:"):
+            return exclude, "regex", text[3:]
+        if len(text) > 2 and text.startswith("/") and text.endswith("/"):
+            return exclude, "regex", text[1:-1]
+        if text.startswith("vendor:"):
+            return exclude, "vendor", text[7:].strip()
+        if GLOB_CHARS_RE.search(text):
+            return exclude, "glob", text
+        return exclude, "exact", text
+
+    @classmethod
+    def load(cls, path):
+        profile = cls()
+        profile.read(path)
+        profile.rules.compile()
+        profile.excludes.compile()
+        return profile
+
+    def read(self, path, seen=None):
+        """Streams one profile file (and its includes) into the rule sets."""
+        path = os.path.abspath(path)
+        seen = set() if seen is None else seen
+        if path in seen:
+            self.errors.append(f"{os.path.basename(path)}: include cycle skipped")
+            return
+        seen.add(path)
+        self.files.append(path)
+        base = os.path.basename(path)
+        with open(path, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                text = line.split("#", 1)[0].strip()
+                if not text:
+                    continue
+                include = PROFILE_INCLUDE_RE.match(text)
+                if include:
+                    target = os.path.join(os.path.dirname(path), include.group(1).strip())
+                    try:
+                        self.read(target, seen)
+                    except OSError as e:
+                        self.errors.append(f"{base}:{number}: {e}")
+                    continue
+                exclude, kind, rule = self.parse_rule(text)
+                if not rule:
+                    continue
+                try:
+                    (self.excludes if exclude else self.rules).add(kind, rule, f"{base}:{number} {text}")
+                except re.error as e:
+                    self.errors.append(f"{base}:{number}: bad pattern '{rule}' ({e})")
+        seen.discard(path) # Diamond includes are fine; only cycles are not.
+
+    def evaluate(self, packages):
+        """
+        One pass over packages. Returns ({name: reason} of the selected
+        packages in input order, {name: reason} of those an exclude dropped).
+        """
+        selected, excluded = {}, {}
+        rule_reason = self.rules.reason
+        excludes = self.excludes
+        exclude_reason = excludes.reason if excludes.exact or excludes.trie or excludes.patterns else None
+        for name in packages:
+            reason = rule_reason(name)
+            if reason is None:
+                continue
+            dropped = exclude_reason(name) if exclude_reason else None
+            if dropped is None:
+                selected[name] = reason
+            else:
+                excluded[name] = dropped
+        return selected, excluded
+
+def load_profile(file_path):
+    """DebloatProfile.load with the GUI/CLI error reporting of load_package_list; None on failure."""
+    try:
+        profile = DebloatProfile.load(file_path)
+    except Exception as e:
+        logger.log(f"Error reading file: {e}", level="ERROR")
+        show_error("Error", str(e))
+        return None
+    for error in profile.errors:
+        logger.log(f"Profile: {error}", level="WARNING")
+    logger.log(f"Loaded profile {os.path.basename(file_path)}: {len(profile.rules)} rules, {len(profile.excludes)} excludes"
+               + (f" from {len(profile.files)} files." if len(profile.files) > 1 else "."), level="HEADER")
+    return profile
+
+# --- PERSISTENT PACKAGE CACHE ---
+# package_cache.json in each device folder holds the last listing together
+# with the build fingerprint and a cheap change token (mtime of
+# packages.xml where the shell may stat it, plus the installed count).
+# A different fingerprint throws the cache away; a matching token means
+# the cached listing is still current and the full fetch can be skipped.
+PACKAGE_CACHE_FILE = "package_cache.json"
+IDENTITY_COMMAND = ("getprop ro.build.fingerprint; "
+                    "stat -c %Y /data/system/packages.xml 2>/dev/null || echo -; "
+                    "pm list packages | wc -l")
+
+def read_device_identity(session):
+    """Returns (fingerprint, change_token) for a device, or (None, None)."""
+    try:
+        code, out, err = run_with_timeout(session.adb("shell", IDENTITY_COMMAND), 10, kind="identity")
+    except Exception:
+        return None, None
+    lines = [line.strip() for line in out.splitlines()]
+    if code != 0 or len(lines) < 3 or not lines[0]:
+        return None, None
+    return lines[0], f"{lines[1]}:{lines[2]}"
+
+def load_package_cache(session):
+    try:
+        with open(os.path.join(session.folder, PACKAGE_CACHE_FILE), "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except Exception:
+        return None
+    if cache.get("serial") != session.serial:
+        return None
+    return cache
+
+def save_package_cache(session, installed, all_packages, records=None):
+    if not session.fingerprint:
+        return
+    cache = {
+        "serial": session.serial,
+        "fingerprint": session.fingerprint,
+        "token": session.change_token,
+        "saved_at": datetime.now().isoformat(timespec="seconds"),
+        "installed": installed,
+        "all": all_packages,
+        "records": [record.to_list() for record in (records or {}).values()],
+    }
+    path = os.path.join(session.folder, PACKAGE_CACHE_FILE)
+    try:
+        session.ensure_folder()
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(path + ".tmp", path)
+    except Exception: pass
+
+# --- SNAPSHOT STORE ---
+# Every fetched inventory is kept in snapshots.db (SQLite) in the device
+# folder. Package names are interned to integer ids, and each distinct
+# inventory (installed + all id sets, delta-encoded and compressed) is
+# stored once however many snapshots point at it, so refreshing an
+# unchanged phone only adds one small row.
+SNAPSHOT_DB_FILE = "snapshots.db"
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS inventories (
+    id INTEGER PRIMARY KEY, digest TEXT UNIQUE NOT NULL,
+    installed BLOB NOT NULL, all_packages BLOB NOT NULL,
+    installed_count INTEGER NOT NULL, all_count INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY, serial TEXT, taken_at TEXT NOT NULL, fingerprint TEXT,
+    inventory_id INTEGER NOT NULL REFERENCES inventories(id));
+"""
+
+class SnapshotStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, SNAPSHOT_DB_FILE)
+
+    def _connect(self):
+        os.makedirs(self.folder, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=10)
+        db.executescript(SNAPSHOT_SCHEMA)
+        return db
+
+    @staticmethod
+    def _pack(ids):
+        ordered = sorted(ids)
+        deltas = array.array("I", (b - a for a, b in zip([0] + ordered, ordered)))
+        return zlib.compress(deltas.tobytes())
+
+    @staticmethod
+    def _unpack(blob):
+        deltas = array.array("I")
+        deltas.frombytes(zlib.decompress(blob))
+        return set(itertools.accumulate(deltas))
+
+    def record(self, installed, all_packages, fingerprint=None, serial=None):
+        """Stores one inventory; returns the new snapshot id."""
+        installed, all_packages = set(installed), set(all_packages)
+        with closing(self._connect()) as db, db:
+            ids = dict(db.execute("SELECT name, id FROM packages"))
+            unknown = (installed | all_packages) - ids.keys()
+            if unknown:
+                db.executemany("INSERT INTO packages(name) VALUES (?)", ((name,) for name in unknown))
+                ids = dict(db.execute("SELECT name, id FROM packages"))
+            installed_blob = self._pack(ids[name] for name in installed)
+            all_blob = self._pack(ids[name] for name in all_packages)
+            digest = hashlib.sha1(installed_blob + b"|" + all_blob).hexdigest()
+            db.execute("INSERT OR IGNORE INTO inventories(digest, installed, all_packages, installed_count, all_count) "
+                       "VALUES (?, ?, ?, ?, ?)", (digest, installed_blob, all_blob, len(installed), len(all_packages)))
+            inventory_id = db.execute("SELECT id FROM inventories WHERE digest = ?", (digest,)).fetchone()[0]
+            cursor = db.execute("INSERT INTO snapshots(serial, taken_at, fingerprint, inventory_id) VALUES (?, ?, ?, ?)",
+                                (serial, datetime.now().isoformat(timespec="seconds"), fingerprint, inventory_id))
+            return cursor.lastrowid
+
+    def snapshots(self):
+        """Every snapshot, oldest first, as dicts."""
+        if not os.path.exists(self.path):
+            return []
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT s.id, s.taken_at, s.fingerprint, i.installed_count, i.all_count, s.inventory_id "
+                              "FROM snapshots s JOIN inventories i ON i.id = s.inventory_id ORDER BY s.id").fetchall()
+        keys = ("id", "taken_at", "fingerprint", "installed_count", "all_count", "inventory_id")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _id_sets(self, db, snapshot_id):
+        row = db.execute("SELECT i.id, i.installed, i.all_packages FROM snapshots s JOIN inventories i "
+                         "ON i.id = s.inventory_id WHERE s.id = ?", (snapshot_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No snapshot #{snapshot_id}")
+        return row[0], self._unpack(row[1]), self._unpack(row[2])
+
+    @staticmethod
+    def _names(db, ids):
+        names = {}
+        ids = list(ids)
+        for i in range(0, len(ids), 900): # Stay under SQLite's bound-parameter limit.
+            part = ids[i:i + 900]
+            names.update(db.execute(f"SELECT id, name FROM packages WHERE id IN ({','.join('?' * len(part))})", part))
+        return names
+
+    def load(self, snapshot_id):
+        """Returns (installed names, all names) of one snapshot."""
+        with closing(self._connect()) as db:
+            _, installed, all_ids = self._id_sets(db, snapshot_id)
+            names = self._names(db, installed | all_ids)
+        return sorted(names[i] for i in installed), sorted(names[i] for i in all_ids)
+
+    def diff(self, a, b):
+        """What changed from snapshot a to snapshot b, as sorted name lists."""
+        with closing(self._connect()) as db:
+            inv_a, installed_a, all_a = self._id_sets(db, a)
+            inv_b, installed_b, all_b = self._id_sets(db, b)
+            if inv_a == inv_b:
+                changed = set()
+            else:
+                changed = (installed_a ^ installed_b) | (all_a ^ all_b)
+            names = self._names(db, changed)
+        pick = lambda ids: sorted(names[i] for i in ids if i in names)
+        return {
+            "installed_added": pick(installed_b - installed_a),
+            "installed_removed": pick(installed_a - installed_b),
+            "all_added": pick(all_b - all_a),
+            "all_removed": pick(all_a - all_b),
+        }
+
+    def last_ota(self):
+        """(last snapshot before the newest fingerprint change, newest snapshot), or None."""
+        snaps = [snap for snap in self.snapshots() if snap["fingerprint"]]
+        for before, after in zip(reversed(snaps[:-1]), reversed(snaps)):
+            if before["fingerprint"] != after["fingerprint"]:
+                return before["id"], snaps[-1]["id"]
+        return None
+
+def record_snapshot(session, installed, all_packages):
+    try:
+        return SnapshotStore(session.folder).record(installed, all_packages, session.fingerprint, session.serial)
+    except Exception as e:
+        logger.log(f"Could not record snapshot: {e}", level="WARNING", device=session)
+        return None
+
+# --- FLEET COMPARISON ---
+# The latest inventory in every device folder becomes one column of a
+# package x device presence matrix. With NumPy it is a boolean array and
+# every query is a vectorized reduction; without it each device is a
+# Python int used as a bitset (bit i = package i), which keeps the same
+# queries at one big-int operation per device. NumPy is imported on the
+# first FleetMatrix, not at startup.
+_numpy_module = False # Not looked up yet.
+
+def _numpy():
+    """The numpy module, or None if it is not installed; imported once."""
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_module = numpy
+    return _numpy_module
+
+def _bit_count(mask):
+    return bin(mask).count("1")
+
+def _set_bits(mask):
+    """Indexes of the set bits of a non-negative int, lowest first."""
+    bits = bin(mask)[:1:-1]
+    i = bits.find("1")
+    while i != -1:
+        yield i
+        i = bits.find("1", i + 1)
+
+class FleetMatrix:
+    def __init__(self, inventories, use_numpy=None):
+        """inventories: {device label: iterable of package names}."""
+        self.devices = list(inventories)
+        self.packages = sorted(set().union(*map(set, inventories.values()))) if inventories else []
+        self.index = {pkg: i for i, pkg in enumerate(self.packages)}
+        self.np = _numpy() if use_numpy is not False else None
+        self.use_numpy = self.np is not None
+        if self.use_numpy:
+            self.matrix = self.np.zeros((len(self.packages), len(self.devices)), dtype=bool)
+            for col, names in enumerate(inventories.values()):
+                self.matrix[[self.index[pkg] for pkg in names], col] = True
+        else:
+            self.columns = [self._bitset(self.index[pkg] for pkg in names) for names in inventories.values()]
+
+    @classmethod
+    def load(cls, root=None, installed=True):
+        """Builds the matrix from every device folder under root that has a package cache."""
+        root = root or application_path
+        inventories = {}
+        for entry in sorted(os.listdir(root)):
+            try:
+                with open(os.path.join(root, entry, PACKAGE_CACHE_FILE), "r", encoding="utf-8") as f:
+                    cache = json.load(f)
+            except Exception:
+                continue
+            inventories[entry] = cache["installed" if installed else "all"]
+        return cls(inventories)
+
+    def _mask_of(self, names):
+        """Profile as the backend's vector type (bool array or int bitset)."""
+        ids = [self.index[pkg] for pkg in names if pkg in self.index]
+        if self.use_numpy:
+            mask = self.np.zeros(len(self.packages), dtype=bool)
+            mask[ids] = True
+            return mask
+        return self._bitset(ids)
+
+    def _bitset(self, ids):
+        # Set bits in a bytearray and convert once; OR-ing 1 << i into a big int is quadratic.
+        bits = bytearray((len(self.packages) + 7) // 8)
+        for i in ids:
+            bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, "little")
+
+    def _names_of(self, mask):
+        if self.use_numpy:
+            return [self.packages[i] for i in self.np.flatnonzero(mask)]
+        return [self.packages[i] for i in _set_bits(mask)]
+
+    def _count_planes(self):
+        # Bit-sliced adder: planes[k] holds bit k of every package's count,
+        # so adding a device costs a few big-int operations, not one per package.
+        planes = []
+        for mask in self.columns:
+            carry, k = mask, 0
+            while carry:
+                if k == len(planes):
+                    planes.append(0)
+                planes[k], carry = planes[k] ^ carry, planes[k] & carry
+                k += 1
+        return planes
+
+    def presence_counts(self):
+        """{package: number of devices that have it}."""
+        if self.use_numpy:
+            return dict(zip(self.packages, self.matrix.sum(axis=1).tolist()))
+        counts = [0] * len(self.packages)
+        for k, plane in enumerate(self._count_planes()):
+            for i in _set_bits(plane):
+                counts[i] += 1 << k
+        return dict(zip(self.packages, counts))
+
+    def majority(self, threshold=0.5):
+        """Packages present on more than threshold of the devices."""
+        need = int(threshold * len(self.devices)) + 1 # Smallest count above threshold * devices.
+        if self.use_numpy:
+            return self._names_of(self.matrix.sum(axis=1) >= need)
+        # count >= need, compared on the bit planes from the top bit down.
+        planes = self._count_planes()
+        if need >> len(planes):
+            return []
+        full = (1 << len(self.packages)) - 1
+        greater, equal = 0, full
+        for k in range(len(planes) - 1, -1, -1):
+            if need >> k & 1:
+                equal &= planes[k]
+            else:
+                greater |= equal & planes[k]
+                equal &= full ^ planes[k]
+        return self._names_of(greater | equal)
+
+    def differing(self):
+        """Packages that some, but not all, devices have."""
+        if self.use_numpy:
+            return self._names_of(self.matrix.any(axis=1) & ~self.matrix.all(axis=1))
+        any_mask, all_mask = 0, (1 << len(self.packages)) - 1
+        for mask in self.columns:
+            any_mask |= mask
+            all_mask &= mask
+        return self._names_of(any_mask & ~all_mask)
+
+    def deviations(self, profile=None):
+        """
+        {device: {"extra": [...], "missing": [...]}} against profile (names;
+        default: the majority). Profile packages no device has are missing everywhere.
+        """
+        profile = set(self.majority() if profile is None else profile)
+        unknown = sorted(pkg for pkg in profile if pkg not in self.index)
+        golden = self._mask_of(profile)
+        result = {}
+        if self.use_numpy:
+            extra = self.matrix & ~golden[:, None]
+            missing = golden[:, None] & ~self.matrix
+            for col, device in enumerate(self.devices):
+                result[device] = {"extra": self._names_of(extra[:, col]), "missing": self._names_of(missing[:, col]) + unknown}
+        else:
+            for device, mask in zip(self.devices, self.columns):
+                result[device] = {"extra": self._names_of(mask & ~golden), "missing": self._names_of(golden & ~mask) + unknown}
+        return result
+
+    def deviation_scores(self, profile=None):
+        """{device: number of packages that differ from profile (default: the majority)}."""
+        profile = set(self.majority() if profile is None else profile)
+        unknown = sum(1 for pkg in profile if pkg not in self.index)
+        golden = self._mask_of(profile)
+        if self.use_numpy:
+            scores = (self.matrix ^ golden[:, None]).sum(axis=0).tolist()
+        else:
+            scores = [_bit_count(mask ^ golden) for mask in self.columns]
+        return {device: score + unknown for device, score in zip(self.devices, scores)}
+
+    def outliers(self, profile=None, factor=3.0):
+        """
+        Devices whose deviation score is far above the fleet's typical one
+        (median + factor * median absolute deviation), worst first.
+        """
+        scores = self.deviation_scores(profile)
+        if not scores:
+            return []
+        ordered = sorted(scores.values())
+        median = ordered[len(ordered) // 2]
+        spread = sorted(abs(v - median) for v in ordered)[len(ordered) // 2]
+        limit = median + factor * max(spread, 1)
+        return sorted(((d, v) for d, v in scores.items() if v > limit), key=lambda item: -item[1])
+
+    def rows(self, packages=None):
+        """[(package, [present per device])] for the matrix view and CSV export."""
+        result = []
+        for pkg in packages if packages is not None else self.packages:
+            i = self.index[pkg]
+            if self.use_numpy:
+                result.append((pkg, self.matrix[i].tolist()))
+            else:
+                result.append((pkg, [bool(mask >> i & 1) for mask in self.columns]))
+        return result
+
+    def export_csv(self, path, packages=None):
+        import csv
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["package", "devices_with_it"] + self.devices)
+            for pkg, present in self.rows(packages):
+                writer.writerow([pkg, sum(present)] + [int(flag) for flag in present])
+
+    def to_json(self, profile=None):
+        return {
+            "devices": self.devices,
+            "packages": len(self.packages),
+            "backend": "numpy" if self.use_numpy else "bitset",
+            "differing": self.differing(),
+            "deviation_scores": self.deviation_scores(profile),
+            "outliers": [device for device, _ in self.outliers(profile)],
+            "deviations": self.deviations(profile),
+        }
+
+# --- PACKAGE INVENTORY ---
+# One 'adb shell' round trip returns every package with its APK path,
+# installer, uid, system flag, enabled state and whether it is installed
+# for user 0, plus the identity lines used by the package cache. Sections
+# are separated by marker lines and parsed line by line as they arrive.
+INVENTORY_MARK = "@@ASM:"
+INVENTORY_COMMAND = "; ".join([
+    f"echo {INVENTORY_MARK}identity",
+    "getprop ro.build.fingerprint",
+    "stat -c %Y /data/system/packages.xml 2>/dev/null || echo -",
+    f"echo {INVENTORY_MARK}all",
+    "pm list packages -f -i -U -u 2>/dev/null || pm list packages -f -i -u",
+    f"echo {INVENTORY_MARK}installed",
+    "pm list packages",
+    f"echo {INVENTORY_MARK}disabled",
+    "pm list packages -d",
+    f"echo {INVENTORY_MARK}system",
+    "pm list packages -s -u",
+])
+
+class PackageRecord:
+    __slots__ = ("name", "path", "installer", "uid", "system", "enabled", "installed")
+
+    def __init__(self, name, path=None, installer=None, uid=None):
+        self.name = name
+        self.path = path
+        self.installer = installer
+        self.uid = uid
+        self.system = False
+        self.enabled = True
+        self.installed = False
+
+    def to_list(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values):
+        record = cls(values[0])
+        for field, value in zip(cls.__slots__, values):
+            setattr(record, field, value)
+        return record
+
+class InventoryParser:
+    """Incremental parser for INVENTORY_COMMAND output; feed it one line at a time."""
+    def __init__(self):
+        self.records = {}
+        self.identity = []
+        self.section = None
+
+    def _record(self, name):
+        record = self.records.get(name)
+        if record is None:
+            record = self.records[name] = PackageRecord(name)
+        return record
+
+    def feed(self, line):
+        line = line.strip()
+        if line.startswith(INVENTORY_MARK):
+            self.section = line[len(INVENTORY_MARK):]
+            return
+        if self.section == "identity":
+            self.identity.append(line)
+            return
+        if not line.startswith("package:"):
+            return
+
+        fields = line[len("package:"):].split()
+        if not fields:
+            return
+        if self.section == "all":
+            path, _, name = fields[0].rpartition("=")
+            record = self._record(name)
+            record.path = path or None
+            for extra in fields[1:]:
+                if extra.startswith("installer="):
+                    installer = extra[len("installer="):]
+                    record.installer = None if installer == "null" else installer
+                elif extra.startswith("uid:"):
+                    record.uid = extra[len("uid:"):]
+        elif self.section == "installed":
+            self._record(fields[0]).installed = True
+        elif self.section == "disabled":
+            self._record(fields[0]).enabled = False
+        elif self.section == "system":
+            self._record(fields[0]).system = True
+
+    def installed_names(self):
+        return [name for name, record in self.records.items() if record.installed]
+
+    def all_names(self):
+        return list(self.records)
+
+    def identity_pair(self):
+        """Returns (fingerprint, change_token) in the format of read_device_identity."""
+        if len(self.identity) < 2 or not self.identity[0]:
+            return None, None
+        return self.identity[0], f"{self.identity[1]}:{len(self.installed_names())}"
+
+def fetch_inventory(session, timeout_sec=30):
+    """Runs the single-pass inventory on one device; returns an InventoryParser."""
+    parser = InventoryParser()
+    stream = CommandStream(session.adb("shell", INVENTORY_COMMAND), timeout_sec, kind="inventory")
+    for line in stream:
+        parser.feed(line)
+    if not parser.records and stream.exit_code != 0:
+        raise RuntimeError("\n".join(stream.stderr_tail).strip() or f"inventory exited with {stream.exit_code}")
+    return parser
+
+def fetch_session_packages(session, use_cache=False, on_cached=None):
+    """
+    Lists installed and all packages for one device and stores them on its session.
+    With use_cache, a cached listing for the same build is applied first (and
+    on_cached(session) called) so the UI can show it before the device answers.
+    """
+    session.status = "Fetching"
+    if use_cache:
+        # The cache is keyed by serial, so it is shown before the device is
+        # asked anything; the identity read afterwards decides whether it stays.
+        cache = load_package_cache(session)
+        if cache:
+            session.model.load(cache["installed"], cache["all"])
+            session.inventory = {values[0]: PackageRecord.from_list(values) for values in cache.get("records", [])}
+            session.package_filter = PackageFilter(session.model.all_names())
+            logger.log(f"Loaded {len(cache['installed'])} packages from cache ({cache.get('saved_at')}).", level="INFO", device=session)
+            if on_cached:
+                on_cached(session)
+        session.fingerprint, session.change_token = read_device_identity(session)
+        if cache and session.fingerprint and cache.get("fingerprint") == session.fingerprint:
+            if cache.get("token") == session.change_token:
+                session.status = "Idle"
+                logger.log("Package cache is current; skipped full fetch.", level="SUCCESS", device=session)
+                return session
+        elif cache and session.fingerprint:
+            logger.log("Build fingerprint changed; discarding package cache.", level="WARNING", device=session)
+            session.model.load([], [])
+            session.inventory = {}
+            session.package_filter = None
+            if on_cached:
+                on_cached(session)
+
+    logger.log("Fetching packages...", level="HEADER", device=session)
+    try:
+        inventory = fetch_inventory(session)
+    except Exception as e:
+        session.status = "Idle"
+        logger.log(f"Fetch Error: {e}", level="ERROR", device=session)
+        return session
+    session.inventory = inventory.records
+    session.fingerprint, session.change_token = inventory.identity_pair()
+    res1, res2 = inventory.installed_names(), inventory.all_names()
+
+    installed_delta, all_delta = session.model.load(res1, res2)
+    if all_delta or session.package_filter is None:
+        session.package_filter = PackageFilter(session.model.all_names())
+    save_packages_to_file(res1, "installed_packages.txt", session.folder)
+    save_packages_to_file(res2, "all_installed_packages.txt", session.folder)
+    save_package_cache(session, res1, res2, session.inventory)
+    record_snapshot(session, res1, res2)
+    export_session_metrics(session)
+    session.status = "Idle"
+    logger.log(f"Fetched {len(res1)} installed / {len(res2)} total packages ({installed_delta} changed).", level="SUCCESS", device=session)
+    return session
+
+# --- PACKAGE METADATA ---
+# Labels, versionName and code size are resolved lazily, only for rows the
+# user can see (plus the first matches of a filter), through a small pool
+# running batched shells: one 'dumpsys package' and one 'du' per package.
+# Results live in an LRU persisted as metadata_cache.json in the device
+# folder; an entry is reused while the package's APK path is unchanged,
+# since an update moves the APK. Android has no shell command that prints
+# an app's label, so the label is derived from the APK folder name (e.g.
+# /system/priv-app/GoogleDialer -> "Google Dialer") or the package name.
+METADATA_CACHE_FILE = "metadata_cache.json"
+METADATA_CACHE_SIZE = 5000
+METADATA_BATCH = 20
+METADATA_WORKERS = 2
+METADATA_FILTER_PREFETCH = 200
+METADATA_PACKAGE_TIMEOUT = 10
+METADATA_RETRY_AFTER = 60 # Seconds before a package that got no answer is asked for again.
+GENERIC_NAME_PARTS = {"com", "org", "net", "android", "google", "app", "apps", "overlay", "service", "services",
+                      "provider", "qti", "qualcomm", "samsung", "sec", "miui", "xiaomi", "oneplus", "vendor"}
+
+def guess_label(package_name, apk_path=None):
+    """A readable name for a package: the APK folder, else the most specific part of the name."""
+    if apk_path:
+        folder = os.path.basename(os.path.dirname(apk_path.replace("\\", "/")))
+        if folder and not folder.startswith("~~") and "." not in folder and "-" not in folder:
+            return re.sub(r'(?<=[a-z0-9])(?=[A-Z])|_', ' ', folder).strip()
+    parts = [part for part in package_name.split(".") if part.lower() not in GENERIC_NAME_PARTS]
+    leaf = parts[-1] if parts else package_name.rsplit(".", 1)[-1]
+    return re.sub(r'(?<=[a-z0-9])(?=[A-Z])|_', ' ', leaf).strip().title() if leaf.islower() else leaf
+
+def format_size(kib):
+    if kib is None:
+        return None
+    if kib >= 1024 * 1024:
+        return f"{kib / (1024 * 1024):.1f} GB"
+    if kib >= 1024:
+        return f"{kib / 1024:.1f} MB"
+    return f"{kib} KB"
+
+def fetch_metadata(session, packages):
+    """Runs one batched shell for packages; returns {name: {"label", "version", "size_kb", "path"}}."""
+    items, paths = [], {}
+    for package_name in packages:
+        if not SAFE_PACKAGE_RE.match(package_name):
+            continue
+        record = session.inventory.get(package_name)
+        path = paths[package_name] = record.path if record else None
+        commands = [f"dumpsys package {package_name} 2>/dev/null | grep -m1 versionName="]
+        if path and path.startswith("/"):
+            commands.append(f"du -sk {shlex.quote(os.path.dirname(path))} 2>/dev/null")
+        items.append((package_name, commands))
+    if not items:
+        return {}
+    results = {}
+    for package_name, lines in run_marked_script(session.serial, items, "metadata", METADATA_PACKAGE_TIMEOUT).items():
+        entry = {"label": guess_label(package_name, paths[package_name]), "version": None, "size_kb": None,
+                 "path": paths[package_name]}
+        for line in lines:
+            line = line.strip()
+            if line.startswith("versionName="):
+                entry["version"] = line.split("=", 1)[1] or None
+            elif line[:1].isdigit():
+                try: entry["size_kb"] = int(line.split()[0])
+                except ValueError: pass
+        results[package_name] = entry
+    return results
+
+class MetadataService:
+    """
+    Per-device lazy metadata. get() never blocks: it returns what is cached
+    and fresh, or None. request() queues packages (visible rows first) and
+    on_update(names) is called from a worker as each batch lands.
+    """
+    def __init__(self, session, on_update=None):
+        self.session = session
+        self.on_update = on_update
+        self.cache = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.queued = set()
+        self.unresolved = {} # name -> when it went unanswered; asked again after METADATA_RETRY_AFTER or retry().
+        self.lock = threading.RLock()
+        self.workers = 0
+        self.dirty = False
+        self.executor = None
+        self._load()
+
+    def _path(self):
+        return os.path.join(self.session.folder, METADATA_CACHE_FILE)
+
+    def _load(self):
+        try:
+            with open(self._path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return
+        if data.get("serial") != self.session.serial:
+            return
+        for name, path, label, version, size_kb in data.get("entries", []):
+            self.cache[name] = {"label": label, "version": version, "size_kb": size_kb, "path": path}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = [[name, e["path"], e["label"], e["version"], e["size_kb"]] for name, e in self.cache.items()]
+            self.dirty = False
+        path = self._path()
+        try:
+            self.session.ensure_folder()
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"serial": self.session.serial, "entries": entries}, f)
+            os.replace(path + ".tmp", path)
+        except Exception: pass
+
+    def _fresh(self, name, entry):
+        record = self.session.inventory.get(name)
+        return record is None or record.path == entry["path"]
+
+    def get(self, name):
+        with self.lock:
+            entry = self.cache.get(name)
+            if entry is None or not self._fresh(name, entry):
+                return None
+            self.cache.move_to_end(name)
+            return entry
+
+    def describe(self, name):
+        """'Label · v1.2 · 14.2 MB' for a row, or None while unresolved."""
+        entry = self.get(name)
+        if entry is None:
+            return None
+        return " \u00b7 ".join(part for part in (entry["label"], entry["version"] and f"v{entry['version']}",
+                                                 format_size(entry["size_kb"])) if part)
+
+    def request(self, names, front=False):
+        """Queues unresolved names; front=True puts them ahead of everything queued (visible rows)."""
+        with self.lock:
+            now = time.monotonic()
+            wanted = [name for name in names
+                      if name not in self.queued and self.get(name) is None
+                      and (name not in self.unresolved or now - self.unresolved[name] >= METADATA_RETRY_AFTER)]
+            if not wanted:
+                return
+            if front:
+                self.queue.extendleft(reversed(wanted))
+            else:
+                self.queue.extend(wanted)
+            self.queued.update(wanted)
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=METADATA_WORKERS)
+            while self.workers < METADATA_WORKERS and self.workers * METADATA_BATCH < len(self.queue):
+                self.workers += 1
+                self.executor.submit(self._drain)
+
+    def _drain(self):
+        try:
+            while True:
+                with self.lock:
+                    batch = [self.queue.popleft() for _ in range(min(METADATA_BATCH, len(self.queue)))]
+                    if not batch:
+                        self.workers -= 1
+                        break
+                detached = self.session.detached.is_set()
+                try:
+                    results = {} if detached else fetch_metadata(self.session, batch)
+                except Exception as e:
+                    logger.log(f"Metadata lookup failed: {e}", level="WARNING", device=self.session)
+                    results = {}
+                with self.lock:
+                    for name, entry in results.items():
+                        self.cache[name] = entry
+                        self.cache.move_to_end(name)
+                    while len(self.cache) > METADATA_CACHE_SIZE:
+                        self.cache.popitem(last=False)
+                    self.queued.difference_update(batch)
+                    if not detached: # Asked again as soon as the rows are shown after re-attach.
+                        now = time.monotonic()
+                        self.unresolved.update((name, now) for name in batch if name not in results)
+                    self.dirty = self.dirty or bool(results)
+                if results and self.on_update:
+                    self.on_update(list(results))
+        except Exception:
+            with self.lock:
+                self.workers -= 1
+            raise
+        self.save()
+
+    def forget(self, names=None):
+        """Drops cached entries (all when names is None), e.g. after a package was updated."""
+        with self.lock:
+            for name in list(self.cache) if names is None else names:
+                self.cache.pop(name, None)
+            if names is None:
+                self.unresolved.clear()
+            else:
+                for name in names:
+                    self.unresolved.pop(name, None)
+            self.dirty = True
+
+    def retry(self):
+        """Lets packages that went unanswered be asked for again, e.g. after a refetch."""
+        with self.lock:
+            self.unresolved.clear()
+
+    def close(self):
+        with self.lock:
+            self.queue.clear()
+            self.queued.clear()
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False)
+        self.save()
+
+# --- SCRCPY SESSIONS ---
+# scrcpy runs as a tracked child process per (device, preset). Its merged
+# output is read on a thread, so a long session can never stall on a full
+# pipe: ordinary lines go to the log, and the lines that carry timing are
+# parsed into stats (time to "Device:" / first texture, fps from
+# --print-fps, skipped frames, warnings). A summary of each finished
+# session is appended to scrcpy_stats.jsonl in the device folder for
+# comparing presets such as --audio-output-buffer values.
+SCRCPY_PRESETS = collections.OrderedDict([
+    ("Project Screen", []),
+    ("Mouse Only (Stealth)", ["--no-video-playback", "--no-audio", "-K", "-M"]),
+    ("Audio Cast Only", ["--no-video-playback", "--audio-output-buffer=20"]),
+])
+SCRCPY_STATS_FILE = "scrcpy_stats.jsonl"
+SCRCPY_STOP_TIMEOUT = 3
+SCRCPY_FPS_RE = re.compile(r'(\d+) fps(?: \(\+(\d+) frames? skipped\))?')
+SCRCPY_DEVICE_RE = re.compile(r'\bDevice: ')
+SCRCPY_TEXTURE_RE = re.compile(r'\bTexture: ')
+SCRCPY_WARN_RE = re.compile(r'^(?:WARN|ERROR)\b|\b(?:underflow|overflow|overrun)\b', re.IGNORECASE)
+
+def find_scrcpy():
+    scrcpy_exe = shutil.which("scrcpy")
+    if not scrcpy_exe:
+        bundled = get_bundled_path("scrcpy.exe")
+        if os.path.exists(bundled):
+            scrcpy_exe = bundled
+    return scrcpy_exe
+
+class ScrcpySession:
+    def __init__(self, serial, preset, flags, scrcpy_exe):
+        self.serial = serial
+        self.preset = preset
+        self.flags = list(flags)
+        # fps is only printed for sessions that render video.
+        if "--no-video-playback" not in self.flags and "--print-fps" not in self.flags:
+            self.flags.append("--print-fps")
+        self.scrcpy_exe = scrcpy_exe
+        self.proc = None
+        self.thread = None
+        self.started = None
+        self.connect_s = None
+        self.first_frame_s = None
+        self.fps = collections.deque(maxlen=120)
+        self.skipped = 0
+        self.warnings = 0
+        self.exit_code = None
+        self.ended = None
+        self.stopping = False
+
+    @property
+    def label(self):
+        return f"{self.preset} ({self.serial or 'default'})"
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        env = os.environ.copy()
+        if os.path.isabs(adb_executable):
+            env["ADB"] = adb_executable
+        cmd = [self.scrcpy_exe] + self.flags
+        if self.serial:
+            cmd += ["--serial", self.serial]
+        cwd_path = os.path.dirname(self.scrcpy_exe) if os.path.isabs(self.scrcpy_exe) else None
+        self.started = time.monotonic()
+        self.proc = subprocess.Popen(
+            cmd, creationflags=CREATE_NO_WINDOW,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            env=env, cwd=cwd_path
+        )
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+        return self
+
+    def _drain(self):
+        device = device_sessions.get(self.serial)
+        for raw in iter(self.proc.stdout.readline, b""):
+            line = raw.decode("utf-8", errors="replace").strip()
+            if line and not self.parse(line):
+                level = "WARNING" if line.startswith(("WARN", "ERROR")) else "INFO"
+                logger.log(f"scrcpy [{self.preset}]: {line}", level=level, device=device)
+        self.exit_code = self.proc.wait()
+        self.ended = time.monotonic()
+        level = "INFO" if self.exit_code == 0 or self.stopping else "WARNING"
+        logger.log(f"scrcpy [{self.preset}] ended (exit {self.exit_code}): {self.summary()}", level=level, device=device)
+        self._save_stats(device)
+
+    def parse(self, line):
+        """Updates the stats from one output line; True when the line is only a stat (not worth logging)."""
+        elapsed = time.monotonic() - self.started
+        match = SCRCPY_FPS_RE.search(line)
+        if match:
+            self.fps.append(int(match.group(1)))
+            self.skipped += int(match.group(2) or 0)
+            if self.first_frame_s is None:
+                self.first_frame_s = elapsed
+            return True
+        if self.connect_s is None and SCRCPY_DEVICE_RE.search(line):
+            self.connect_s = elapsed
+        elif self.first_frame_s is None and SCRCPY_TEXTURE_RE.search(line):
+            self.first_frame_s = elapsed
+        if SCRCPY_WARN_RE.search(line):
+            self.warnings += 1
+        return False
 
-    # --- 3. Local Bin Subfolder ---
-    bundled = get_bundled_path("adb.exe")
-    if os.path.exists(bundled):
-        return bundled
-    
-    # --- 4. Fallback: Ask User ---
-    return None
+    def stats(self):
+        fps = list(self.fps)
+        return {
+            "preset": self.preset, "serial": self.serial, "flags": self.flags, "running": self.running,
+            "uptime_s": round((self.ended or time.monotonic()) - self.started, 1) if self.started else None,
+            "connect_s": self.connect_s and round(self.connect_s, 2),
+            "first_frame_s": self.first_frame_s and round(self.first_frame_s, 2),
+            "fps_last": fps[-1] if fps else None,
+            "fps_avg": round(sum(fps) / len(fps), 1) if fps else None,
+            "frames_skipped": self.skipped, "warnings": self.warnings, "exit_code": self.exit_code,
+        }
 
-def force_kill_all_adb():
-    """Nuclear option to clear all ADB processes."""
-    try:
-        subprocess.run(
-            ["taskkill", "/F", "/IM", "adb.exe"],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-            creationflags=CREATE_NO_WINDOW
-        )
-    except: pass
+    def summary(self):
+        stats = self.stats()
+        parts = [f"up {stats['uptime_s']}s"]
+        if stats["connect_s"] is not None:
+            parts.append(f"connected in {stats['connect_s']}s")
+        if stats["first_frame_s"] is not None:
+            parts.append(f"first frame {stats['first_frame_s']}s")
+        if stats["fps_avg"] is not None:
+            parts.append(f"avg {stats['fps_avg']} fps, {stats['frames_skipped']} frames skipped")
+        if stats["warnings"]:
+            parts.append(f"{stats['warnings']} warnings")
+        return ", ".join(parts)
 
-def get_device_name_with_tool(adb_path):
-    try:
-        # 1. Sanity Check
+    def _save_stats(self, device):
+        if device is None:
+            return
         try:
-            run_with_timeout([adb_path, "--version"], 5)
-        except:
-            return None, "Binary Unresponsive"
+            device.ensure_folder()
+            with open(os.path.join(device.folder, SCRCPY_STATS_FILE), "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(self.stats(), ended_at=datetime.now().isoformat(timespec="seconds"))) + "\n")
+        except Exception: pass
 
-        # 2. Run 'devices'
+    def stop(self):
+        self.stopping = True
+        if not self.running:
+            return
+        self.proc.terminate()
         try:
-            code, output, err = run_with_timeout([adb_path, "devices"], 15)
+            self.proc.wait(SCRCPY_STOP_TIMEOUT)
         except subprocess.TimeoutExpired:
-            return None, "Daemon Start Timeout"
+            self.proc.kill()
+            self.proc.wait()
 
-        if "device" not in output.replace("List of devices attached", ""):
-            return None, "No device found"
+class ScrcpyManager:
+    """Sessions keyed by (serial, preset): starting a preset that is already running reuses it."""
+    def __init__(self):
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
 
-        # 3. Get Model Name
+    def start(self, serial, preset):
+        scrcpy_exe = find_scrcpy()
+        if not scrcpy_exe:
+            logger.log("Error: 'scrcpy' not found.", level="ERROR")
+            show_error("Error", "Scrcpy not found in PATH or bin folder.")
+            return None
+        key = (serial, preset)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None and session.running:
+                logger.log(f"scrcpy {session.label} is already running.", level="INFO")
+                return session
+            session = ScrcpySession(serial, preset, SCRCPY_PRESETS[preset], scrcpy_exe)
+            self.sessions[key] = session
+        logger.log(f"Launching Scrcpy ({preset}) via {adb_executable}...", level="HEADER")
         try:
-            code, name, err = run_with_timeout([adb_path, "shell", "getprop", "ro.product.model"], 5)
-            if code == 0:
-                name = name.strip()
-                name = re.sub(r'[^\w\-_]', '_', name)
-                return (name if name else "Unknown_Device"), None
-        except:
-            return None, "Read Error"
-            
-    except Exception as e:
-        return None, str(e)
-        
-    return None, "Unknown Error"
+            return session.start()
+        except Exception as e:
+            logger.log(f"Failed to launch scrcpy: {e}", level="ERROR")
+            with self.lock:
+                self.sessions.pop(key, None)
+            return None
 
-class Logger:
-    def __init__(self, textbox=None):
-        self.textbox = textbox
-        self.log_file = os.path.join(device_folder, "operation_log.txt")
-        self.setup_tags()
+    def stop(self, serial, preset):
+        session = self.sessions.get((serial, preset))
+        if session:
+            session.stop()
+        return session
 
-    def setup_tags(self):
-        if self.textbox:
-            self.textbox.tag_config("INFO", foreground="#212121") 
-            self.textbox.tag_config("SUCCESS", foreground="#2e7d32", font=("Consolas", 13, "bold")) 
-            self.textbox.tag_config("ERROR", foreground="#c62828", font=("Consolas", 13, "bold")) 
-            self.textbox.tag_config("WARNING", foreground="#ef6c00", font=("Consolas", 12, "bold")) 
-            self.textbox.tag_config("HEADER", foreground="#1565c0", font=("Consolas", 10, "bold")) 
+    def restart(self, serial, preset):
+        self.stop(serial, preset)
+        return self.start(serial, preset)
 
-    def update_log_path(self, new_folder):
-        self.log_file = os.path.join(new_folder, "operation_log.txt")
+    def stop_all(self):
+        for session in list(self.sessions.values()):
+            session.stop()
 
-    def log(self, message, level=None):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        formatted_msg = f"[{timestamp}] {message}"
-        
-        if level is None:
-            msg_lower = message.lower()
-            if any(x in msg_lower for x in ["error", "failed", "failure", "exception", "no device", "timed out", "unresponsive", "switching"]):
-                level = "ERROR"
-            elif any(x in msg_lower for x in ["success", "installed successfully"]):
-                level = "SUCCESS"
-            elif any(x in msg_lower for x in ["warning", "no selection"]):
-                level = "WARNING"
-            elif any(x in msg_lower for x in ["starting", "launching", "fetching", "connecting", "attempting"]):
-                level = "HEADER"
-            else:
-                level = "INFO"
+    def list(self):
+        with self.lock:
+            return list(self.sessions.values())
 
-        if self.textbox:
-            def _gui_log():
-                self.textbox.insert(tk.END, formatted_msg + "\n", level)
-                self.textbox.see(tk.END)
-            self.textbox.after(0, _gui_log)
+scrcpy_manager = ScrcpyManager()
+
+# --- UI STALL PROFILER ---
+# Opt-in with ADB_MANAGER_PROFILE_UI=1 (or =<stall threshold in ms>).
+# Every Tk callback (after() timers, bindings, widget commands) goes through
+# tkinter.CallWrapper, so patching it times each handler. A heartbeat timer
+# measures how late the event loop runs it, and a sampler thread records the
+# main thread's stack while a handler is over the threshold. The report is
+# rewritten to ui_profile.txt periodically and on exit.
+UI_PROFILE_FILE = "ui_profile.txt"
+UI_HEARTBEAT_MS = 50
+UI_STALL_MS = 200
+UI_SAMPLE_INTERVAL = 0.01
+UI_STACK_DEPTH = 12
+UI_MAX_STALLS = 30
+UI_REPORT_EVERY_MS = 30000
+
+def tk_callback_label(func, subst):
+    """'after create_gui.<locals>.tick (uninstall.py:123)' for a registered Tk callback."""
+    code = getattr(func, "__code__", None)
+    if code is not None and code.co_name == "callit" and "func" in code.co_freevars:
+        # Misc.after() wraps the real callback in a closure.
+        func = func.__closure__[code.co_freevars.index("func")].cell_contents
+        kind = "after"
+    else:
+        kind = "bind" if subst else "command"
+    target = getattr(func, "__func__", func)
+    code = getattr(target, "__code__", None)
+    name = getattr(target, "__qualname__", None) or type(target).__name__
+    if code is None:
+        return f"{kind} {name}"
+    return f"{kind} {name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class UiStallProfiler:
+    def __init__(self, window, stall_ms=UI_STALL_MS, path=None):
+        self.window = window
+        self.stall = stall_ms / 1000
+        self.path = path or os.path.join(application_path, UI_PROFILE_FILE)
+        self.context = None # Optional callable describing what the UI holds, e.g. package counts.
+        self.started = time.monotonic()
+        self.main_ident = threading.get_ident()
+        self.handlers = {} # label -> [calls, total seconds, max seconds]
+        self.lags = collections.deque(maxlen=20000)
+        self.stalls = []
+        self.active = [] # (label, start) of the callbacks running now, outermost first.
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self.running = False
+        self._original_call = None
 
+    def install(self):
+        """Patches tk.CallWrapper.__call__ on the class, so every callback is timed, also those registered earlier."""
+        profiler = self
+        original = self._original_call = tk.CallWrapper.__call__
+        def timed_call(wrapper, *args):
+            if threading.get_ident() != profiler.main_ident:
+                return original(wrapper, *args)
+            return profiler.time_callback(tk_callback_label(wrapper.func, wrapper.subst), original, wrapper, args)
+        tk.CallWrapper.__call__ = timed_call
+        self.running = True
+        threading.Thread(target=self._sample, daemon=True).start()
+        self.expected = time.monotonic() + UI_HEARTBEAT_MS / 1000
+        self.window.after(UI_HEARTBEAT_MS, self._heartbeat)
+        self.window.after(UI_REPORT_EVERY_MS, self._periodic_report)
+        return self
+
+    def uninstall(self):
+        self.running = False
+        if self._original_call:
+            tk.CallWrapper.__call__ = self._original_call
+
+    def time_callback(self, label, original, wrapper, args):
+        start = time.monotonic()
+        with self.lock:
+            self.active.append((label, start))
+            outermost = len(self.active) == 1
+            if outermost:
+                self.samples = collections.Counter()
         try:
-            folder = os.path.dirname(self.log_file)
-            if not os.path.exists(folder):
-                os.makedirs(folder, exist_ok=True)
-                
-            with open(self.log_file, "a", encoding="utf-8") as f:
-                f.write(f"{datetime.now().strftime('%Y-%m-%d')} [{level}] {message}\n")
-        except Exception:
-            pass
+            return original(wrapper, *args)
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.active.pop()
+                stats = self.handlers.setdefault(label, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+                if outermost and elapsed >= self.stall:
+                    self._record_stall(label, elapsed, self.samples)
 
-logger = None
+    def _record_stall(self, label, elapsed, samples):
+        context = None
+        if self.context:
+            try: context = self.context()
+            except Exception: pass
+        self.stalls.append({"label": label, "seconds": elapsed, "at": datetime.now().strftime("%H:%M:%S"),
+                            "context": context, "samples": samples})
+        if len(self.stalls) > 2 * UI_MAX_STALLS:
+            self.stalls = sorted(self.stalls, key=lambda stall: stall["seconds"], reverse=True)[:UI_MAX_STALLS]
 
-def uninstall_packages(package_list):
-    task_log_file = os.path.join(device_folder, "uninstall_log.txt")
-    logger.log(f"Starting uninstall for {len(package_list)} packages...", level="HEADER")
-    try:
-        with open(task_log_file, "w") as f: f.write(f"Start: {datetime.now()}\n")
-    except: pass
+    def _heartbeat(self):
+        if not self.running:
+            return
+        now = time.monotonic()
+        lag = max(0.0, now - self.expected)
+        self.lags.append(lag)
+        # The heartbeat itself runs through the patched CallWrapper, so it is the only active entry here.
+        if lag >= self.stall and len(self.active) <= 1:
+            with self.lock:
+                self._record_stall("(event loop, no callback)", lag, collections.Counter())
+        self.expected = now + UI_HEARTBEAT_MS / 1000
+        self.window.after(UI_HEARTBEAT_MS, self._heartbeat)
 
-    for package_name in package_list:
-        logger.log(f"Uninstalling: {package_name}", level="INFO")
+    def _periodic_report(self):
+        if self.running:
+            self.write_report()
+            self.window.after(UI_REPORT_EVERY_MS, self._periodic_report)
+
+    def _sample(self):
+        while self.running:
+            time.sleep(UI_SAMPLE_INTERVAL)
+            with self.lock:
+                if not self.active or time.monotonic() - self.active[0][1] < self.stall:
+                    continue
+                outermost, samples = self.active[0], self.samples
+                frame = sys._current_frames().get(self.main_ident)
+            if frame is None:
+                continue
+            # Formatted outside the lock, so callbacks starting or ending meanwhile are not held up.
+            stack = [f for f in traceback.extract_stack(frame) if f.name not in ("timed_call", "time_callback")]
+            key = tuple(f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in stack[-UI_STACK_DEPTH:])
+            del frame
+            with self.lock:
+                if self.active and self.active[0] is outermost:
+                    samples[key] += 1
+
+    def report(self):
+        with self.lock:
+            handlers = sorted(self.handlers.items(), key=lambda item: item[1][1], reverse=True)
+            stalls = sorted(self.stalls, key=lambda stall: stall["seconds"], reverse=True)[:UI_MAX_STALLS]
+            lags = sorted(self.lags)
+        ms = lambda seconds: f"{seconds * 1000:.1f} ms"
+        lines = [f"UI stall report, {datetime.now().isoformat(timespec='seconds')}, "
+                 f"{time.monotonic() - self.started:.0f}s profiled, stall threshold {ms(self.stall)}", ""]
+        if lags:
+            pick = lambda fraction: lags[min(len(lags) - 1, int(fraction * len(lags)))]
+            late = sum(1 for lag in lags if lag >= self.stall)
+            lines += [f"Event loop lag ({len(lags)} heartbeats every {UI_HEARTBEAT_MS} ms): p50 {ms(pick(0.5))}, "
+                      f"p95 {ms(pick(0.95))}, p99 {ms(pick(0.99))}, max {ms(lags[-1])}, {late} over threshold", ""]
+        lines.append("Handlers by total time (nested callbacks are included in their caller):")
+        lines.append(f"{'calls':>8} {'total':>12} {'mean':>10} {'max':>10}  handler")
+        for label, (calls, total, worst) in handlers:
+            lines.append(f"{calls:>8} {ms(total):>12} {ms(total / calls):>10} {ms(worst):>10}  {label}")
+        lines += ["", f"Worst stalls ({len(stalls)}):"]
+        for stall in stalls:
+            lines.append(f"{ms(stall['seconds']):>10} at {stall['at']}  {stall['label']}"
+                         + (f"  [{stall['context']}]" if stall["context"] else ""))
+            total = sum(stall["samples"].values())
+            for stack, count in stall["samples"].most_common(3):
+                lines.append(f"    {count}/{total} samples:")
+                lines += [f"        {entry}" for entry in stack]
+        return "\n".join(lines) + "\n"
+
+    def write_report(self):
         try:
-            code, out, err = run_with_timeout(
-                [adb_executable, "shell", "pm", "uninstall", "--user", "0", package_name], 
-                15
-            )
-            if code == 0:
-                logger.log(f"SUCCESS: {package_name}", level="SUCCESS")
-                with open(task_log_file, "a") as f: f.write(f"SUCCESS: {package_name}\n")
-            else:
-                logger.log(f"FAILED: {package_name} (ADB Error: {err.strip()})", level="ERROR")
-        except Exception as e:
-            logger.log(f"ERROR: {package_name} ({str(e)})", level="ERROR")
-    logger.log("Uninstallation process finished.", level="HEADER")
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(self.report())
+        except Exception: pass
 
-def install_existing_packages(package_list):
-    task_log_file = os.path.join(device_folder, "install_existing_log.txt")
-    logger.log(f"Starting install for {len(package_list)} packages...", level="HEADER")
+def ui_profiler_from_env(window):
+    """Starts the profiler when ADB_MANAGER_PROFILE_UI is set; returns it or None."""
+    value = os.environ.get("ADB_MANAGER_PROFILE_UI", "")
+    if value in ("", "0"):
+        return None
     try:
-        with open(task_log_file, "w") as f: f.write(f"Start: {datetime.now()}\n")
-    except: pass
+        stall_ms = float(value) if value != "1" else UI_STALL_MS
+    except ValueError:
+        stall_ms = UI_STALL_MS
+    return UiStallProfiler(window, stall_ms).install()
 
-    for package_name in package_list:
-        logger.log(f"Installing: {package_name}", level="INFO")
+# --- VIRTUALIZED PACKAGE LIST ---
+# Row kind -> (font, foreground, background when selected)
+ROW_STYLES = {
+    "normal": (("Segoe UI", 11), "#212121", "#e3f2fd"),
+    "existing": (("Segoe UI", 11, "bold"), "#2e7d32", "#e8f5e9"),
+    "missing": (("Segoe UI", 11, "bold"), "#c62828", "#ffebee"),
+}
+
+class VirtualPackageList:
+    """
+    Canvas list that only draws the rows in view. Canvas items are pooled and
+    re-labelled on scroll, and selection lives outside the widgets,
+    so replacing the rows or scrolling costs O(visible rows), not O(packages).
+    Selection is read from and written to the device's PackageModel bitmap.
+    describe(pkg) supplies the grey detail text on the right of a row (None
+    while unknown); on_visible(rows) is told which rows each redraw showed.
+    """
+    ROW_HEIGHT = 26
+    DETAIL_FONT = ("Segoe UI", 9)
+
+    def __init__(self, parent, model=None, kind_of=None, on_select=None, describe=None, on_visible=None):
+        self.canvas = tk.Canvas(parent, bg="white", highlightthickness=1, highlightbackground="#e0e0e0")
+        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.yview)
+        self.kind_of = kind_of or (lambda pkg: "normal")
+        self.on_select = on_select
+        self.describe = describe
+        self.on_visible = on_visible
+        self.rows = []
+        self.model = model or PackageModel()
+        self.offset = 0
+        self._pool = []
+
+        self.canvas.bind("<Configure>", lambda e: self.redraw())
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<Button-4>", lambda e: self.yview("scroll", -1, "units"))
+        self.canvas.bind("<Button-5>", lambda e: self.yview("scroll", 1, "units"))
+        # Windows delivers <MouseWheel> to the focus widget, so grab it while hovered.
+        self.canvas.bind("<Enter>", lambda e: self.canvas.bind_all("<MouseWheel>", self._on_mousewheel))
+        self.canvas.bind("<Leave>", lambda e: self.canvas.unbind_all("<MouseWheel>"))
+
+    def pack(self):
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+    def set_rows(self, rows):
+        self.rows = rows
+        self._clamp()
+        self.redraw()
+
+    def _view_height(self):
+        return max(self.canvas.winfo_height(), 1)
+
+    def _clamp(self):
+        max_offset = max(0, len(self.rows) * self.ROW_HEIGHT - self._view_height())
+        self.offset = min(max(0, int(self.offset)), max_offset)
+
+    def yview(self, *args):
+        if not args:
+            return
+        if args[0] == "moveto":
+            self.offset = float(args[1]) * len(self.rows) * self.ROW_HEIGHT
+        elif args[0] == "scroll":
+            step = self.ROW_HEIGHT if args[2] == "units" else self._view_height()
+            self.offset += int(args[1]) * step
+        self._clamp()
+        self.redraw()
+
+    def scroll_to(self, pkg):
         try:
-            code, out, err = run_with_timeout(
-                [adb_executable, "shell", "pm", "install-existing", package_name], 
-                15
-            )
-            if code == 0:
-                logger.log(f"SUCCESS: {package_name}", level="SUCCESS")
-                with open(task_log_file, "a") as f: f.write(f"SUCCESS: {package_name}\n")
-            else:
-                logger.log(f"FAILED: {package_name} (ADB Error: {err.strip()})", level="ERROR")
-        except Exception as e:
-            logger.log(f"ERROR: {package_name} ({str(e)})", level="ERROR")
-    logger.log("Installation process finished.", level="HEADER")
+            index = self.rows.index(pkg)
+        except ValueError:
+            return
+        self.offset = max(0, index - 1) * self.ROW_HEIGHT
+        self._clamp()
+        self.redraw()
 
-def load_package_list(file_path):
-    package_list = []
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                package_name = line.strip()
-                if package_name and not package_name.startswith("#"):
-                    package_list.append(package_name)
-    except Exception as e:
-        logger.log(f"Error reading file: {e}", level="ERROR")
-        messagebox.showerror("Error", str(e))
-        return []
-    logger.log(f"Loaded {len(package_list)} packages from {os.path.basename(file_path)}.", level="HEADER")
-    return package_list
+    def redraw(self):
+        height = self._view_height()
+        width = max(self.canvas.winfo_width(), 1)
+        first = self.offset // self.ROW_HEIGHT
+        count = height // self.ROW_HEIGHT + 2
 
-def get_installed_packages_worker(all_packages):
-    cmd = [adb_executable, "shell", "pm", "list", "packages"]
-    if all_packages:
-        cmd.append("-a")
-    try:
-        code, out, err = run_with_timeout(cmd, 10)
-        if code == 0:
-            packages = out.strip().split('\n')
-            return [p.replace("package:", "").strip() for p in packages if p.strip()]
-        return []
-    except Exception:
-        return []
+        while len(self._pool) < count:
+            rect = self.canvas.create_rectangle(0, 0, 0, 0, width=0)
+            text = self.canvas.create_text(0, 0, anchor="w")
+            detail = self.canvas.create_text(0, 0, anchor="e", font=self.DETAIL_FONT, fill="#757575")
+            self._pool.append((rect, text, detail))
 
-def save_packages_to_file(packages, filename):
-    full_path = os.path.join(device_folder, filename)
-    try:
-        if not os.path.exists(device_folder):
-            os.makedirs(device_folder, exist_ok=True)
-        with open(full_path, "w", encoding="utf-8") as f:
-            f.write("\n".join(packages))
-    except Exception: pass
+        visible = []
+        for slot, (rect, text, detail) in enumerate(self._pool):
+            index = first + slot
+            if slot >= count or index >= len(self.rows):
+                self.canvas.itemconfigure(rect, state="hidden")
+                self.canvas.itemconfigure(text, state="hidden")
+                self.canvas.itemconfigure(detail, state="hidden")
+                continue
+            pkg = self.rows[index]
+            visible.append(pkg)
+            font, fg, sel_bg = ROW_STYLES.get(self.kind_of(pkg), ROW_STYLES["normal"])
+            is_sel = self.model.is_selected(pkg)
+            y = index * self.ROW_HEIGHT - self.offset
+            self.canvas.coords(rect, 0, y, width, y + self.ROW_HEIGHT)
+            self.canvas.itemconfigure(rect, fill=sel_bg if is_sel else "white", state="normal")
+            self.canvas.coords(text, 8, y + self.ROW_HEIGHT // 2)
+            self.canvas.itemconfigure(text, text=("\u2611  " if is_sel else "\u2610  ") + pkg, font=font, fill=fg, state="normal")
+            info = self.describe(pkg) if self.describe else None
+            self.canvas.coords(detail, width - 8, y + self.ROW_HEIGHT // 2)
+            self.canvas.itemconfigure(detail, text=info or "", state="normal" if info else "hidden")
 
-def run_scrcpy(flags):
-    scrcpy_exe = shutil.which("scrcpy")
-    if not scrcpy_exe:
-        bundled = get_bundled_path("scrcpy.exe")
-        if os.path.exists(bundled):
-            scrcpy_exe = bundled
+        total = len(self.rows) * self.ROW_HEIGHT
+        if total <= height:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.offset / total, (self.offset + height) / total)
+        if self.on_visible and visible:
+            self.on_visible(visible)
 
-    if not scrcpy_exe:
-        logger.log("Error: 'scrcpy' not found.", level="ERROR")
-        messagebox.showerror("Error", "Scrcpy not found in PATH or bin folder.")
-        return
+    def _on_mousewheel(self, event):
+        self.yview("scroll", int(-1 * (event.delta / 120)), "units")
 
-    env = os.environ.copy()
-    if os.path.isabs(adb_executable):
-        env["ADB"] = adb_executable
+    def _on_click(self, event):
+        index = (self.offset + event.y) // self.ROW_HEIGHT
+        if 0 <= index < len(self.rows):
+            pkg = self.rows[index]
+            self.model.set_selected([pkg], not self.model.is_selected(pkg))
+            self._selection_changed()
 
-    cmd = [scrcpy_exe] + flags
-    logger.log(f"Launching Scrcpy via {adb_executable}...", level="HEADER")
-    try:
-        cwd_path = os.path.dirname(scrcpy_exe) if os.path.isabs(scrcpy_exe) else None
-        subprocess.Popen(
-            cmd, creationflags=CREATE_NO_WINDOW,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            stdin=subprocess.DEVNULL,
-            env=env, cwd=cwd_path
-        )
-    except Exception as e:
-        logger.log(f"Failed to launch scrcpy: {e}", level="ERROR")
+    def set_model(self, model):
+        self.model = model
+        self._selection_changed()
+
+    def set_selected(self, packages, value=True):
+        self.model.set_selected(packages, value)
+        self._selection_changed()
+
+    def clear_selection(self):
+        self.model.clear_selection()
+        self._selection_changed()
+
+    def _selection_changed(self):
+        self.redraw()
+        if self.on_select:
+            self.on_select(self.model.selection_count())
 
 def create_gui():
     global logger, adb_executable
+    import_tk()
     
     # 1. Initialize Root Window First (needed for dialogs)
     window = tk.Tk()
+    ui_profiler = ui_profiler_from_env(window)
     
-    # 2. Resolve ADB using new logic
-    adb_executable = resolve_initial_adb()
+    # 2. Resolve ADB using new logic (remembered binary, else race the candidates)
+    startup_timer = PhaseTimer()
+    adb_executable, adb_version, adb_verified = resolve_adb_fast(startup_timer)
+    metrics.meta["adb_version"] = adb_version or "unknown"
     
     # 3. If NOT found (or only Shim found), Ask User
     if not adb_executable:
@@ -344,6 +4342,7 @@ def create_gui():
         
         if file_path and os.path.exists(file_path):
             adb_executable = file_path
+            adb_verified = False
         else:
             # If user cancels, we fall back to "adb" as a hail mary
             adb_executable = "adb" 
@@ -369,13 +4368,6 @@ def create_gui():
     style.configure("Scrcpy.TButton", background="#26c6da", foreground="white", font=bold_font)
     style.map("Scrcpy.TButton", background=[("active", "#00acc1")])
 
-    style.configure("PackageCheckbutton.TCheckbutton", font=("Segoe UI", 11), background="#f5f5f5", anchor="w")
-    style.map("PackageCheckbutton.TCheckbutton", background=[("selected", "#e3f2fd")])
-    style.configure("ExistingPackageCheckbutton.TCheckbutton", font=("Segoe UI", 11, "bold"), foreground="#2e7d32", background="#f5f5f5", anchor="w")
-    style.map("ExistingPackageCheckbutton.TCheckbutton", background=[("selected", "#e8f5e9")])
-    style.configure("MissingPackageCheckbutton.TCheckbutton", font=("Segoe UI", 11, "bold"), foreground="#c62828", background="#f5f5f5", anchor="w")
-    style.map("MissingPackageCheckbutton.TCheckbutton", background=[("selected", "#ffebee")])
-
     paned_window = ttk.Panedwindow(window, orient=tk.HORIZONTAL)
     paned_window.pack(fill=tk.BOTH, expand=True)
 
@@ -384,34 +4376,29 @@ def create_gui():
     controls_frame = ttk.Frame(left_frame, padding=10)
     controls_frame.pack(anchor="nw", fill=tk.X)
 
-    package_list_var = tk.Variable(value=[])
+    view_source = []
     
     def select_file():
         global is_diff_view_active
-        file_path = filedialog.askopenfilename(filetypes=[("Text Files", "*.txt")])
+        file_path = filedialog.askopenfilename(filetypes=[("Package Lists / Profiles", "*.txt *.profile"), ("All Files", "*.*")])
         if file_path:
-            targets = load_package_list(file_path)
-            if not targets: return
-            for _, var, _, _ in checkboxes: var.set(False)
-            
-            match_count = 0
-            first_match_widget = None
-            for cb, var, pkg, _ in checkboxes:
-                if pkg in targets:
-                    var.set(True)
-                    match_count += 1
-                    if first_match_widget is None: first_match_widget = cb
+            profile = load_profile(file_path)
+            if profile is None or not len(profile.rules): return
+            selected, excluded = profile.evaluate(current_source())
+            matches = list(selected)
+            package_view.model.clear_selection()
+            package_view.set_selected(matches)
             
             file_label.config(text=f"Selected: {os.path.basename(file_path)}", foreground="#1565c0")
-            logger.log(f"Auto-selected {match_count} packages from file.", level="SUCCESS")
+            logger.log(f"Auto-selected {len(matches)} packages from file"
+                       + (f" ({len(excluded)} excluded)." if excluded else "."), level="SUCCESS")
+            # Why each package was picked (or dropped) goes next to the device's other lists.
+            save_packages_to_file([f"{pkg}\t{reason}" for pkg, reason in selected.items()]
+                                  + [f"-{pkg}\t{reason}" for pkg, reason in excluded.items()],
+                                  "profile_matches.txt")
 
-            if first_match_widget:
-                window.update_idletasks()
-                try:
-                    widget_y = first_match_widget.winfo_y()
-                    frame_h = scrollable_frame.winfo_height()
-                    if frame_h > 0: canvas.yview_moveto(max(0, (widget_y - 30) / frame_h))
-                except: pass
+            if matches:
+                package_view.scroll_to(matches[0])
         update_diff_btn()
 
     ttk.Button(controls_frame, text="Load List File", command=select_file, style="Action.TButton").pack(side="left", padx=(0, 10))
@@ -427,6 +4414,12 @@ def create_gui():
     refresh_frame = ttk.Frame(controls_frame)
     refresh_frame.pack(side="right")
     
+    device_var = tk.StringVar(value="")
+    device_combo = ttk.Combobox(refresh_frame, textvariable=device_var, state="readonly", width=28)
+    device_combo.pack(side="left", padx=2)
+    fan_out_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(refresh_frame, text="All Devices", variable=fan_out_var).pack(side="left", padx=2)
+
     refresh_btn = ttk.Button(refresh_frame, text="Refresh", command=lambda: fetch_packages_thread(True), style="Action.TButton")
     refresh_btn.pack(side="left", padx=2)
 
@@ -434,154 +4427,445 @@ def create_gui():
     list_container.pack(fill=tk.BOTH, expand=True)
     
     select_all_var = tk.BooleanVar(value=False)
-    checkboxes = []
 
     def toggle_select_all():
-        val = select_all_var.get()
-        for _, var, _, _ in checkboxes: var.set(val)
-
-    ttk.Checkbutton(list_container, text="Select All Displayed", variable=select_all_var, command=toggle_select_all).pack(anchor="w", pady=(0,5))
-
-    canvas = tk.Canvas(list_container, bg="white", highlightthickness=1, highlightbackground="#e0e0e0")
-    scrollbar = ttk.Scrollbar(list_container, orient="vertical", command=canvas.yview)
-    scrollable_frame = ttk.Frame(canvas, style="TFrame")
-    scrollable_frame.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-    canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-    canvas.configure(yscrollcommand=scrollbar.set)
-    canvas.pack(side="left", fill="both", expand=True)
-    scrollbar.pack(side="right", fill="y")
-    
-    def _on_mousewheel(event):
-        canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
-    def _bind_to_mousewheel(event):
-        canvas.bind_all("<MouseWheel>", _on_mousewheel)
-    def _unbind_from_mousewheel(event):
-        canvas.unbind_all("<MouseWheel>")
-    list_container.bind('<Enter>', _bind_to_mousewheel)
-    list_container.bind('<Leave>', _unbind_from_mousewheel)
-    filter_entry.bind("<KeyRelease>", lambda e: update_package_listbox())
+        package_view.set_selected(package_view.rows, select_all_var.get())
+
+    header_frame = ttk.Frame(list_container)
+    header_frame.pack(fill="x", pady=(0,5))
+    ttk.Checkbutton(header_frame, text="Select All Displayed", variable=select_all_var, command=toggle_select_all).pack(side="left")
+    selection_label = ttk.Label(header_frame, text="0 selected", font=("Segoe UI", 9))
+    selection_label.pack(side="right")
+
+    snapshot_kinds = None # {pkg: row kind} while the Diff View shows a snapshot comparison.
+    def row_kind(pkg):
+        if is_diff_view_active:
+            return snapshot_kinds.get(pkg, "missing") if snapshot_kinds is not None else "missing"
+        return "existing" if package_view.model.is_installed(pkg) else "normal"
+
+    def metadata_of(session):
+        if session.metadata is None:
+            session.metadata = MetadataService(session, on_update=lambda names: window.after(0, metadata_arrived, session))
+        return session.metadata
+
+    def metadata_arrived(session):
+        # Rows update in place: a redraw only re-labels the rows in view.
+        if session is get_active_session():
+            package_view.redraw()
+
+    def row_detail(pkg):
+        session = get_active_session()
+        return session.metadata.describe(pkg) if session and session.metadata else None
+
+    def rows_shown(rows):
+        session = get_active_session()
+        if session and not session.detached.is_set():
+            metadata_of(session).request(rows, front=True)
+
+    package_view = VirtualPackageList(list_container, kind_of=row_kind,
+                                      on_select=lambda n: selection_label.config(text=f"{n} selected"),
+                                      describe=row_detail, on_visible=rows_shown)
+    package_view.pack()
+    if ui_profiler:
+        ui_profiler.context = lambda: (f"{current_device_name}: {len(package_view.model.all)} packages, "
+                                       f"{len(package_view.model.installed)} installed, {len(package_view.rows)} rows shown")
+    filter_job = None
+    def schedule_filter(event=None):
+        # Coalesce keystrokes: only the query typed last gets evaluated.
+        nonlocal filter_job
+        if filter_job:
+            window.after_cancel(filter_job)
+        filter_job = window.after(FILTER_DEBOUNCE_MS, run_filter)
+
+    def run_filter():
+        nonlocal filter_job
+        filter_job = None
+        update_package_listbox()
+
+    filter_entry.bind("<KeyRelease>", schedule_filter)
 
     right_frame = ttk.Frame(paned_window, padding=10)
     paned_window.add(right_frame, weight=2)
 
     scrcpy_frame = ttk.LabelFrame(right_frame, text="Scrcpy Tools", padding=10)
     scrcpy_frame.pack(fill=tk.X, pady=(0, 10))
-    ttk.Button(scrcpy_frame, text="Project Screen", command=lambda: run_scrcpy([]), style="Scrcpy.TButton").pack(fill=tk.X, pady=2)
-    ttk.Button(scrcpy_frame, text="Mouse Only (Stealth)", command=lambda: run_scrcpy(["--no-video-playback", "--no-audio", "-K", "-M"]), style="Scrcpy.TButton").pack(fill=tk.X, pady=2)
-    ttk.Button(scrcpy_frame, text="Audio Cast Only", command=lambda: run_scrcpy(["--no-video-playback", "--audio-output-buffer=20"]), style="Scrcpy.TButton").pack(fill=tk.X, pady=2)
+    for preset in SCRCPY_PRESETS:
+        ttk.Button(scrcpy_frame, text=preset, command=lambda p=preset: start_scrcpy(p), style="Scrcpy.TButton").pack(fill=tk.X, pady=2)
+    scrcpy_tree = ttk.Treeview(scrcpy_frame, columns=("preset", "device", "state", "startup", "fps"), show="headings",
+                               height=3, selectmode="browse")
+    for col, title, width in (("preset", "Preset", 140), ("device", "Device", 110), ("state", "State", 70),
+                              ("startup", "Startup", 70), ("fps", "FPS (skipped)", 90)):
+        scrcpy_tree.heading(col, text=title)
+        scrcpy_tree.column(col, width=width, anchor="w")
+    scrcpy_tree.pack(fill=tk.X, pady=(5, 0))
+    scrcpy_controls = ttk.Frame(scrcpy_frame)
+    scrcpy_controls.pack(fill=tk.X, pady=(5, 0))
+
+    def start_scrcpy(preset):
+        scrcpy_manager.start(active_serial, preset)
+        refresh_scrcpy_panel(reschedule=False)
+
+    def scrcpy_command(action):
+        selected = scrcpy_tree.selection()
+        if not selected:
+            return
+        session = scrcpy_rows.get(selected[0])
+        if session:
+            threading.Thread(target=getattr(scrcpy_manager, action), args=(session.serial, session.preset), daemon=True).start()
+
+    for text, action in (("Stop", "stop"), ("Restart", "restart")):
+        ttk.Button(scrcpy_controls, text=text, command=lambda a=action: scrcpy_command(a)).pack(side="right", padx=2)
+
+    scrcpy_rows = {}
+    def refresh_scrcpy_panel(reschedule=True):
+        sessions = scrcpy_manager.list()
+        scrcpy_rows.clear()
+        scrcpy_rows.update((str(id(session)), session) for session in sessions)
+        for iid in scrcpy_tree.get_children():
+            if iid not in scrcpy_rows:
+                scrcpy_tree.delete(iid)
+        for iid, session in scrcpy_rows.items():
+            stats = session.stats()
+            device = device_sessions.get(session.serial)
+            startup = stats["first_frame_s"] if stats["first_frame_s"] is not None else stats["connect_s"]
+            fps = f"{stats['fps_last']} ({stats['frames_skipped']})" if stats["fps_last"] is not None else "-"
+            if stats["running"]:
+                state = "Running"
+            elif stats["exit_code"] is None:
+                state = "Starting"
+            else:
+                state = "Stopped" if session.stopping else f"Exit {stats['exit_code']}"
+            values = (session.preset, device.name if device else session.serial or "default", state,
+                      "-" if startup is None else f"{startup:.1f}s", fps)
+            if scrcpy_tree.exists(iid):
+                scrcpy_tree.item(iid, values=values)
+            else:
+                scrcpy_tree.insert("", "end", iid=iid, values=values)
+        if reschedule:
+            window.after(1000, refresh_scrcpy_panel)
+
+    devices_frame = ttk.LabelFrame(right_frame, text="Devices", padding=5)
+    devices_frame.pack(fill=tk.X, pady=(0, 10))
+    device_tree = ttk.Treeview(devices_frame, columns=("model", "serial", "status"), show="headings", height=4)
+    for col, title, width in (("model", "Model", 140), ("serial", "Serial", 140), ("status", "Status", 160)):
+        device_tree.heading(col, text=title)
+        device_tree.column(col, width=width, anchor="w")
+    device_tree.pack(fill=tk.X)
+    ttk.Button(devices_frame, text="Fleet Matrix...", command=lambda: open_fleet_view(), style="Action.TButton").pack(anchor="e", pady=(5, 0))
+
+    jobs_frame = ttk.LabelFrame(right_frame, text="Jobs", padding=5)
+    jobs_frame.pack(fill=tk.X, pady=(0, 10))
+    jobs_tree = ttk.Treeview(jobs_frame, columns=("job", "device", "action", "progress", "rate", "eta", "state"),
+                             show="headings", height=4, selectmode="browse")
+    for col, title, width in (("job", "#", 30), ("device", "Device", 120), ("action", "Action", 70), ("progress", "Progress", 110),
+                              ("rate", "Rate", 60), ("eta", "ETA", 60), ("state", "State", 80)):
+        jobs_tree.heading(col, text=title)
+        jobs_tree.column(col, width=width, anchor="w")
+    jobs_tree.pack(fill=tk.X)
+    jobs_bar = ttk.Progressbar(jobs_frame, mode="determinate", maximum=1)
+    jobs_bar.pack(fill=tk.X, pady=(5, 0))
+    jobs_controls = ttk.Frame(jobs_frame)
+    jobs_controls.pack(fill=tk.X, pady=(5, 0))
+    jobs_label = ttk.Label(jobs_controls, text="No jobs", font=("Segoe UI", 9))
+    jobs_label.pack(side="left")
+
+    stats_frame = ttk.LabelFrame(right_frame, text="ADB Stats", padding=5)
+    stats_frame.pack(fill=tk.X, pady=(0, 10))
+    stats_tree = ttk.Treeview(stats_frame, columns=("command", "count", "p50", "p95", "spawn", "timeouts", "errors"), show="headings", height=5)
+    for col, title, width in (("command", "Command", 150), ("count", "Runs", 50), ("p50", "p50", 60), ("p95", "p95", 60),
+                              ("spawn", "Spawn avg", 70), ("timeouts", "Timeouts", 60), ("errors", "Errors", 50)):
+        stats_tree.heading(col, text=title)
+        stats_tree.column(col, width=width, anchor="w" if col == "command" else "e")
+    stats_tree.pack(fill=tk.X)
 
     ttk.Label(right_frame, text="System Log:").pack(anchor="w")
     log_textbox = scrolledtext.ScrolledText(right_frame, font=("Consolas", 9), height=15, state='normal')
     log_textbox.pack(fill=tk.BOTH, expand=True)
+
+    scheduler = JobScheduler(on_progress=lambda session, *_: update_device_status(session))
+    JOBS_SHOWN_FINISHED = 10
+
+    def selected_job():
+        selection = jobs_tree.selection()
+        if not selection:
+            return None
+        return next((job for job in scheduler.jobs if str(job.id) == selection[0]), None)
+
+    def job_command(action):
+        job = selected_job()
+        if job is None:
+            logger.log("Select a job first.", level="WARNING")
+            return
+        getattr(scheduler, action)(job)
+        refresh_jobs_panel(reschedule=False)
+
+    for text, action in (("Cancel", "cancel"), ("Run Next", "prioritize"), ("Resume", "resume"), ("Pause", "pause")):
+        ttk.Button(jobs_controls, text=text, command=lambda a=action: job_command(a)).pack(side="right", padx=2)
+
+    def fmt_duration(seconds):
+        if seconds is None:
+            return "-"
+        seconds = int(seconds)
+        return f"{seconds // 60}:{seconds % 60:02d}" if seconds >= 60 else f"{seconds}s"
+
+    def refresh_jobs_panel(reschedule=True):
+        finished = [job for job in scheduler.jobs if not job.active][-JOBS_SHOWN_FINISHED:]
+        shown = [job for job in scheduler.jobs if job.active or job in finished]
+        ids = {str(job.id) for job in shown}
+        for iid in jobs_tree.get_children():
+            if iid not in ids:
+                jobs_tree.delete(iid)
+        for job in shown:
+            rate = job.rate()
+            progress = f"{job.done}/{job.total}" + (f" ({job.failed} failed)" if job.failed else "")
+            values = (job.id, job.session.name, job.action, progress,
+                      f"{rate:.1f}/s" if rate else "-", fmt_duration(job.eta()), job.state)
+            iid = str(job.id)
+            if jobs_tree.exists(iid):
+                jobs_tree.item(iid, values=values)
+            else:
+                jobs_tree.insert("", "end", iid=iid, values=values)
+        done, total, rate, eta = scheduler.progress()
+        jobs_bar.config(value=done / total if total else 0)
+        if total:
+            jobs_label.config(text=f"{done}/{total} packages" + (f" | {rate:.1f}/s | ETA {fmt_duration(eta)}" if rate else ""))
+        else:
+            jobs_label.config(text="No jobs running")
+        if reschedule:
+            window.after(500, refresh_jobs_panel)
+
+    stats_shown = None
+    def refresh_stats_panel():
+        # Polled rather than pushed: metrics change once per adb call, far faster than worth redrawing.
+        nonlocal stats_shown
+        if (metrics.version, active_serial) != stats_shown:
+            stats_shown = (metrics.version, active_serial)
+            fmt = lambda value: "-" if value is None else f"{value * 1000:.0f} ms"
+            stats_tree.delete(*stats_tree.get_children())
+            for serial, kind, stats in metrics.rows():
+                if serial not in ("", active_serial):
+                    continue # Host-wide commands plus the active device only.
+                stats_tree.insert("", "end", values=(kind, stats.count, fmt(stats.quantile(0.5)), fmt(stats.quantile(0.95)),
+                                                     fmt(stats.spawn_sum / stats.count), stats.timeouts, stats.errors()))
+        window.after(1000, refresh_stats_panel)
     
     logger = Logger(log_textbox)
+    if ui_profiler:
+        logger.log(f"UI profiler on: stalls over {ui_profiler.stall * 1000:.0f} ms are reported in {ui_profiler.path}", level="WARNING")
     logger.log(f"GUI Started. Initial ADB: {adb_executable}", level="HEADER")
+    if enable_native_adb_from_env():
+        logger.log("Native ADB client enabled (in-process host protocol).", level="INFO")
+
+    def current_source():
+        return diff_list if is_diff_view_active else view_source
 
+    source_lookup = (None, None, {}, None) # (source, device engine, position, engine for source)
     def update_package_listbox():
-        nonlocal checkboxes
-        for cb, _, _, _ in checkboxes: cb.destroy()
-        checkboxes = []
-        filter_txt = filter_entry.get().lower()
-        source = diff_list if is_diff_view_active else package_list_var.get()
-        
-        for pkg in source:
-            if filter_txt in pkg.lower():
-                var = tk.BooleanVar(value=select_all_var.get())
-                is_inst = pkg in existing_packages
-                style_n = "MissingPackageCheckbutton.TCheckbutton" if is_diff_view_active else ("ExistingPackageCheckbutton.TCheckbutton" if is_inst else "PackageCheckbutton.TCheckbutton")
-                cb = ttk.Checkbutton(scrollable_frame, text=pkg, variable=var, style=style_n)
-                cb.pack(anchor="w", fill="x", pady=1)
-                checkboxes.append((cb, var, pkg, is_inst))
-
-    def fetch_packages_thread(get_all=False):
+        nonlocal source_lookup
+        source = current_source()
+        session = get_active_session()
+        shared = session.package_filter if session else None
+        if source_lookup[0] is not source or source_lookup[1] is not shared:
+            # The device's engine indexes its full list; a source with names
+            # outside it (a diff against a snapshot or profile) gets its own.
+            covered = shared is not None and all(pkg in shared.position for pkg in source)
+            source_lookup = (source, shared, {pkg: i for i, pkg in enumerate(source)},
+                             shared if covered else PackageFilter(source))
+        _, _, position, engine = source_lookup
+
+        rows = filter_rows(source, engine, filter_entry.get(), position)
+        filter_entry.config(bg="#ffebee" if engine.error else "white")
+        package_view.set_rows(rows)
+        if session and filter_entry.get().strip() and not session.detached.is_set():
+            metadata_of(session).request(rows[:METADATA_FILTER_PREFETCH])
+
+    def refresh_device_panel():
+        device_tree.delete(*device_tree.get_children())
+        for session in device_sessions.values():
+            device_tree.insert("", "end", iid=session.serial, values=(session.name, session.serial, session.status))
+        device_combo["values"] = [session.label for session in device_sessions.values()]
+        active = get_active_session()
+        device_var.set(active.label if active else "")
+
+    def update_device_status(session, *_):
+        def _update():
+            if device_tree.exists(session.serial):
+                device_tree.set(session.serial, "status", session.status)
+        window.after(0, _update)
+
+    def show_active_device(get_all=True):
+        nonlocal view_source
+        session = get_active_session()
+        if session is None:
+            return
+        window.title(f"ADB Manager - {session.name}")
+        package_view.set_model(session.model)
+        view_source = session.model.all_names() if get_all else session.model.installed_names()
+        update_package_listbox()
+        update_diff_btn()
+
+    def on_device_selected(event=None):
+        labels = list(device_combo["values"])
+        label = device_var.get()
+        if label not in labels:
+            return
+        session = list(device_sessions.values())[labels.index(label)]
+        set_active_session(session.serial)
+        logger.log(f"Active device: {session.label}", level="INFO")
+        show_active_device()
+
+    device_combo.bind("<<ComboboxSelected>>", on_device_selected)
+
+    def fetch_packages_thread(get_all=False, use_cache=False, timer=None):
         logger.log("Initiating ADB connection...", level="HEADER")
         refresh_btn.config(state="disabled")
 
         def task():
-            global existing_packages, installed_packages_cache, all_packages_cache, current_device_name, device_folder, adb_executable
-            
             logger.log("Scanning for active ADB connection...", level="INFO")
             # FIX: Kill command removed.
-            
-            # PHASE 1: Try System ADB (with safety net)
-            logger.log(f"Attempting connection with: {adb_executable}", level="INFO")
-            new_device_name, error_reason = get_device_name_with_tool(adb_executable)
-            
-            # PHASE 2: Fallback to Bundled
-            if not new_device_name:
-                logger.log(f"Connection failed ({error_reason}).", level="WARNING")
-                
-                bundled_adb = get_bundled_path("adb.exe")
-                if adb_executable != bundled_adb and os.path.exists(bundled_adb):
-                    logger.log("Switching to Bundled ADB...", level="WARNING")
-                    
-                    # We only force kill if the FIRST attempt failed, just in case the shim is truly broken.
-                    force_kill_all_adb() 
-                    adb_executable = bundled_adb
-                    
-                    new_device_name, error_reason = get_device_name_with_tool(adb_executable)
-
-            if new_device_name is None:
+            found, error_reason = connect_devices(verified=timer is not None and adb_verified, timer=timer)
+
+            if not found:
                 msg = f"Failed to connect. Error: {error_reason}. Check cable/drivers."
                 window.after(0, lambda: logger.log(msg, level="ERROR"))
                 window.after(0, lambda: refresh_btn.config(state="normal"))
                 window.after(0, lambda: window.title("ADB Manager - No Device"))
+                window.after(0, start_device_watcher)
                 return
 
-            if new_device_name != current_device_name or "Unknown" in device_folder:
-                current_device_name = new_device_name
-                
-                # --- UPDATE FIX: Use correct path for new folder creation ---
-                if getattr(sys, 'frozen', False):
-                    app_path = os.path.dirname(sys.executable)
-                else:
-                    app_path = os.path.dirname(os.path.abspath(__file__))
-                    
-                device_folder = os.path.join(app_path, current_device_name)
-                
-                if not os.path.exists(device_folder):
-                    try: os.makedirs(device_folder)
-                    except: pass
-
-                logger.update_log_path(device_folder)
-                window.after(0, lambda: window.title(f"ADB Manager - {current_device_name}"))
-
-            logger.log("Fetching packages...", level="HEADER")
-            
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as exc:
-                f1 = exc.submit(get_installed_packages_worker, False)
-                f2 = exc.submit(get_installed_packages_worker, True)
-                try:
-                    res1, res2 = f1.result(), f2.result()
-                    existing_packages = res1
-                    installed_packages_cache[:] = res1
-                    all_packages_cache[:] = res2
-                    save_packages_to_file(res1, "installed_packages.txt")
-                    save_packages_to_file(res2, "all_installed_packages.txt")
-                    
-                    def update_ui():
-                        package_list_var.set(all_packages_cache if get_all else existing_packages)
-                        logger.log(f"Fetched {len(all_packages_cache if get_all else existing_packages)} packages.", level="SUCCESS")
-                        update_package_listbox()
-                        update_diff_btn()
-                        refresh_btn.config(state="normal")
-                    window.after(0, update_ui)
-                except Exception as e:
-                    window.after(0, lambda: logger.log(f"Fetch Error: {e}", level="ERROR"))
-                    window.after(0, lambda: refresh_btn.config(state="normal"))
+            sessions = build_sessions(found)
+            logger.log(f"Connected to {len(sessions)} device(s).", level="SUCCESS")
+
+            for session in sessions.values():
+                session.status = "Fetching"
+            set_active_session(active_serial if active_serial in device_sessions else next(iter(device_sessions)))
+            window.after(0, refresh_device_panel)
+
+            def on_cached(session):
+                if session.serial == active_serial:
+                    window.after(0, lambda: show_active_device(get_all))
+            mark = timer.start("fetch packages") if timer else None
+            run_on_devices(fetch_session_packages, list(sessions.values()), use_cache=use_cache, on_cached=on_cached)
+            if timer:
+                timer.stop(mark)
+                logger.log(f"Startup timing: {timer.summary()}", level="INFO")
+                save_adb_probe(adb_executable, adb_version if adb_verified else None, timer)
+
+            def update_ui():
+                refresh_device_panel()
+                show_active_device(get_all)
+                refresh_btn.config(state="normal")
+                start_device_watcher()
+                for session in sessions.values():
+                    if session.metadata:
+                        session.metadata.retry()
+                    offer_pending_jobs(session)
+            window.after(0, update_ui)
         
         threading.Thread(target=task, daemon=True).start()
 
+    device_watcher = None
+    def start_device_watcher():
+        nonlocal device_watcher
+        if device_watcher is None:
+            known = {serial: "device" for serial, session in device_sessions.items() if not session.detached.is_set()}
+            device_watcher = DeviceWatcher(on_device_change, known).start()
+            logger.log("Watching for devices being plugged in or removed.", level="INFO")
+
+    def refetch_device(session):
+        """Refreshes one device's inventory after it (re)attached."""
+        fetch_session_packages(session, use_cache=True)
+        if session.metadata:
+            session.metadata.retry()
+        def update_ui():
+            refresh_device_panel()
+            if session.serial == active_serial:
+                show_active_device()
+            offer_pending_jobs(session)
+        window.after(0, update_ui)
+
+    def offer_pending_jobs(session):
+        """Offers to re-queue the work a previous run left unfinished on this device."""
+        entries = load_pending_jobs(session)
+        if not entries:
+            return
+        count = sum(len(entry["packages"]) for entry in entries)
+        if messagebox.askyesno("Unfinished Jobs", f"{count} package(s) were left unfinished on {session.label} last time.\n\nQueue them again?"):
+            for entry in entries:
+                scheduler.submit(Job(session, entry["action"], entry["packages"], batch=entry.get("batch", True),
+                                     options=entry.get("options"), on_done=lambda job: window.after(0, after_job)))
+            logger.log(f"Re-queued {count} unfinished package(s).", level="INFO", device=session)
+        else:
+            logger.log(f"Discarded {count} unfinished package(s) from the last session.", level="INFO", device=session)
+
+    def after_job():
+        # The models were updated package by package; only re-read the views.
+        global diff_list
+        if is_diff_view_active and snapshot_kinds is None:
+            diff_list = package_view.model.missing_names()
+        refresh_device_panel()
+        update_package_listbox()
+        update_diff_btn()
+
+    def on_device_change(serial, old_state, new_state):
+        # Runs on the watcher thread; attach() runs on the Tk thread, and a
+        # refresh may rebuild device_sessions on its worker meanwhile.
+        session = device_sessions.get(serial)
+        if new_state == "device":
+            name = read_device_model(adb_executable, serial) or (session.name if session else "Unknown_Device")
+            def attach():
+                with device_sessions_lock:
+                    current = device_sessions.get(serial)
+                    if current is None or current.name != name:
+                        current = DeviceSession(serial, name)
+                        device_sessions[serial] = current
+                current.ensure_folder()
+                current.detached.clear()
+                current.status = "Fetching"
+                logger.log(f"Device attached: {current.label}", level="SUCCESS")
+                if get_active_session() is None:
+                    set_active_session(serial)
+                refresh_device_panel()
+                threading.Thread(target=refetch_device, args=(current,), daemon=True).start()
+            window.after(0, attach)
+        elif old_state == "device":
+            if session:
+                session.detached.set()
+                session.status = "Disconnected"
+            stopped = close_streams(serial)
+            logger.log(f"Device {'removed' if new_state is None else new_state}: {session.label if session else serial}"
+                       + (f"; stopped {stopped} running command(s)." if stopped else "."), level="WARNING")
+            window.after(0, refresh_device_panel)
+        elif new_state == "unauthorized":
+            logger.log(f"Device {serial} is unauthorized; accept the USB debugging prompt on the phone.", level="WARNING")
+        elif new_state:
+            logger.log(f"Device {serial}: {new_state}", level="INFO")
+
     def perform(action):
-        sel = [pkg for _, var, pkg, _ in checkboxes if var.get()]
+        sel = package_view.model.selected_names()
         if not sel: 
             logger.log("No selection made.", level="WARNING")
             return
 
-        if action == "uninstall":
-            threading.Thread(target=uninstall_packages, args=(sel,)).start()
-        elif action == "install":
-            threading.Thread(target=install_existing_packages, args=(sel,)).start()
+        targets = list(device_sessions.values()) if fan_out_var.get() else [get_active_session()]
+        targets = [session for session in targets if session and not session.detached.is_set()]
+        if action in JOB_ACTIONS and not targets:
+            logger.log("No device connected.", level="ERROR")
+            return
+
+        if action in JOB_ACTIONS:
+            options = {"backup": True} if action == "uninstall" and backup_var.get() else None
+            for session in targets:
+                packages = sel
+                if action == "restore":
+                    manifest = load_backup_manifest(session)
+                    packages = [pkg for pkg in sel if pkg in manifest]
+                    if len(packages) < len(sel):
+                        logger.log(f"{len(sel) - len(packages)} selected package(s) have no backup.", level="WARNING", device=session)
+                    if not packages:
+                        continue
+                scheduler.submit(Job(session, action, packages, options=options, on_done=lambda job: window.after(0, after_job)))
+            logger.log(f"Queued {action} of {len(sel)} packages on {len(targets)} device(s).", level="INFO")
         elif action == "save":
             path = filedialog.asksaveasfilename(initialdir=device_folder, defaultextension=".txt", initialfile=f"{current_device_name}_selection.txt")
             if path:
@@ -594,12 +4878,16 @@ def create_gui():
     actions_frame.pack(side="bottom", fill="x", padx=10, pady=10)
     
     def clear_sel():
-        for _, var, _, _ in checkboxes: var.set(False)
+        package_view.clear_selection()
+        select_all_var.set(False)
         logger.log("Selection cleared.", level="INFO")
     
     ttk.Button(actions_frame, text="Clear Selection", command=clear_sel, style="Clear.TButton").pack(side="left", padx=(0, 10))
     ttk.Button(actions_frame, text="Uninstall Selected", command=lambda: perform("uninstall"), style="Uninstall.TButton").pack(side="left", fill="x", expand=True, padx=2)
     ttk.Button(actions_frame, text="Install Selected", command=lambda: perform("install"), style="Install.TButton").pack(side="left", fill="x", expand=True, padx=2)
+    ttk.Button(actions_frame, text="Restore Backup", command=lambda: perform("restore"), style="Install.TButton").pack(side="left", padx=2)
+    backup_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(actions_frame, text="Backup APKs", variable=backup_var).pack(side="left", padx=(10, 0))
 
     extra_frame = ttk.Frame(left_frame, padding=(10, 0))
     extra_frame.pack(side="bottom", fill="x")
@@ -607,17 +4895,22 @@ def create_gui():
     diff_btn = ttk.Button(extra_frame, text="Show Diff", command=lambda: toggle_diff(), state="disabled", style="Action.TButton")
     diff_btn.pack(side="right")
     
+    ttk.Button(extra_frame, text="Snapshots...", command=lambda: open_snapshot_diff(), style="Action.TButton").pack(side="right", padx=(5, 0))
+    ttk.Button(extra_frame, text="History...", command=lambda: open_history(), style="Action.TButton").pack(side="right", padx=(5, 0))
     ttk.Button(extra_frame, text="Save Selection", command=lambda: perform("save"), style="Action.TButton").pack(side="right", padx=5)
 
     def update_diff_btn():
-        state = "normal" if installed_packages_cache and all_packages_cache else "disabled"
+        model = package_view.model
+        state = "normal" if model.installed and model.all else "disabled"
         diff_btn.config(state=state)
 
     def toggle_diff():
         global is_diff_view_active, diff_list
+        nonlocal snapshot_kinds
         is_diff_view_active = not is_diff_view_active
+        snapshot_kinds = None
         if is_diff_view_active:
-            diff_list = sorted(list(set(all_packages_cache) - set(installed_packages_cache)))
+            diff_list = package_view.model.missing_names()
             diff_btn.config(text="Exit Diff View", style="Clear.TButton")
             logger.log(f"Diff View: {len(diff_list)} missing packages.", level="WARNING")
         else:
@@ -625,18 +4918,484 @@ def create_gui():
             logger.log("Exited Diff View.", level="INFO")
         update_package_listbox()
 
+    def show_snapshot_diff(store, a, b):
+        global is_diff_view_active, diff_list
+        nonlocal snapshot_kinds
+        changes = store.diff(a, b)
+        # Newly installed rows show green, removed ones red.
+        snapshot_kinds = {pkg: "missing" for pkg in changes["installed_removed"]}
+        snapshot_kinds.update((pkg, "existing") for pkg in changes["installed_added"])
+        diff_list = sorted(snapshot_kinds)
+        is_diff_view_active = True
+        diff_btn.config(text="Exit Diff View", style="Clear.TButton", state="normal")
+        logger.log(f"Snapshot #{a} -> #{b}: +{len(changes['installed_added'])} installed, -{len(changes['installed_removed'])} removed, "
+                   f"{len(changes['all_added'])} new / {len(changes['all_removed'])} gone from all packages.", level="WARNING")
+        update_package_listbox()
+
+    def open_snapshot_diff():
+        session = get_active_session()
+        if session is None:
+            logger.log("No device connected.", level="ERROR")
+            return
+        store = SnapshotStore(session.folder)
+        snaps = store.snapshots()
+        if len(snaps) < 2:
+            logger.log("Need at least two snapshots; they are taken on every fetch.", level="WARNING")
+            return
+
+        dialog = tk.Toplevel(window)
+        dialog.title(f"Snapshots - {session.name}")
+        dialog.transient(window)
+        def build_of(fingerprint):
+            # brand/product/device:release/BUILD_ID/INCREMENTAL:type/tags -> BUILD_ID.INCREMENTAL
+            parts = (fingerprint or "?").split("/")
+            return f"{parts[3]}.{parts[4].split(':')[0]}" if len(parts) > 4 else parts[0]
+        labels = [f"#{snap['id']}  {snap['taken_at'].replace('T', ' ')}  {snap['installed_count']}/{snap['all_count']} pkgs  "
+                  f"build {build_of(snap['fingerprint'])}" for snap in snaps]
+        ids = [snap["id"] for snap in snaps]
+        choices = []
+        for row, (title, default) in enumerate((("From (A):", len(snaps) - 2), ("To (B):", len(snaps) - 1))):
+            ttk.Label(dialog, text=title).grid(row=row, column=0, sticky="w", padx=10, pady=5)
+            combo = ttk.Combobox(dialog, values=labels, state="readonly", width=70)
+            combo.current(default)
+            combo.grid(row=row, column=1, padx=10, pady=5)
+            choices.append(combo)
+
+        def compare():
+            show_snapshot_diff(store, ids[choices[0].current()], ids[choices[1].current()])
+            dialog.destroy()
+
+        def since_ota():
+            pair = store.last_ota()
+            if pair is None:
+                logger.log("No build fingerprint change recorded for this device.", level="WARNING")
+                return
+            choices[0].current(ids.index(pair[0]))
+            choices[1].current(ids.index(pair[1]))
+
+        buttons = ttk.Frame(dialog, padding=10)
+        buttons.grid(row=2, column=0, columnspan=2, sticky="e")
+        ttk.Button(buttons, text="Since Last OTA", command=since_ota, style="Action.TButton").pack(side="left", padx=5)
+        ttk.Button(buttons, text="Compare", command=compare, style="Action.TButton").pack(side="left")
+
+    def open_history():
+        session = get_active_session()
+        if session is None:
+            logger.log("No device connected.", level="ERROR")
+            return
+        journal = OperationJournal(session)
+        runs = journal.runs()
+        if not runs:
+            logger.log(f"No operations recorded yet in {JOURNAL_FILE}.", level="WARNING")
+            return
+
+        dialog = tk.Toplevel(window)
+        dialog.title(f"History - {session.name}")
+        dialog.transient(window)
+        dialog.geometry("800x450")
+        runs_tree = ttk.Treeview(dialog, columns=("started", "actions", "ok", "failed", "origin"), show="headings", height=12)
+        for col, title, width in (("started", "Started", 150), ("actions", "Actions", 130), ("ok", "OK", 60),
+                                  ("failed", "Failed", 60), ("origin", "Origin", 300)):
+            runs_tree.heading(col, text=title)
+            runs_tree.column(col, width=width, anchor="w")
+        for run in reversed(runs):
+            runs_tree.insert("", "end", iid=run["run"], values=(run["started"].replace("T", " "), ", ".join(run["actions"]),
+                                                                 run["ok"], run["failed"], run["origin"] or ""))
+        runs_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+
+        range_frame = ttk.Frame(dialog, padding=(10, 0))
+        range_frame.pack(fill=tk.X)
+        bounds = []
+        for title in ("Since:", "Until:"):
+            ttk.Label(range_frame, text=title).pack(side="left")
+            entry = ttk.Entry(range_frame, width=22)
+            entry.pack(side="left", padx=(2, 10))
+            bounds.append(entry)
+        ttk.Label(range_frame, text="(ISO time, e.g. 2024-05-01T12:00; applies when no run is selected)").pack(side="left")
+
+        def apply(mode):
+            selected = list(runs_tree.selection())
+            since, until = (entry.get().strip() or None for entry in bounds)
+            if not selected and not (since or until):
+                messagebox.showinfo("History", "Select one or more runs, or enter a time range.", parent=dialog)
+                return
+            entries = journal.select(selected, None, None) if selected else journal.select(None, since, until)
+            targets = journal_targets(entries, mode)
+            if not targets:
+                logger.log(f"Nothing to {mode}: the chosen entries changed no package.", level="WARNING", device=session)
+                return
+            origin = f"{mode} of {', '.join(selected)}" if selected else f"{mode} of {since or '...'} to {until or 'now'}"
+            if not messagebox.askyesno("History", f"{mode.capitalize()} {len(targets)} package(s) on {session.name}?", parent=dialog):
+                return
+            scheduler.submit(Job(session, mode, list(targets), options={"targets": targets, "origin": origin},
+                                 on_done=lambda job: window.after(0, after_job)))
+            logger.log(f"Queued {origin} ({len(targets)} packages).", level="INFO", device=session)
+            dialog.destroy()
+
+        buttons = ttk.Frame(dialog, padding=10)
+        buttons.pack(fill=tk.X)
+        ttk.Button(buttons, text="Replay", command=lambda: apply("replay"), style="Action.TButton").pack(side="right", padx=5)
+        ttk.Button(buttons, text="Revert", command=lambda: apply("revert"), style="Action.TButton").pack(side="right")
+
+    def open_fleet_view():
+        dialog = tk.Toplevel(window)
+        dialog.title("Fleet Matrix")
+        dialog.geometry("1000x650")
+        summary = ttk.Label(dialog, text="Loading device inventories...", padding=10)
+        summary.pack(anchor="w")
+        state = {"fleet": None, "profile": None, "profile_name": "majority"}
+
+        top = ttk.Frame(dialog, padding=(10, 0))
+        top.pack(fill=tk.X)
+        dev_tree = ttk.Treeview(dialog, columns=("device", "score", "extra", "missing", "flag"), show="headings", height=8)
+        for col, title, width in (("device", "Device", 260), ("score", "Deviation", 80), ("extra", "Extra", 70),
+                                  ("missing", "Missing", 70), ("flag", "", 80)):
+            dev_tree.heading(col, text=title)
+            dev_tree.column(col, width=width, anchor="w" if col == "device" else "e")
+        dev_tree.pack(fill=tk.X, padx=10, pady=5)
+        # The matrix shows one page of packages x devices at a time, so a big
+        # fleet never puts more than FLEET_PAGE_ROWS * FLEET_PAGE_DEVICES cells in Tk.
+        FLEET_PAGE_ROWS = 200
+        FLEET_PAGE_DEVICES = 25
+        pager = ttk.Frame(dialog, padding=(10, 0))
+        pager.pack(fill=tk.X)
+        page_label = ttk.Label(pager, text="")
+        matrix_frame = ttk.Frame(dialog)
+        matrix_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        state.update(differing=[], row_page=0, device_page=0)
+
+        def show_page():
+            fleet = state["fleet"]
+            differing = state["differing"]
+            rows_pages = max(1, -(-len(differing) // FLEET_PAGE_ROWS))
+            device_pages = max(1, -(-len(fleet.devices) // FLEET_PAGE_DEVICES))
+            state["row_page"] = min(max(state["row_page"], 0), rows_pages - 1)
+            state["device_page"] = min(max(state["device_page"], 0), device_pages - 1)
+            first_row = state["row_page"] * FLEET_PAGE_ROWS
+            first_device = state["device_page"] * FLEET_PAGE_DEVICES
+            devices = fleet.devices[first_device:first_device + FLEET_PAGE_DEVICES]
+            packages = differing[first_row:first_row + FLEET_PAGE_ROWS]
+            page_label.config(text=f"Packages {first_row + 1 if packages else 0}-{first_row + len(packages)} of {len(differing)}, "
+                                   f"devices {first_device + 1}-{first_device + len(devices)} of {len(fleet.devices)}")
+            for child in matrix_frame.winfo_children():
+                child.destroy()
+            columns = ["count"] + [f"d{i}" for i in range(len(devices))]
+            grid = ttk.Treeview(matrix_frame, columns=columns, show="tree headings")
+            grid.heading("#0", text="Package")
+            grid.column("#0", width=300)
+            grid.heading("count", text="#")
+            grid.column("count", width=40, anchor="e")
+            for i, device in enumerate(devices):
+                grid.heading(f"d{i}", text=device)
+                grid.column(f"d{i}", width=110, anchor="center")
+            for pkg, present in fleet.rows(packages):
+                shown = present[first_device:first_device + FLEET_PAGE_DEVICES]
+                grid.insert("", "end", text=pkg, values=[sum(present)] + ["\u25cf" if flag else "" for flag in shown])
+            x_scroll = ttk.Scrollbar(matrix_frame, orient="horizontal", command=grid.xview)
+            y_scroll = ttk.Scrollbar(matrix_frame, orient="vertical", command=grid.yview)
+            grid.configure(xscrollcommand=x_scroll.set, yscrollcommand=y_scroll.set)
+            y_scroll.pack(side="right", fill="y")
+            x_scroll.pack(side="bottom", fill="x")
+            grid.pack(fill=tk.BOTH, expand=True)
+
+        def turn(key, step):
+            if state["fleet"]:
+                state[key] += step
+                show_page()
+
+        for text, key, step in (("< Packages", "row_page", -1), ("Packages >", "row_page", 1),
+                                ("< Devices", "device_page", -1), ("Devices >", "device_page", 1)):
+            ttk.Button(pager, text=text, command=lambda k=key, d=step: turn(k, d)).pack(side="left", padx=(0, 5))
+        page_label.pack(side="left", padx=10)
+
+        def show():
+            fleet = state["fleet"]
+            profile = state["profile"]
+            deviations = fleet.deviations(profile)
+            scores = fleet.deviation_scores(profile)
+            outliers = {device for device, _ in fleet.outliers(profile)}
+            differing = fleet.differing()
+            summary.config(text=f"{len(fleet.devices)} devices, {len(fleet.packages)} packages, {len(differing)} differ between devices. "
+                                f"Compared against: {state['profile_name']} ({'NumPy' if fleet.use_numpy else 'bitset'} backend).")
+            dev_tree.delete(*dev_tree.get_children())
+            for device in sorted(fleet.devices, key=lambda d: -scores[d]):
+                dev_tree.insert("", "end", values=(device, scores[device], len(deviations[device]["extra"]),
+                                                   len(deviations[device]["missing"]), "OUTLIER" if device in outliers else ""))
+            state["differing"] = differing
+            show_page()
+
+        def load_golden():
+            path = filedialog.askopenfilename(parent=dialog, filetypes=[("Text Files", "*.txt")])
+            if path:
+                state["profile"] = load_package_list(path)
+                state["profile_name"] = os.path.basename(path)
+                show()
+
+        def use_majority():
+            state["profile"], state["profile_name"] = None, "majority"
+            show()
+
+        def export(kind):
+            fleet = state["fleet"]
+            path = filedialog.asksaveasfilename(parent=dialog, initialdir=application_path, defaultextension=f".{kind}",
+                                                initialfile=f"fleet_matrix.{kind}")
+            if not path:
+                return
+            try:
+                if kind == "csv":
+                    fleet.export_csv(path)
+                else:
+                    with open(path, "w", encoding="utf-8") as f:
+                        json.dump(fleet.to_json(state["profile"]), f, indent=2)
+                logger.log(f"Fleet matrix exported to {os.path.basename(path)}", level="SUCCESS")
+            except Exception as e:
+                messagebox.showerror("Error", str(e), parent=dialog)
+
+        ttk.Button(top, text="Compare to Majority", command=use_majority, style="Action.TButton").pack(side="left")
+        ttk.Button(top, text="Golden Profile...", command=load_golden, style="Action.TButton").pack(side="left", padx=5)
+        ttk.Button(top, text="Export CSV", command=lambda: export("csv"), style="Action.TButton").pack(side="right")
+        ttk.Button(top, text="Export JSON", command=lambda: export("json"), style="Action.TButton").pack(side="right", padx=5)
+
+        def build():
+            try:
+                fleet = FleetMatrix.load()
+            except Exception as e:
+                window.after(0, lambda msg=str(e): summary.config(text=f"Could not load inventories: {msg}"))
+                return
+            def ready():
+                state["fleet"] = fleet
+                if not fleet.devices:
+                    summary.config(text="No device inventories found yet; fetch packages on each device first.")
+                    return
+                show()
+            window.after(0, ready)
+        threading.Thread(target=build, daemon=True).start()
+
+    JOB_SHUTDOWN_TIMEOUT = 30
+    closing = False
     def on_closing():
+        nonlocal closing
+        if closing:
+            # Second close while draining: stop instead of waiting for everything.
+            scheduler.stop()
+            return
+        if scheduler.active_jobs():
+            answer = messagebox.askyesnocancel(
+                "Jobs Running",
+                "Jobs are still running.\n\nYes: finish them, then close.\n"
+                "No: stop after the current step and offer the rest next time.")
+            if answer is None:
+                return
+            closing = True
+            window.title("ADB Manager - Closing...")
+            if answer:
+                scheduler.drain()
+                logger.log("Finishing queued jobs before closing...", level="HEADER")
+                wait_for_jobs(None)
+            else:
+                scheduler.stop()
+                logger.log("Stopping jobs before closing...", level="HEADER")
+                wait_for_jobs(time.monotonic() + JOB_SHUTDOWN_TIMEOUT)
+            return
+        close_app()
+
+    def wait_for_jobs(deadline):
+        if scheduler.busy() and (deadline is None or time.monotonic() < deadline):
+            window.after(200, wait_for_jobs, deadline)
+            return
+        saved = scheduler.save_pending()
+        if saved:
+            logger.log(f"Saved {saved} unfinished package(s) to {PENDING_JOBS_FILE}.", level="WARNING")
+        close_app()
+
+    def close_app():
         logger.log("Stopping ADB server and closing...", level="HEADER")
+        for session in device_sessions.values():
+            if session.metadata:
+                session.metadata.close()
+        if device_watcher:
+            device_watcher.stop()
+        scrcpy_manager.stop_all()
+        if ui_profiler:
+            ui_profiler.uninstall()
+            ui_profiler.write_report()
         try:
             force_kill_all_adb()
         except: pass
+        logger.close()
         window.destroy()
         sys.exit(0)
 
     window.protocol("WM_DELETE_WINDOW", on_closing)
 
-    fetch_packages_thread(True)
+    fetch_packages_thread(True, use_cache=True, timer=startup_timer)
+    refresh_stats_panel()
+    refresh_jobs_panel()
+    refresh_scrcpy_panel()
     window.mainloop()
 
+# --- HEADLESS CLI ---
+def load_plan(path):
+    """
+    Reads a plan file. JSON plans look like {"uninstall": [...], "install": [...], "restore": [...]};
+    any other file is a package list (one per line) to uninstall.
+    """
+    if path.lower().endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        return {action: list(plan.get(action, [])) for action in ("uninstall", "install", "restore")}
+    return {"uninstall": read_package_list(path), "install": [], "restore": []}
+
+def run_headless(argv):
+    """Command-line entry point for CI provisioning. Never imports tkinter."""
+    import argparse
+    global logger, adb_executable
+
+    parser = argparse.ArgumentParser(prog="uninstall.py", description="Headless ADB package manager. Prints JSON results.")
+    parser.add_argument("--adb", help="Path to the adb binary (default: auto-detect).")
+    parser.add_argument("--serial", action="append", default=[], help="Device serial to target (repeatable).")
+    parser.add_argument("--all-devices", action="store_true", help="Target every attached device.")
+    parser.add_argument("--plan", action="append", default=[], help="Plan file: .json plan or a package list to uninstall (repeatable).")
+    parser.add_argument("--uninstall", action="append", default=[], metavar="FILE", help="Package list file to uninstall (repeatable).")
+    parser.add_argument("--install", action="append", default=[], metavar="FILE", help="Package list file to install-existing (repeatable).")
+    parser.add_argument("--profile", action="append", default=[], metavar="FILE",
+                        help="Debloat profile (globs, regexes, vendor prefixes, excludes, includes) matched against each device's installed packages and uninstalled (repeatable).")
+    parser.add_argument("--restore", action="append", default=[], metavar="FILE", help="Package list file to reinstall from APK backups (repeatable).")
+    parser.add_argument("--backup", action="store_true", help="Back up APKs to the shared store before uninstalling; packages that fail to back up are kept.")
+    parser.add_argument("--list", action="store_true", help="Include the package inventory in the output.")
+    parser.add_argument("--history", action="store_true", help=f"Include the runs recorded in each device's {JOURNAL_FILE}.")
+    parser.add_argument("--revert", action="append", default=[], metavar="RUN",
+                        help="Undo a journal run: run id, 'last' or 'all' (repeatable; narrow with --since/--until).")
+    parser.add_argument("--replay", action="append", default=[], metavar="RUN",
+                        help="Redo a journal run: run id, 'last' or 'all' (repeatable; narrow with --since/--until).")
+    parser.add_argument("--since", metavar="TIME", help="With --revert/--replay: only entries at or after this ISO time.")
+    parser.add_argument("--until", metavar="TIME", help="With --revert/--replay: only entries at or before this ISO time.")
+    parser.add_argument("--no-batch", action="store_true", help="Run one adb process per package.")
+    parser.add_argument("--fleet", action="store_true", help="Compare the stored inventories of all device folders; no device needed.")
+    parser.add_argument("--golden", metavar="FILE", help="With --fleet: package list every device should match (default: majority).")
+    parser.add_argument("--output", "-o", default="-", help="Where to write the JSON results (default: stdout).")
+    parser.add_argument("--quiet", "-q", action="store_true", help="Do not echo log lines to stderr.")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    logger = Logger(stream=None if args.quiet else sys.stderr)
+    timer = PhaseTimer()
+    if args.adb:
+        adb_executable, adb_verified = args.adb, False
+    else:
+        adb_executable, adb_version, adb_verified = resolve_adb_fast(timer)
+        adb_executable = adb_executable or "adb"
+        metrics.meta["adb_version"] = adb_version or "unknown"
+    if enable_native_adb_from_env():
+        logger.log("Native ADB client enabled (in-process host protocol).", level="INFO")
+    report = {"adb": adb_executable, "started_at": datetime.now().isoformat(timespec="seconds"), "devices": {}, "error": None}
+
+    def finish(exit_code):
+        report["adb"] = adb_executable
+        report["elapsed_s"] = round(time.monotonic() - started, 3)
+        report["metrics"] = metrics.to_json()["devices"]
+        text = json.dumps(report, indent=2)
+        if args.output == "-":
+            print(text)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        logger.close()
+        return exit_code
+
+    plan = {"uninstall": [], "install": [], "restore": []}
+    try:
+        for path in args.plan:
+            loaded = load_plan(path)
+            plan["uninstall"] += loaded["uninstall"]
+            plan["install"] += loaded["install"]
+            plan["restore"] += loaded["restore"]
+        for path in args.uninstall:
+            plan["uninstall"] += read_package_list(path)
+        for path in args.install:
+            plan["install"] += read_package_list(path)
+        for path in args.restore:
+            plan["restore"] += read_package_list(path)
+        golden = read_package_list(args.golden) if args.golden else None
+        profiles = [DebloatProfile.load(path) for path in args.profile]
+        for profile in profiles:
+            for error in profile.errors:
+                logger.log(f"Profile: {error}", level="WARNING")
+    except Exception as e:
+        report["error"] = f"Bad plan: {e}"
+        return finish(2)
+    plan = {action: list(dict.fromkeys(packages)) for action, packages in plan.items()}
+
+    if args.fleet:
+        fleet = FleetMatrix.load()
+        report["fleet"] = fleet.to_json(golden)
+        return finish(0 if fleet.devices else 2)
+
+    found, error_reason = connect_devices(adb_verified, timer)
+    report["startup"] = timer.as_dict()
+    if not found:
+        report["error"] = f"Failed to connect: {error_reason}"
+        return finish(2)
+    sessions = build_sessions(found)
+
+    if args.serial:
+        missing = [serial for serial in args.serial if serial not in sessions]
+        if missing:
+            report["error"] = f"Device(s) not attached: {', '.join(missing)}"
+            return finish(2)
+        targets = [sessions[serial] for serial in args.serial]
+    elif args.all_devices or len(sessions) == 1:
+        targets = list(sessions.values())
+    else:
+        report["error"] = "More than one device attached; use --serial or --all-devices."
+        return finish(2)
+
+    def run_device(session=None):
+        result = {"model": session.name, "folder": session.folder}
+        if args.list or profiles:
+            fetch_session_packages(session)
+        if args.list:
+            result["packages"] = {name: dict(zip(PackageRecord.__slots__, record.to_list()))
+                                  for name, record in session.inventory.items()}
+        to_uninstall = list(plan["uninstall"])
+        if profiles:
+            result["profile"] = {}
+            for profile in profiles:
+                selected, excluded = profile.evaluate(session.model.installed_names())
+                for name, reason in selected.items():
+                    result["profile"].setdefault(name, reason)
+            to_uninstall = list(dict.fromkeys(to_uninstall + list(result["profile"])))
+        if to_uninstall:
+            result["uninstall"] = uninstall_packages(to_uninstall, batch=not args.no_batch, session=session, backup=args.backup)
+        if plan["install"]:
+            result["install"] = install_existing_packages(plan["install"], batch=not args.no_batch, session=session)
+        if plan["restore"]:
+            result["restore"] = restore_packages(plan["restore"], session=session)
+        journal = OperationJournal(session)
+        for mode, runs in (("revert", args.revert), ("replay", args.replay)):
+            if not runs:
+                continue
+            targets = journal_targets(journal.select(None if "all" in runs else runs, args.since, args.until), mode)
+            origin = f"{mode} of {', '.join(runs)}"
+            result[mode] = apply_journal(list(targets), batch=not args.no_batch, session=session, targets=targets,
+                                         origin=origin) if targets else {}
+        if args.history:
+            result["history"] = journal.runs()
+        return result
+
+    failed = False
+    for serial, result in run_on_devices(run_device, targets).items():
+        if isinstance(result, Exception):
+            report["devices"][serial] = {"error": str(result)}
+            failed = True
+            continue
+        report["devices"][serial] = result
+        for action in ("uninstall", "install", "restore", "revert", "replay"):
+            if any(not r["success"] for r in result.get(action, {}).values()):
+                failed = True
+    return finish(1 if failed else 0)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_headless(sys.argv[1:]))
     create_gui()
\ No newline at end of file